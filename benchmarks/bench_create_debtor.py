@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Measure the rate of debtor creation with different ID allocators.
+
+Usage: bench_create_debtor.py [NUMBER]
+
+Creates NUMBER debtors with each of the allocators, calling
+`procedures.create_debtor` once per debtor. The debtors are written
+to the database specified by SQLALCHEMY_DATABASE_URI, so do not run
+this against a production database.
+
+"""
+
+import sys
+import time
+from swaptacular_debtor import create_app, procedures
+from swaptacular_debtor.ids import ID_ALLOCATORS, create_id_allocator
+from swaptacular_debtor.models import reserve_debtor_id_block
+
+DEFAULT_NUMBER = 1000
+
+
+def report(title, seconds, number):
+    print(f'{title:<40} {number / seconds:10.0f} debtors/s')
+
+
+def main(number):
+    app = create_app()
+    with app.app_context():
+        for name in ID_ALLOCATORS:
+            allocator = create_id_allocator(name, reserve_block=reserve_debtor_id_block)
+            app.extensions['debtor_id_allocator'] = allocator
+            started_at = time.perf_counter()
+            for _ in range(number):
+                allocator.allocate()
+            report(f'{name} allocation', time.perf_counter() - started_at, number)
+            started_at = time.perf_counter()
+            for _ in range(number):
+                procedures.create_debtor(user_id=1)
+            report(f'{name} create_debtor', time.perf_counter() - started_at, number)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if args else DEFAULT_NUMBER)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Measure the per-call Python overhead of the transfer procedures.
+
+Usage: bench_procedure_queries.py [NUMBER]
+
+Prepares and commits NUMBER direct transfers, first with statement
+caching disabled (the statements are built and compiled on each
+call), then with statement caching enabled. The reported time is the
+CPU time of this process, which excludes the time spent in the
+database server. A debtor is created, and then deleted, in the
+database specified by SQLALCHEMY_DATABASE_URI, so do not run this
+against a production database.
+
+"""
+
+import sys
+import time
+from sqlalchemy.sql.compiler import SQLCompiler
+from swaptacular_debtor import create_app, procedures
+from swaptacular_debtor.models import db, Debtor, Account, Coordinator, Branch, Operator
+
+DEFAULT_NUMBER = 1000
+STATEMENT_BUILDERS = [
+    procedures._get_accounts_upsert,
+    procedures._get_account_amount_update_stmt,
+    procedures._get_account_slot_upsert_stmt,
+    procedures._get_prepared_transfer_delete_stmt,
+    procedures._get_account_balances_upsert_stmt,
+    procedures._get_debtor_operators_queries,
+    procedures._get_account_state_query,
+]
+
+compilations = 0
+sqlcompiler_init = SQLCompiler.__init__
+
+
+def counting_sqlcompiler_init(self, *args, **kwargs):
+    global compilations
+    compilations += 1
+    sqlcompiler_init(self, *args, **kwargs)
+
+
+def report(title, seconds, compilation_count, number):
+    print(f'{title:<40} {seconds / number * 1e6:8.0f} us/transfer {compilation_count / number:5.1f} compilations/transfer')
+
+
+def transfer(debtor_id):
+    pt = procedures.prepare_direct_transfer((debtor_id, procedures.ROOT_CREDITOR_ID), 1, 1)
+    procedures.commit_creditor_prepared_transfer(pt)
+
+
+def run(title, app, debtor_id, number, cached):
+    global compilations
+    with app.app_context():
+        transfer(debtor_id)
+        compilations = 0
+        started_at = time.process_time()
+        for _ in range(number):
+            if not cached:
+                for builder in STATEMENT_BUILDERS:
+                    builder.cache_clear()
+            transfer(debtor_id)
+        report(title, time.process_time() - started_at, compilations, number)
+
+
+def main(number):
+    SQLCompiler.__init__ = counting_sqlcompiler_init
+    uncached_app = create_app({'SQLALCHEMY_COMPILED_CACHE_SIZE': 0})
+    cached_app = create_app()
+    with cached_app.app_context():
+        debtor_id = procedures.create_debtor(user_id=1).debtor_id
+        procedures._change_account_balances({(debtor_id, procedures.ROOT_CREDITOR_ID): (0, 2 * number + 2)})
+        db.session.commit()
+    try:
+        run('statements compiled on each call', uncached_app, debtor_id, number, cached=False)
+        run('cached statements', cached_app, debtor_id, number, cached=True)
+    finally:
+        with cached_app.app_context():
+            for model in [Operator, Branch, Coordinator, Account, Debtor]:
+                model.query.filter_by(debtor_id=debtor_id).delete()
+            db.session.commit()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if args else DEFAULT_NUMBER)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Measure the cost of serializing one signal message.
+
+Usage: bench_signal_serializers.py [NUMBER]
+
+Compares the marshmallow schema dump with the compiled dump function
+that `SignalModel` uses. No database or message broker is needed.
+
+"""
+
+import sys
+import timeit
+from sqlalchemy.orm import configure_mappers
+from swaptacular_debtor import create_app
+from swaptacular_debtor.models import TransactionSignal
+
+DEFAULT_NUMBER = 100000
+
+
+def report(title, seconds, number):
+    print(f'{title:<40} {seconds / number * 1e9:10.0f} ns/signal')
+
+
+def main(number):
+    app = create_app()
+    with app.app_context():
+        configure_mappers()
+        signal = TransactionSignal(
+            debtor_id=1234567890123,
+            prepared_transfer_seqnum=42,
+            sender_creditor_id=1,
+            recipient_creditor_id=2,
+            amount=1000,
+        )
+        schema_dump = TransactionSignal.__marshmallow_schema__.dump
+        compiled_dump = TransactionSignal._get_signalbus_dump()
+        _, actor_name = TransactionSignal._get_signalbus_routing()
+        assert compiled_dump(signal) == schema_dump(signal)
+
+        report('marshmallow schema dump', timeit.timeit(lambda: schema_dump(signal), number=number), number)
+        report('compiled dump', timeit.timeit(lambda: compiled_dump(signal), number=number), number)
+        report('routing lookup', timeit.timeit(TransactionSignal._get_signalbus_routing, number=number), number)
+        report('create and encode message', timeit.timeit(
+            lambda: signal._create_signalbus_message(actor_name).encode(),
+            number=number,
+        ), number)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if args else DEFAULT_NUMBER)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Measure the throughput and the latency of the procedures under concurrency.
+
+Usage: bench_throughput.py [options]   (see --help)
+
+Each operation is run by 1..N concurrent worker processes, for a
+fixed time, with each of the account-skew distributions:
+
+  uniform   -- the sender accounts are chosen uniformly
+  zipf      -- the sender accounts are chosen by a Zipf distribution,
+               so a few accounts get most of the transfers
+  hot-root  -- all transfers are sent from the root account
+
+The reported throughput is in operations per second; the latencies
+are the 50th and the 99th percentile, in milliseconds; the retries
+are the failed transaction attempts per operation. The results are
+appended to a JSON-lines file, together with the current git commit,
+and are compared with the latest results for another commit, so
+that regressions show up.
+
+Debtors are created, and then deleted, in the database specified by
+SQLALCHEMY_DATABASE_URI, so do not run this against a production
+database.
+
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import datetime
+import argparse
+import itertools
+import traceback
+import subprocess
+import multiprocessing
+from swaptacular_debtor import create_app, procedures
+from swaptacular_debtor.models import db, get_now_utc
+
+OPERATIONS = ['transfer', 'cancel', 'withdrawal_request', 'create_debtor']
+SKEWS = ['uniform', 'zipf', 'hot-root']
+DEFAULT_WORKERS = '1,2,4,8'
+DEFAULT_DURATION_SECONDS = 5.0
+DEFAULT_ACCOUNTS = 1000
+DEFAULT_RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'throughput_results.jsonl')
+ZIPF_EXPONENT = 1.1
+WARMUP_OPERATIONS = 10
+WORKER_STARTUP_TIMEOUT_SECONDS = 120.0
+WORKER_EXIT_TIMEOUT_SECONDS = 10.0
+RESULTS_POLL_SECONDS = 1.0
+USER_ID = 1
+INITIAL_BALANCE = 10 ** 15
+
+
+class Workload:
+    """Choose the arguments of the operations, according to the account-skew distribution."""
+
+    def __init__(self, debtor_id, accounts, skew):
+        self.debtor_id = debtor_id
+        self.creditor_ids = list(range(1, accounts + 1))
+        self.skew = skew
+        weights = (1.0 / (rank ** ZIPF_EXPONENT) for rank in range(1, accounts + 1))
+        self.zipf_cum_weights = list(itertools.accumulate(weights))
+
+    def choose_sender(self):
+        if self.skew == 'hot-root':
+            return procedures.ROOT_CREDITOR_ID
+        if self.skew == 'zipf':
+            return random.choices(self.creditor_ids, cum_weights=self.zipf_cum_weights)[0]
+        return random.choice(self.creditor_ids)
+
+    def choose_recipient(self):
+        return random.choice(self.creditor_ids)
+
+    def run(self, operation, created_debtor_ids):
+        if operation in ('transfer', 'cancel'):
+            sender = (self.debtor_id, self.choose_sender())
+            pt = procedures.prepare_direct_transfer(sender, self.choose_recipient(), 1)
+            if operation == 'transfer':
+                procedures.commit_creditor_prepared_transfer(pt)
+            else:
+                procedures.cancel_creditor_prepared_transfer(pt)
+        elif operation == 'withdrawal_request':
+            operator = (self.debtor_id, procedures.DEFAULT_BRANCH_ID, USER_ID)
+            deadline_ts = get_now_utc() + datetime.timedelta(days=1)
+            procedures.create_withdrawal_request(operator, self.choose_sender(), 1, deadline_ts)
+        elif operation == 'create_debtor':
+            created_debtor_ids.append(procedures.create_debtor(user_id=USER_ID).debtor_id)
+        else:
+            raise ValueError(operation)
+
+
+class MeasurementError(Exception):
+    """A worker process failed, or did not finish in time."""
+
+
+def worker(debtor_id, accounts, skew, operation, duration, barrier, results):
+    # The created debtors are reported even if the worker fails, so
+    # that they can be deleted.
+    created_debtor_ids = []
+    try:
+        results.put(run_worker(debtor_id, accounts, skew, operation, duration, barrier, created_debtor_ids))
+    except BaseException:
+        results.put(dict(error=traceback.format_exc(), created_debtor_ids=created_debtor_ids))
+
+
+def run_worker(debtor_id, accounts, skew, operation, duration, barrier, created_debtor_ids):
+    app = create_app()
+    workload = Workload(debtor_id, accounts, skew)
+    latencies = []
+    errors = 0
+    with app.app_context():
+        for _ in range(WARMUP_OPERATIONS):
+            workload.run(operation, created_debtor_ids)
+        stats = app.extensions['contention_stats']
+        retries_before = sum(p.retries for p in stats.get_procedures().values())
+        barrier.wait(timeout=WORKER_STARTUP_TIMEOUT_SECONDS)
+        deadline = time.perf_counter() + duration
+        while True:
+            started_at = time.perf_counter()
+            if started_at >= deadline:
+                break
+            try:
+                workload.run(operation, created_debtor_ids)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started_at)
+        retries = sum(p.retries for p in stats.get_procedures().values()) - retries_before
+    return dict(latencies=latencies, errors=errors, retries=retries, created_debtor_ids=created_debtor_ids)
+
+
+def collect_results(processes, barrier, results, timeout, created_debtor_ids):
+    """Return the results of the workers, or raise `MeasurementError` if some of them fail.
+
+    The IDs of the debtors created by the workers are added to
+    `created_debtor_ids`, even when the measurement fails.
+
+    """
+
+    worker_results = []
+    error = None
+    pending = len(processes)
+    deadline = time.monotonic() + timeout
+    while pending > 0:
+        try:
+            result = results.get(timeout=RESULTS_POLL_SECONDS)
+        except queue.Empty:
+            # The workers put their results before exiting, so when
+            # all workers have exited, no more results will come.
+            if all(process.exitcode is not None for process in processes) or time.monotonic() > deadline:
+                error = error or f'{pending} of the worker processes died, or did not finish in time.'
+                break
+            if error is None and any(process.exitcode not in (None, 0) for process in processes):
+                error = 'A worker process died.'
+                barrier.abort()
+            continue
+        pending -= 1
+        created_debtor_ids.extend(result['created_debtor_ids'])
+        if 'error' in result:
+            # The workers that wait for the others get released.
+            error = error or result['error']
+            barrier.abort()
+        else:
+            worker_results.append(result)
+    if error is not None:
+        for process in processes:
+            if process.exitcode is None:
+                process.terminate()
+        raise MeasurementError(error)
+    return worker_results
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))]
+
+
+def measure(context, debtor_id, accounts, skew, operation, workers, duration, created_debtor_ids):
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(debtor_id, accounts, skew, operation, duration, barrier, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        timeout = WORKER_STARTUP_TIMEOUT_SECONDS + duration + WORKER_EXIT_TIMEOUT_SECONDS
+        worker_results = collect_results(processes, barrier, results, timeout, created_debtor_ids)
+    finally:
+        for process in processes:
+            process.join()
+    latencies = sorted(latency for r in worker_results for latency in r['latencies'])
+    count = len(latencies)
+    return dict(
+        operation=operation,
+        skew=skew,
+        workers=workers,
+        accounts=accounts,
+        duration=duration,
+        operations=count,
+        ops_per_second=count / duration,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        retries_per_operation=sum(r['retries'] for r in worker_results) / max(count, 1),
+        errors=sum(r['errors'] for r in worker_results),
+    )
+
+
+def create_benchmark_debtor(app, accounts):
+    with app.app_context():
+        debtor_id = procedures.create_debtor(user_id=USER_ID).debtor_id
+        account_ids = [procedures.ROOT_CREDITOR_ID, *range(1, accounts + 1)]
+        procedures._change_account_balances({(debtor_id, c): (0, INITIAL_BALANCE) for c in account_ids})
+        db.session.commit()
+    return debtor_id
+
+
+def delete_debtors(app, debtor_ids):
+    tables = [table for table in reversed(db.metadata.sorted_tables) if 'debtor_id' in table.c]
+    with app.app_context():
+        for table in tables:
+            db.session.execute(table.delete().where(table.c.debtor_id.in_(debtor_ids)))
+        db.session.commit()
+
+
+def get_git_commit():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=directory) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_baseline(previous_results, result):
+    key = ('operation', 'skew', 'workers', 'accounts')
+    for previous in reversed(previous_results):
+        if previous['commit'] != result['commit'] and all(previous[k] == result[k] for k in key):
+            return previous
+    return None
+
+
+def report(result, baseline):
+    line = (
+        f"{result['operation']:<20} {result['skew']:<9} {result['workers']:>3} workers"
+        f" {result['ops_per_second']:9.0f} ops/s"
+        f" p50 {result['p50_ms']:7.2f} ms p99 {result['p99_ms']:7.2f} ms"
+        f" {result['retries_per_operation']:6.3f} retries/op"
+    )
+    if result['errors']:
+        line += f" {result['errors']} errors"
+    if baseline is not None:
+        change = result['ops_per_second'] / baseline['ops_per_second'] - 1 if baseline['ops_per_second'] else 0.0
+        line += f" ({change:+.1%} ops/s, p99 was {baseline['p99_ms']:.2f} ms at {baseline['commit']})"
+    print(line, flush=True)
+
+
+def parse_list(value, choices=None):
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    if choices is not None:
+        for item in items:
+            if item not in choices:
+                raise argparse.ArgumentTypeError(f'"{item}" is not one of {", ".join(choices)}')
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-o', '--operations', type=lambda v: parse_list(v, OPERATIONS), default=OPERATIONS,
+                        help='Comma-separated operations to measure (default: all).')
+    parser.add_argument('-s', '--skews', type=lambda v: parse_list(v, SKEWS), default=SKEWS,
+                        help='Comma-separated account-skew distributions (default: all).')
+    parser.add_argument('-w', '--workers', type=lambda v: [int(n) for n in parse_list(v)],
+                        default=[int(n) for n in parse_list(DEFAULT_WORKERS)],
+                        help=f'Comma-separated numbers of concurrent workers (default: {DEFAULT_WORKERS}).')
+    parser.add_argument('-d', '--duration', type=float, default=DEFAULT_DURATION_SECONDS,
+                        help=f'Seconds to run each measurement (default: {DEFAULT_DURATION_SECONDS}).')
+    parser.add_argument('-a', '--accounts', type=int, default=DEFAULT_ACCOUNTS,
+                        help=f'Number of creditor accounts (default: {DEFAULT_ACCOUNTS}).')
+    parser.add_argument('-r', '--results', default=DEFAULT_RESULTS_PATH,
+                        help='The JSON-lines file to which the results are appended.')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    app = create_app()
+    commit = get_git_commit()
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    previous_results = load_results(args.results)
+    debtor_id = create_benchmark_debtor(app, args.accounts)
+    created_debtor_ids = []
+    try:
+        with open(args.results, 'a') as f:
+            for operation in args.operations:
+                # The skew does not matter when creating debtors.
+                skews = args.skews[:1] if operation == 'create_debtor' else args.skews
+                for skew in skews:
+                    for workers in args.workers:
+                        result = measure(context, debtor_id, args.accounts, skew, operation, workers,
+                                         args.duration, created_debtor_ids)
+                        result = dict(commit=commit, started_at=started_at, **result)
+                        report(result, find_baseline(previous_results, result))
+                        f.write(json.dumps(result) + '\n')
+                        f.flush()
+    except MeasurementError as e:
+        return f'The measurement was aborted: {e}'
+    finally:
+        delete_debtors(app, [debtor_id, *created_debtor_ids])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,6 +32,10 @@ case $1 in
         shift;
         exec flask signalbus "$@"
         ;;
+    debtor)
+        shift;
+        exec flask debtor "$@"
+        ;;
     supervisord)
         exec supervisord -c /usr/src/app/docker_flask/supervisord.conf
         ;;
@@ -3,6 +3,7 @@ from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging.config import fileConfig
 import logging
+import re
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -21,6 +22,7 @@ from flask import current_app
 config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
+PARTITION_NAME = re.compile(r'\w+_p\d+')
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -28,6 +30,17 @@ target_metadata = current_app.extensions['migrate'].db.metadata
 # ... etc.
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # Table partitions, and the foreign keys that PostgreSQL creates
+    # for them, are not present in the metadata.
+    if reflected and compare_to is None:
+        if type_ == 'table':
+            return not PARTITION_NAME.fullmatch(name)
+        if type_ == 'foreign_key_constraint':
+            return not PARTITION_NAME.fullmatch(object.referred_table.name)
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -73,6 +86,7 @@ def run_migrations_online():
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      include_object=include_object,
                       **current_app.extensions['migrate'].configure_args)
     
     try:
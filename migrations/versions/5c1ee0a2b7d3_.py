@@ -0,0 +1,40 @@
+"""empty message
+
+Revision ID: 5c1ee0a2b7d3
+Revises: 44423ccd9930
+Create Date: 2026-10-17 03:02:41.506312
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1ee0a2b7d3'
+down_revision = '44423ccd9930'
+branch_labels = None
+depends_on = None
+
+SIGNAL_TABLES = ['withdrawal_signal', 'transaction_signal']
+
+
+def upgrade():
+    op.execute("""
+        CREATE FUNCTION signalbus_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('signalbus', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table in SIGNAL_TABLES:
+        op.execute(f"""
+            CREATE TRIGGER {table}_notify AFTER INSERT ON {table}
+            FOR EACH STATEMENT EXECUTE PROCEDURE signalbus_notify()
+        """)
+
+
+def downgrade():
+    for table in SIGNAL_TABLES:
+        op.execute(f'DROP TRIGGER {table}_notify ON {table}')
+    op.execute('DROP FUNCTION signalbus_notify()')
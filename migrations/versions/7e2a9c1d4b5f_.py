@@ -0,0 +1,24 @@
+"""empty message
+
+Revision ID: 7e2a9c1d4b5f
+Revises: 11d4f6b2c630
+Create Date: 2026-10-17 03:10:12.418907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e2a9c1d4b5f'
+down_revision = '11d4f6b2c630'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE SEQUENCE debtor_id_block_seq MINVALUE 1 MAXVALUE 140737488355327')
+
+
+def downgrade():
+    op.execute('DROP SEQUENCE debtor_id_block_seq')
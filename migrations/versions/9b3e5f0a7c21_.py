@@ -0,0 +1,116 @@
+"""empty message
+
+Revision ID: 9b3e5f0a7c21
+Revises: 7e2a9c1d4b5f
+Create Date: 2026-10-17 03:24:51.733190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3e5f0a7c21'
+down_revision = '7e2a9c1d4b5f'
+branch_labels = None
+depends_on = None
+
+PARTITION_COUNT = 8
+
+PRIMARY_KEYS = {
+    'account': ['debtor_id', 'creditor_id'],
+    'account_slot': ['debtor_id', 'creditor_id', 'slot'],
+    'prepared_transfer': ['debtor_id', 'prepared_transfer_seqnum'],
+    'withdrawal_request': ['debtor_id', 'creditor_id', 'withdrawal_request_seqnum'],
+    'withdrawal': ['debtor_id', 'creditor_id', 'withdrawal_request_seqnum'],
+    'withdrawal_signal': ['debtor_id', 'creditor_id', 'withdrawal_request_seqnum'],
+    'transaction_signal': ['debtor_id', 'prepared_transfer_seqnum'],
+}
+
+SERIAL_COLUMNS = {
+    'prepared_transfer': 'prepared_transfer_seqnum',
+    'withdrawal_request': 'withdrawal_request_seqnum',
+    'transaction_signal': 'prepared_transfer_seqnum',
+}
+
+INDEXES = [
+    ('idx_prepared_transfer_coordinator_id', 'prepared_transfer', ['debtor_id', 'coordinator_id']),
+    ('idx_prepared_transfer_prepared_at_ts', 'prepared_transfer', ['prepared_at_ts']),
+    ('idx_prepared_transfer_sender_creditor_id', 'prepared_transfer', ['debtor_id', 'sender_creditor_id']),
+    ('idx_withdrawal_closing_ts', 'withdrawal', ['debtor_id', 'operator_branch_id', 'closing_ts']),
+    ('idx_withdrawal_request_deadline_ts', 'withdrawal_request', ['deadline_ts']),
+    ('idx_withdrawal_request_opening_ts', 'withdrawal_request', ['debtor_id', 'operator_branch_id', 'opening_ts']),
+]
+
+FOREIGN_KEYS = [
+    ('account_debtor_id_fkey', 'account', 'debtor', ['debtor_id'], ['debtor_id'], None),
+    ('account_slot_debtor_id_creditor_id_fkey', 'account_slot', 'account',
+     ['debtor_id', 'creditor_id'], ['debtor_id', 'creditor_id'], None),
+    ('prepared_transfer_debtor_id_sender_creditor_id_fkey', 'prepared_transfer', 'account',
+     ['debtor_id', 'sender_creditor_id'], ['debtor_id', 'creditor_id'], None),
+    ('prepared_transfer_debtor_id_coordinator_id_fkey', 'prepared_transfer', 'coordinator',
+     ['debtor_id', 'coordinator_id'], ['debtor_id', 'coordinator_id'], None),
+    ('withdrawal_request_debtor_id_operator_branch_id_operator_u_fkey', 'withdrawal_request', 'operator',
+     ['debtor_id', 'operator_branch_id', 'operator_user_id'], ['debtor_id', 'branch_id', 'user_id'], None),
+    ('withdrawal_debtor_id_operator_branch_id_operator_user_id_fkey', 'withdrawal', 'operator',
+     ['debtor_id', 'operator_branch_id', 'operator_user_id'], ['debtor_id', 'branch_id', 'user_id'], None),
+    ('withdrawal_signal_debtor_id_creditor_id_withdrawal_request_fkey', 'withdrawal_signal', 'withdrawal',
+     ['debtor_id', 'creditor_id', 'withdrawal_request_seqnum'],
+     ['debtor_id', 'creditor_id', 'withdrawal_request_seqnum'], 'CASCADE'),
+]
+
+SIGNAL_TABLES = ['withdrawal_signal', 'transaction_signal']
+
+
+def _rebuild_tables(partitioned):
+    # Each table is renamed, and a new table with the same columns,
+    # defaults, and check constraints is created in its place. Then
+    # the rows are copied, the old tables are dropped (along with
+    # their indexes, foreign keys, and triggers), and the indexes,
+    # foreign keys, and triggers are created again on the new tables.
+    bind = op.get_bind()
+    for table in PRIMARY_KEYS:
+        old_table = f'{table}_old'
+        comment = bind.execute(
+            sa.text("SELECT obj_description(CAST(:table AS regclass), 'pg_class')"),
+            table=table,
+        ).scalar()
+        op.rename_table(table, old_table)
+        op.execute(f"""
+            CREATE TABLE {table} (
+                LIKE {old_table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING COMMENTS
+            ) {'PARTITION BY HASH (debtor_id)' if partitioned else ''}
+        """)
+        if comment is not None:
+            op.create_table_comment(table, comment)
+        if partitioned:
+            for remainder in range(PARTITION_COUNT):
+                op.execute(f"""
+                    CREATE TABLE {table}_p{remainder} PARTITION OF {table}
+                    FOR VALUES WITH (MODULUS {PARTITION_COUNT}, REMAINDER {remainder})
+                """)
+        op.execute(f'INSERT INTO {table} SELECT * FROM {old_table}')
+        if table in SERIAL_COLUMNS:
+            column = SERIAL_COLUMNS[table]
+            op.execute(f'ALTER SEQUENCE {table}_{column}_seq OWNED BY {table}.{column}')
+    for table in PRIMARY_KEYS:
+        op.execute(f'DROP TABLE {table}_old CASCADE')
+    for table, columns in PRIMARY_KEYS.items():
+        op.create_primary_key(f'{table}_pkey', table, columns)
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+    for name, source, referent, local_cols, remote_cols, ondelete in FOREIGN_KEYS:
+        op.create_foreign_key(name, source, referent, local_cols, remote_cols, ondelete=ondelete)
+    for table in SIGNAL_TABLES:
+        op.execute(f"""
+            CREATE TRIGGER {table}_notify AFTER INSERT ON {table}
+            FOR EACH STATEMENT EXECUTE PROCEDURE signalbus_notify()
+        """)
+
+
+def upgrade():
+    _rebuild_tables(partitioned=True)
+
+
+def downgrade():
+    _rebuild_tables(partitioned=False)
@@ -0,0 +1,35 @@
+"""empty message
+
+Revision ID: c4d8e2f1a6b3
+Revises: 9b3e5f0a7c21
+Create Date: 2026-10-17 05:02:37.215864
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d8e2f1a6b3'
+down_revision = '9b3e5f0a7c21'
+branch_labels = None
+depends_on = None
+
+SIGNAL_TABLES = ['transaction_signal', 'withdrawal_signal']
+
+
+def upgrade():
+    for table in SIGNAL_TABLES:
+        # The existing signals get the current time.
+        op.add_column(table, sa.Column(
+            'inserted_at_ts',
+            sa.TIMESTAMP(timezone=True),
+            nullable=False,
+            server_default=sa.func.now(),
+        ))
+        op.alter_column(table, 'inserted_at_ts', server_default=None)
+
+
+def downgrade():
+    for table in SIGNAL_TABLES:
+        op.drop_column(table, 'inserted_at_ts')
@@ -0,0 +1,40 @@
+"""empty message
+
+Revision ID: e7a1c5d9f3b8
+Revises: c4d8e2f1a6b3
+Create Date: 2026-10-17 09:41:12.508317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a1c5d9f3b8'
+down_revision = 'c4d8e2f1a6b3'
+branch_labels = None
+depends_on = None
+
+HISTORY_INDEXES = [
+    ('idx_withdrawal_closing_ts', 'withdrawal', 'closing_ts'),
+    ('idx_withdrawal_request_opening_ts', 'withdrawal_request', 'opening_ts'),
+]
+
+
+def upgrade():
+    for name, table, ts_column in HISTORY_INDEXES:
+        # The primary key columns are appended, so that the history
+        # pages can be read in index order, without sorting.
+        op.drop_index(name, table_name=table)
+        op.create_index(
+            name,
+            table,
+            ['debtor_id', 'operator_branch_id', ts_column, 'creditor_id', 'withdrawal_request_seqnum'],
+            unique=False,
+        )
+
+
+def downgrade():
+    for name, table, ts_column in HISTORY_INDEXES:
+        op.drop_index(name, table_name=table)
+        op.create_index(name, table, ['debtor_id', 'operator_branch_id', ts_column], unique=False)
@@ -15,19 +15,92 @@ class Configuration(metaclass=MetaFlaskEnv):
     SQLALCHEMY_MAX_OVERFLOW = None
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = False
+    SQLALCHEMY_COMPILED_CACHE_SIZE = 1000
     RABBITMQ_EVENT_EXCHANGE = ''
+    ROOT_ACCOUNT_SLOTS = 0
+    SIGNALBUS_AUTOFLUSH = True
+    PREPARED_TRANSFER_MAX_AGE_DAYS = 7.0
+    LOCK_ACCOUNT_AMOUNTS_WITH_UPDATE = True
+    DEBTOR_ID_ALLOCATOR = 'block'
+    DEBTOR_SHARDS = ''
+    REPLICA_DATABASE_URIS = ''
+    REPLICA_MAX_STALENESS_SECONDS = 5.0
+    ACCOUNT_CACHE_SIZE = 10000
+    ACCOUNT_CACHE_TTL_SECONDS = 5.0
+    ACCOUNT_CACHE_SHARED_PATH = ''
+    ASYNC_DATABASE_POOL_SIZE = 10
+    DEBTOR_QUEUE_PARTITIONS = 1
+    CONTENTION_HOT_ACCOUNTS_SIZE = 1000
+    METRICS_ENABLED = True
     # DRAMATIQ_BROKER_CLASS = 'StubBroker'
 
 
 def create_app(config_dict={}):
     from flask import Flask
-    from .tasks import broker
-    from .models import db, migrate
+    from sqlalchemy.util import LRUCache
+    from .tasks import broker, get_partition_queue_names, COMMANDS_QUEUE
+    from .models import db, migrate, reserve_debtor_id_block
+    from .ids import create_id_allocator
+    from .sharding import ShardRouter, parse_shards
+    from .replicas import ReplicaSelector, get_replica_staleness
+    from .account_cache import create_account_cache
+    from .contention import ContentionStats
+    from .metrics import Metrics, TimedQueuePool, metrics_blueprint
+    from .cli import debtor
 
     app = Flask(__name__)
     app.config.from_object(Configuration)
     app.config.from_mapping(config_dict)
+    shards = parse_shards(app.config['DEBTOR_SHARDS'])
+    shard_binds = {f'shard{i}': database_uri for i, (_, database_uri) in enumerate(shards)}
+    replica_binds = {f'replica{i}': uri for i, uri in enumerate(app.config['REPLICA_DATABASE_URIS'].split())}
+    app.config['SQLALCHEMY_BINDS'] = {**(app.config.get('SQLALCHEMY_BINDS') or {}), **shard_binds, **replica_binds}
+    if app.config['METRICS_ENABLED']:
+        # The pool checkout times are recorded (see `metrics`).
+        engine_options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool, **engine_options}
+    if app.config['SQLALCHEMY_COMPILED_CACHE_SIZE'] > 0:
+        # Compiled statements are cached by the engines, so that the
+        # statements that get reused (see `procedures`) are compiled
+        # only once.
+        engine_options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+        execution_options = engine_options.get('execution_options') or {}
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {**engine_options, 'execution_options': {
+            'compiled_cache': LRUCache(app.config['SQLALCHEMY_COMPILED_CACHE_SIZE']),
+            **execution_options,
+        }}
     db.init_app(app)
+    db.signalbus.autoflush = app.config['SIGNALBUS_AUTOFLUSH']
     migrate.init_app(app, db)
     broker.init_app(app)
+    for queue_name in get_partition_queue_names(COMMANDS_QUEUE, app.config['DEBTOR_QUEUE_PARTITIONS']):
+        # Dramatiq workers consume only declared queues. Note that
+        # Dramatiq workers run many threads, and consume all declared
+        # queues, so they do not execute debtor's commands one after
+        # another, unless a separate worker is started for each
+        # sub-queue, with `--threads 1 --queues QUEUE_NAME`. The
+        # `consume_commands` CLI command should be used instead.
+        broker.declare_queue(queue_name)
+    app.extensions['debtor_id_allocator'] = create_id_allocator(
+        app.config['DEBTOR_ID_ALLOCATOR'],
+        reserve_block=reserve_debtor_id_block,
+    )
+    app.extensions['shard_router'] = ShardRouter([
+        (lower_bound, f'shard{i}') for i, (lower_bound, _) in enumerate(shards)
+    ]) if shards else None
+    app.extensions['replica_selector'] = ReplicaSelector(
+        replica_binds,
+        max_staleness=app.config['REPLICA_MAX_STALENESS_SECONDS'],
+        get_staleness=lambda bind_key: get_replica_staleness(db.get_engine(app, bind=bind_key)),
+    ) if replica_binds else None
+    app.extensions['account_cache'] = create_account_cache(
+        app.config['ACCOUNT_CACHE_SIZE'],
+        ttl=app.config['ACCOUNT_CACHE_TTL_SECONDS'],
+        shared_path=app.config['ACCOUNT_CACHE_SHARED_PATH'],
+    )
+    app.extensions['contention_stats'] = ContentionStats(app.config['CONTENTION_HOT_ACCOUNTS_SIZE'])
+    app.extensions['metrics'] = Metrics() if app.config['METRICS_ENABLED'] else None
+    if app.config['METRICS_ENABLED']:
+        app.register_blueprint(metrics_blueprint)
+    app.cli.add_command(debtor)
     return app
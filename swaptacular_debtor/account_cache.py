@@ -0,0 +1,133 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+import datetime
+from collections import namedtuple
+from .lru import LruCache
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+AccountState = namedtuple('AccountState', 'balance avl_balance demurrage last_transfer_ts')
+
+
+class AccountCache(LruCache):
+    """An in-process LRU cache for account states, with a time-to-live.
+
+    The keys are `(debtor_id, creditor_id)` tuples, the values are
+    `AccountState` tuples.
+
+    """
+
+    def set(self, pk, state, version=None):
+        super().set(pk, AccountState(*state), version)
+
+
+class SharedAccountCache:
+    """A cache for account states, shared between processes (gunicorn workers, for example).
+
+    The entries are stored in a memory-mapped file (preferably in
+    "/dev/shm"). The cache is direct-mapped: each account has a single
+    slot, and an entry is evicted when another account that maps to
+    the same slot gets cached. No locks are used -- each entry
+    contains a checksum, and half-written entries are ignored.
+
+    Each slot also has a version, which gets incremented when an
+    account that maps to the slot is invalidated (see `get_version`).
+
+    """
+
+    # debtor_id, creditor_id, balance, avl_balance, demurrage,
+    # last_transfer_ts (in microseconds since the epoch), expires_at,
+    # checksum
+    SLOT = struct.Struct('<qqqqqqdI')
+    DATA = struct.Struct('<qqqqqqd')
+    EXPIRES_AT_OFFSET = struct.calcsize('<qqqqqq')
+    VERSION = struct.Struct('<Q')
+
+    def __init__(self, path, size, ttl):
+        assert size > 0
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        # The slots are followed by their versions.
+        self._versions_offset = size * self.SLOT.size
+        length = self._versions_offset + size * self.VERSION.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < length:
+                os.ftruncate(fd, length)
+            self._mmap = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+
+    def _get_offset(self, pk):
+        return (hash(pk) % self.size) * self.SLOT.size
+
+    def _get_version_offset(self, pk):
+        return self._versions_offset + (hash(pk) % self.size) * self.VERSION.size
+
+    def get_version(self, pk):
+        """Return a value that changes when the account gets invalidated."""
+
+        return self.VERSION.unpack_from(self._mmap, self._get_version_offset(pk))[0]
+
+    def get(self, pk):
+        """Return the cached state of an account, or `None` if it is not cached."""
+
+        *data, checksum = self.SLOT.unpack_from(self._mmap, self._get_offset(pk))
+        debtor_id, creditor_id, balance, avl_balance, demurrage, last_transfer_us, expires_at = data
+        if (debtor_id, creditor_id) != pk or expires_at <= time.time():
+            return None
+        if zlib.crc32(self.DATA.pack(*data)) != checksum:
+            return None
+        return AccountState(balance, avl_balance, demurrage, EPOCH + last_transfer_us * ONE_MICROSECOND)
+
+    def set(self, pk, state, version=None):
+        """Cache account's state, unless the account has been invalidated since `version` was obtained."""
+
+        if version is not None and self.get_version(pk) != version:
+            return
+        balance, avl_balance, demurrage, last_transfer_ts = state
+        data = self.DATA.pack(
+            *pk,
+            balance,
+            avl_balance,
+            demurrage,
+            (last_transfer_ts - EPOCH) // ONE_MICROSECOND,
+            time.time() + self.ttl,
+        )
+        offset = self._get_offset(pk)
+        self._mmap[offset:offset + self.SLOT.size] = data + struct.pack('<I', zlib.crc32(data))
+
+        # The account may have been invalidated by another process
+        # after the version was checked, but before the entry was
+        # written. (Note that `invalidate` increments the version
+        # before clearing the entry.)
+        if version is not None and self.get_version(pk) != version:
+            self._clear(pk)
+
+    def invalidate(self, pk):
+        version_offset = self._get_version_offset(pk)
+        version = self.VERSION.unpack_from(self._mmap, version_offset)[0]
+        self.VERSION.pack_into(self._mmap, version_offset, (version + 1) & 0xffffffffffffffff)
+        self._clear(pk)
+
+    def _clear(self, pk):
+        # Zeroing the expiration time also invalidates the checksum.
+        offset = self._get_offset(pk)
+        debtor_id, creditor_id = self.SLOT.unpack_from(self._mmap, offset)[:2]
+        if (debtor_id, creditor_id) == pk:
+            struct.pack_into('<d', self._mmap, offset + self.EXPIRES_AT_OFFSET, 0.0)
+
+
+def create_account_cache(size, ttl, shared_path=''):
+    """Create an account cache, or return `None` if `size` is zero."""
+
+    if size <= 0:
+        return None
+    if shared_path:
+        return SharedAccountCache(shared_path, size, ttl)
+    return AccountCache(size, ttl)
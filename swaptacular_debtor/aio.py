@@ -0,0 +1,292 @@
+import re
+import json
+import random
+import asyncio
+import itertools
+import functools
+from types import SimpleNamespace
+import asyncpg
+from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.engine.url import make_url
+from flask_signalbus.utils import DBSerializationError
+from .contention import get_retry_cause
+from .ids import BlockIdAllocator, BLOCK_BITS, BLOCK_SIZE, MAX_BLOCK, scramble_id
+from .models import Debtor, Account, Coordinator, Branch, Operator, PreparedTransfer, WithdrawalRequest, \
+    DEBTOR_ID_BLOCK_SEQUENCE, get_now_utc
+from .procedures import ROOT_CREDITOR_ID, DEFAULT_COORINATOR_ID, DEFAULT_BRANCH_ID, InsufficientFunds, \
+    InvalidPreparedTransfer, OperatorInfo, _get_account_amount_update, _get_account_balances_upsert, \
+    _get_account_slot_upsert, _get_commit_changes, _get_cancel_changes, _get_prepared_transfer_delete, \
+    _with_column_defaults, _get_account_state_query, _get_operator_query, _get_operator_permission_query, \
+    _check_can_withdraw, STATEMENT_CACHE_SIZE
+
+# The same retry parameters as in `db.atomic`.
+ATOMIC_RETRIES = 7
+ATOMIC_MIN_WAIT_SECONDS = 0.1
+ATOMIC_MAX_WAIT_SECONDS = 10.0
+
+SERIALIZATION_ERRORS = (asyncpg.SerializationError, asyncpg.DeadlockDetectedError, DBSerializationError)
+
+DIALECT = pg.dialect(paramstyle='format')
+
+
+def compile_statement(stmt, params=None):
+    """Compile an SQLAlchemy Core statement, and return a `(sql, params)` tuple for asyncpg.
+
+    The compiled statements are cached. Note that asyncpg prepares
+    the statements on the server, and caches them per connection.
+
+    """
+
+    compiled, sql = _compile(stmt)
+    values = compiled.construct_params(params)
+    return sql, [values[name] for name in compiled.positiontup]
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _compile(stmt):
+    compiled = stmt.compile(dialect=DIALECT)
+    numbers = itertools.count(1)
+    sql = re.sub(r'%[s%]', lambda m: f'${next(numbers)}' if m.group() == '%s' else '%', compiled.string)
+    return compiled, sql
+
+
+def _get_insert(model, **values):
+    values = _with_column_defaults(model.__table__, values)
+    return _get_insert_stmt(model, tuple(sorted(values))), values
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _get_insert_stmt(model, keys):
+    table = model.__table__
+    return table.insert().values({k: bindparam(k, type_=table.c[k].type) for k in keys}).returning(*table.c)
+
+
+async def _init_connection(connection):
+    for type_name in ['json', 'jsonb']:
+        await connection.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+async def _fetch(connection, stmt, params=None):
+    sql, values = compile_statement(stmt, params)
+    return await connection.fetch(sql, *values)
+
+
+async def _delete_prepared_transfer(connection, prepared_transfer):
+    rows = await _fetch(connection, *_get_prepared_transfer_delete(prepared_transfer))
+    rows = [SimpleNamespace(**row) for row in rows]
+    if not rows:
+        raise InvalidPreparedTransfer()
+    return rows
+
+
+async def _change_account_balances(connection, changes, last_transfer_ts=None):
+    if changes:
+        await _fetch(connection, *_get_account_balances_upsert(changes, last_transfer_ts))
+
+
+class AsyncProcedures:
+    """Asynchronous counterparts of some of the functions in `procedures`.
+
+    The database is accessed through asyncpg connection pools (one
+    for each shard), so that a single process can keep many
+    transactions in flight. Like in `db.atomic`, the transactions are
+    retried on serialization failures. Accounts, operators, and
+    prepared transfers are passed as primary key tuples, and the
+    created rows are returned as `asyncpg.Record` instances.
+
+    The Flask application context is not used, so the procedures can
+    be called from any event loop.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pool_size = app.config['ASYNC_DATABASE_POOL_SIZE']
+        self._pools = {}
+        self._id_block = None
+        self._id_counter = BLOCK_SIZE
+
+    async def close(self):
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            await (await pool).close()
+
+    async def _get_pool(self, bind_key=None):
+        if bind_key not in self._pools:
+            binds = self.app.config['SQLALCHEMY_BINDS'] or {}
+            url = make_url(binds[bind_key] if bind_key else self.app.config['SQLALCHEMY_DATABASE_URI'])
+            url.drivername = url.get_backend_name()
+            self._pools[bind_key] = asyncio.ensure_future(asyncpg.create_pool(
+                str(url),
+                min_size=1,
+                max_size=self.pool_size,
+                init=_init_connection,
+                server_settings={'default_transaction_isolation': 'repeatable read'},
+            ))
+        pool = self._pools[bind_key]
+        try:
+            # The pool is shared, so its creation must not be cancelled
+            # together with the caller.
+            return await asyncio.shield(pool)
+        except Exception:
+            # The pool will be created again on the next call.
+            if self._pools.get(bind_key) is pool:
+                del self._pools[bind_key]
+            raise
+
+    def _get_bind_key(self, debtor_id):
+        router = self.app.extensions['shard_router']
+        return None if router is None else router.get_shard(debtor_id)
+
+    async def execute_atomic(self, debtor_id, func):
+        """Execute `await func(connection)` in a transaction, in the debtor's shard.
+
+        The transaction is retried on serialization failures.
+
+        """
+
+        pool = await self._get_pool(self._get_bind_key(debtor_id))
+        stats = self.app.extensions['contention_stats']
+        attempts = 0
+        retry_causes = []
+        failed = True
+        try:
+            while True:
+                attempts += 1
+                try:
+                    async with pool.acquire() as connection:
+                        async with connection.transaction():
+                            result = await func(connection)
+                    failed = False
+                    return result
+                except SERIALIZATION_ERRORS as e:
+                    retry_causes.append(get_retry_cause(e))
+                    if len(retry_causes) > ATOMIC_RETRIES:
+                        raise
+
+                # Many coroutines may have failed at the same moment, so
+                # the waits are randomized, to avoid colliding again.
+                max_wait_seconds = ATOMIC_MIN_WAIT_SECONDS * 2 ** (len(retry_causes) - 1)
+                await asyncio.sleep(random.uniform(0.0, min(ATOMIC_MAX_WAIT_SECONDS, max_wait_seconds)))
+        finally:
+            if stats is not None:
+                name = f'{func.__module__}.{func.__qualname__}'
+                stats.record(name, attempts, retry_causes, failed=failed)
+
+    def _invalidate_cached_accounts(self, pks):
+        cache = self.app.extensions['account_cache']
+        if cache is not None:
+            for pk in pks:
+                cache.invalidate(pk)
+
+    async def _allocate_debtor_id(self):
+        allocator = self.app.extensions['debtor_id_allocator']
+        if not isinstance(allocator, BlockIdAllocator):
+            return allocator.allocate()
+        if self._id_counter >= BLOCK_SIZE:
+            pool = await self._get_pool()
+            block = await pool.fetchval(f"SELECT nextval('{DEBTOR_ID_BLOCK_SEQUENCE}')")
+            assert 0 < block <= MAX_BLOCK
+            self._id_block = block
+            self._id_counter = 0
+        n = (self._id_block << BLOCK_BITS) | self._id_counter
+        self._id_counter += 1
+        return scramble_id(n)
+
+    async def create_debtor(self, user_id, **kw):
+        if 'debtor_id' not in kw:
+            kw['debtor_id'] = await self._allocate_debtor_id()
+        debtor_id = kw['debtor_id']
+
+        async def create(connection):
+            [debtor] = await _fetch(connection, *_get_insert(Debtor, **kw))
+            for model, values in [
+                    (Account, dict(creditor_id=ROOT_CREDITOR_ID, discount_demurrage_rate=0.0)),
+                    (Coordinator, dict(coordinator_id=DEFAULT_COORINATOR_ID)),
+                    (Branch, dict(branch_id=DEFAULT_BRANCH_ID)),
+                    (Operator, dict(branch_id=DEFAULT_BRANCH_ID, user_id=user_id, alias='admin',
+                                    can_withdraw=True, can_audit=True))]:
+                await _fetch(connection, *_get_insert(model, debtor_id=debtor_id, **values))
+            return debtor
+
+        return await self.execute_atomic(debtor_id, create)
+
+    async def prepare_direct_transfer(self, sender_account, recipient_creditor_id, amount):
+        assert amount > 0
+        debtor_id, sender_creditor_id = sender_account
+        ignore_demurrage = recipient_creditor_id == ROOT_CREDITOR_ID
+
+        async def prepare(connection):
+            if not await _fetch(connection, *_get_account_amount_update(sender_account, amount, ignore_demurrage)):
+                params = dict(debtor_id=debtor_id, creditor_id=sender_creditor_id)
+                accounts = await _fetch(connection, _get_account_state_query(), params)
+                account = accounts[0] if accounts else dict(avl_balance=0, demurrage=0)
+                raise InsufficientFunds(account['avl_balance'] + (account['demurrage'] if ignore_demurrage else 0))
+            [transfer] = await _fetch(connection, *_get_insert(
+                PreparedTransfer,
+                debtor_id=debtor_id,
+                sender_creditor_id=sender_creditor_id,
+                recipient_creditor_id=recipient_creditor_id,
+                amount=amount,
+                transfer_type=PreparedTransfer.TYPE_DIRECT,
+            ))
+            return transfer
+
+        transfer = await self.execute_atomic(debtor_id, prepare)
+        self._invalidate_cached_accounts([tuple(sender_account)])
+        return transfer
+
+    def _use_account_slots(self, creditor_id):
+        return creditor_id == ROOT_CREDITOR_ID and self.app.config['ROOT_ACCOUNT_SLOTS'] > 0
+
+    async def commit_creditor_prepared_transfer(self, prepared_transfer):
+        async def commit(connection):
+            rows = await _delete_prepared_transfer(connection, prepared_transfer)
+            changes, slot_amounts = _get_commit_changes(rows, self._use_account_slots)
+            now = get_now_utc()
+            await _change_account_balances(connection, changes, now)
+            for recipient, amount in sorted(slot_amounts.items()):
+                slot = random.randrange(self.app.config['ROOT_ACCOUNT_SLOTS'])
+                await _fetch(connection, *_get_account_slot_upsert(recipient, slot, amount, now))
+            return changes
+
+        self._invalidate_cached_accounts(await self.execute_atomic(prepared_transfer[0], commit))
+
+    async def cancel_creditor_prepared_transfer(self, prepared_transfer):
+        async def cancel(connection):
+            rows = await _delete_prepared_transfer(connection, prepared_transfer)
+            changes = _get_cancel_changes(rows)
+            await _change_account_balances(connection, changes)
+            return changes
+
+        self._invalidate_cached_accounts(await self.execute_atomic(prepared_transfer[0], cancel))
+
+    async def get_operator(self, operator):
+        """Return operator's `OperatorInfo`, or `None` if the operator does not exist."""
+
+        async def get(connection):
+            return next(iter(await _fetch(connection, *_get_operator_query(operator))), None)
+
+        row = await self.execute_atomic(operator[0], get)
+        return None if row is None else OperatorInfo(*row)
+
+    async def create_withdrawal_request(self, operator, creditor_id, amount, deadline_ts, details={}):
+        debtor_id, operator_branch_id, operator_user_id = operator
+        insert = _get_insert(
+            WithdrawalRequest,
+            debtor_id=debtor_id,
+            creditor_id=creditor_id,
+            amount=amount,
+            operator_branch_id=operator_branch_id,
+            operator_user_id=operator_user_id,
+            deadline_ts=deadline_ts,
+            details=details,
+        )
+
+        async def create(connection):
+            _check_can_withdraw(next(iter(await _fetch(connection, *_get_operator_permission_query(operator))), None))
+            [request] = await _fetch(connection, *insert)
+            return request
+
+        return await self.execute_atomic(debtor_id, create)
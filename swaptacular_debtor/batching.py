@@ -0,0 +1,166 @@
+import time
+import logging
+from sqlalchemy.exc import DBAPIError, IntegrityError, DataError, ProgrammingError
+from flask_signalbus.utils import DBSerializationError
+from .models import db
+from .sharding import sharded
+from .tasks import broker, commands, get_message_debtor_id, COMMANDS_QUEUE
+from . import procedures
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_WAIT_MILLISECONDS = 50
+TRANSIENT_ERROR_DELAY_SECONDS = 5.0
+
+# A command that fails with one of these errors is dropped, without
+# aborting the other commands in its transaction.
+COMMAND_ERRORS = (
+    procedures.InsufficientFunds,
+    procedures.InvalidPreparedTransfer,
+    procedures.InvalidWithdrawalRequest,
+    procedures.InvalidOperator,
+    procedures.PermissionDenied,
+)
+
+
+@sharded
+@db.atomic
+def execute_commands(debtor_id, commands):
+    """Execute debtor's commands in a single transaction.
+
+    `commands` is a sequence of `(func, args, kwargs)` tuples. Each
+    command is executed in a savepoint, so that a command that fails
+    with one of the `COMMAND_ERRORS` is rolled back alone. Other
+    errors abort the whole transaction.
+
+    """
+
+    for func, args, kwargs in commands:
+        try:
+            # Note that the savepoint must be rolled back on any
+            # error, otherwise the `db.atomic` rollback would roll
+            # back only the savepoint, instead of the transaction.
+            with db.session.begin_nested():
+                func(*args, **kwargs)
+        except COMMAND_ERRORS as e:
+            logger = logging.getLogger(__name__)
+            logger.info('Dropped command %s%r for debtor %i: %r', func.__name__, args, debtor_id, e)
+
+
+def consume_commands(batch_size=DEFAULT_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT_MILLISECONDS, queue_name=COMMANDS_QUEUE,
+                     drain=False):
+    """Consume command messages from a queue in batches.
+
+    Runs until interrupted, or if `drain` is true, until no message
+    has arrived for `max_wait` milliseconds.
+
+    A batch is complete when it contains `batch_size` messages, or
+    when no message has arrived for `max_wait` milliseconds. The
+    commands in the batch are grouped by debtor, and each group is
+    executed in a single transaction (see `execute_commands`). The
+    messages are acknowledged only after the transaction has been
+    committed. If a group fails, its commands are retried one by one,
+    and the messages of the commands that fail again are rejected
+    (dead-lettered).
+
+    Only the messages of the commands that fail deterministically are
+    rejected. When a group fails with a transient database error (see
+    `is_transient_error`), the consumer is closed without
+    acknowledging the rest of the batch, so that RabbitMQ redelivers
+    the messages, and consuming is resumed after a delay.
+
+    Like with Dramatiq workers, the delivery is "at least once": if
+    the process dies after a commit, but before the acknowledgements,
+    the commands will be executed again.
+
+    """
+
+    logger = logging.getLogger(__name__)
+    while True:
+        consumer = broker.consume(queue_name, prefetch=batch_size, timeout=max_wait)
+        try:
+            while True:
+                messages = _collect_batch(consumer, batch_size, block=not drain)
+                if not messages:
+                    return
+                process_batch(consumer, messages)
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            logger.exception('Caught transient error, will retry in %s seconds.', TRANSIENT_ERROR_DELAY_SECONDS)
+        finally:
+            consumer.close()
+        time.sleep(TRANSIENT_ERROR_DELAY_SECONDS)
+
+
+def is_transient_error(error):
+    """Return whether executing the failed commands again may succeed.
+
+    These are database errors, like a lost connection or a
+    serialization failure that persisted after the retries, except
+    for the errors caused by the commands themselves (integrity
+    violations, invalid data, and invalid SQL).
+
+    """
+
+    if isinstance(error, DBSerializationError):
+        return True
+    return isinstance(error, DBAPIError) and not isinstance(error, (IntegrityError, DataError, ProgrammingError))
+
+
+def process_batch(consumer, messages):
+    """Execute the commands in a batch of messages, and acknowledge or reject each message.
+
+    Transient database errors (see `is_transient_error`) are not
+    caught, and the messages that have not been processed yet are
+    left unacknowledged.
+
+    """
+
+    logger = logging.getLogger(__name__)
+    groups = {}
+    for message in messages:
+        func = commands.get(message.actor_name)
+        if func is None:
+            logger.error('Rejected a message for unknown command "%s".', message.actor_name)
+            consumer.nack(message)
+            continue
+        try:
+            debtor_id = get_message_debtor_id(message.args, message.kwargs)
+        except (KeyError, IndexError):
+            logger.error('Rejected a "%s" message without a debtor ID.', message.actor_name)
+            consumer.nack(message)
+            continue
+        groups.setdefault(debtor_id, []).append((message, (func, message.args, message.kwargs)))
+    for debtor_id, items in groups.items():
+        _execute_group(consumer, debtor_id, items)
+
+
+def _collect_batch(consumer, batch_size, block=True):
+    # Wait for the first message (indefinitely if `block` is true),
+    # then until the consumer times out.
+    messages = []
+    while len(messages) < batch_size:
+        message = next(consumer)
+        if message is not None:
+            messages.append(message)
+        elif messages or not block:
+            break
+    return messages
+
+
+def _execute_group(consumer, debtor_id, items):
+    try:
+        execute_commands(debtor_id, [command for _, command in items])
+    except Exception as e:
+        if is_transient_error(e):
+            raise
+        if len(items) > 1:
+            for item in items:
+                _execute_group(consumer, debtor_id, [item])
+            return
+        logger = logging.getLogger(__name__)
+        logger.exception('Caught error while executing a command for debtor %i.', debtor_id)
+        consumer.nack(items[0][0])
+    else:
+        for message, _ in items:
+            consumer.ack(message)
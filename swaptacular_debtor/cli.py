@@ -0,0 +1,289 @@
+import sys
+import time
+import datetime
+import select
+import logging
+import click
+import sqlalchemy
+from flask import current_app
+from flask.cli import with_appcontext
+from flask_signalbus.utils import report_signal_count
+from .models import db, Debtor, AccountSlot, SIGNALBUS_NOTIFY_CHANNEL, get_now_utc
+from . import procedures, batching
+from .tasks import get_partition_queue_names
+from .sharding import ShardRouter, parse_shards, get_shard_keys, use_shard, move_debtor
+
+DEBTOR_IDS_CHUNK_SIZE = 1000
+DEFAULT_FLUSH_WAIT_SECONDS = 0.5
+DEFAULT_SWEEP_INTERVAL_SECONDS = 60.0
+
+
+def _iter_debtor_ids(bind_key=None):
+    last_debtor_id = None
+    while True:
+        with use_shard(bind_key):
+            query = db.session.query(Debtor.debtor_id)
+            if last_debtor_id is not None:
+                query = query.filter(Debtor.debtor_id > last_debtor_id)
+            debtor_ids = [row[0] for row in query.order_by(Debtor.debtor_id).limit(DEBTOR_IDS_CHUNK_SIZE).all()]
+            db.session.rollback()
+        yield from debtor_ids
+        if len(debtor_ids) < DEBTOR_IDS_CHUNK_SIZE:
+            break
+        last_debtor_id = debtor_ids[-1]
+
+
+def _iter_all_debtor_ids():
+    for bind_key in get_shard_keys():
+        yield from _iter_debtor_ids(bind_key)
+
+
+def _reap(procedure, cutoff_ts, batch_size):
+    total_count = 0
+    while True:
+        count = procedure(cutoff_ts, batch_size)
+        total_count += count
+        if count < batch_size:
+            return total_count
+
+
+@click.group()
+def debtor():
+    """Perform debtor maintenance operations."""
+
+
+@debtor.command('accrue_demurrage')
+@with_appcontext
+@click.option('-d', '--debtor-id', type=int, help='Process only the accounts of the specified debtor.')
+@click.option('-s', '--start-after', type=int, help='Resume from the specified creditor ID.'
+              ' Requires the --debtor-id option.')
+@click.option('-c', '--chunk-size', type=int, default=procedures.DEMURRAGE_CHUNK_SIZE,
+              help='The number of accounts to process in one transaction.'
+              ' The default is %s.' % procedures.DEMURRAGE_CHUNK_SIZE)
+def accrue_demurrage(debtor_id, start_after, chunk_size):
+    """Accrue the demurrage on debtors' accounts.
+
+    The accounts of each debtor are processed in chunks, each chunk in
+    a separate transaction. After each chunk a checkpoint is logged,
+    from which an interrupted run can be resumed with the --debtor-id
+    and --start-after options.
+
+    """
+
+    logger = logging.getLogger(__name__)
+    if start_after is not None and debtor_id is None:
+        raise click.UsageError('The --start-after option requires the --debtor-id option.')
+    accrual_ts = get_now_utc()
+    debtor_ids = _iter_all_debtor_ids() if debtor_id is None else [debtor_id]
+    for debtor_id in debtor_ids:
+        checkpoints = procedures.accrue_demurrage(debtor_id, accrual_ts, start_after, chunk_size)
+        for creditor_id in checkpoints:
+            logger.info('Accrued demurrage for debtor %i, up to creditor %i.', debtor_id, creditor_id)
+        start_after = None
+
+
+@debtor.command('fold_account_slots')
+@with_appcontext
+@click.option('-r', '--repeat', type=float, help='Fold the slots every FLOAT seconds.')
+def fold_account_slots(repeat):
+    """Fold the amounts accumulated in account slots back into the accounts."""
+
+    logger = logging.getLogger(__name__)
+    while True:
+        started_at = time.time()
+        accounts = []
+        for bind_key in get_shard_keys():
+            with use_shard(bind_key):
+                accounts.extend(db.session.query(AccountSlot.debtor_id, AccountSlot.creditor_id).distinct().all())
+                db.session.rollback()
+        for account in accounts:
+            slot_count = procedures.fold_account_slots(tuple(account))
+            logger.debug('Folded %i slots of account %s.', slot_count, tuple(account))
+        if repeat is None:
+            break
+        time.sleep(max(0.0, repeat + started_at - time.time()))
+
+
+@debtor.command('reap_expired')
+@with_appcontext
+@click.option('-b', '--batch-size', type=int, default=procedures.REAPER_BATCH_SIZE,
+              help='The number of rows to process in one transaction.'
+              ' The default is %s.' % procedures.REAPER_BATCH_SIZE)
+@click.option('-r', '--repeat', type=float, help='Reap every FLOAT seconds.')
+def reap_expired(batch_size, repeat):
+    """Cancel stale prepared transfers and delete expired withdrawal requests.
+
+    Prepared transfers older than PREPARED_TRANSFER_MAX_AGE_DAYS are
+    cancelled. The rows locked by concurrent transactions are skipped,
+    so several processes can run this command in parallel.
+
+    """
+
+    logger = logging.getLogger(__name__)
+    max_age = datetime.timedelta(days=current_app.config['PREPARED_TRANSFER_MAX_AGE_DAYS'])
+    while True:
+        started_at = time.time()
+        now = get_now_utc()
+        for bind_key in get_shard_keys():
+            with use_shard(bind_key):
+                count = _reap(procedures.cancel_stale_prepared_transfers, now - max_age, batch_size)
+                logger.info('Cancelled %i stale prepared transfers.', count)
+                count = _reap(procedures.delete_expired_withdrawal_requests, now, batch_size)
+                logger.info('Deleted %i expired withdrawal requests.', count)
+        if repeat is None:
+            break
+        time.sleep(max(0.0, repeat + started_at - time.time()))
+
+
+@debtor.command('flush_signals')
+@with_appcontext
+@click.option('-w', '--wait', type=float, default=DEFAULT_FLUSH_WAIT_SECONDS,
+              help='The number of seconds to wait after a notification, to allow auto-flushing'
+              ' senders to complete. Ignored when SIGNALBUS_AUTOFLUSH is disabled.'
+              ' The default is %s seconds.' % DEFAULT_FLUSH_WAIT_SECONDS)
+@click.option('-s', '--sweep-interval', type=float, default=DEFAULT_SWEEP_INTERVAL_SECONDS,
+              help='Flush all pending signals every FLOAT seconds.'
+              ' The default is %s seconds.' % DEFAULT_SWEEP_INTERVAL_SECONDS)
+@click.option('--shard', help='Flush the signals from the specified shard (shard0, shard1, etc.).'
+              ' Required when DEBTOR_SHARDS is configured.')
+def flush_signals(wait, sweep_interval, shard):
+    """Send pending signals as soon as they are recorded in the database.
+
+    Runs until terminated. Listens for PostgreSQL notifications about
+    newly inserted signals, and immediately flushes the corresponding
+    signal types. Also, all signal types are periodically flushed, in
+    case a notification has been missed.
+
+    When SIGNALBUS_AUTOFLUSH is disabled, signals are sent only by
+    this command, and therefore they can be sent without waiting.
+
+    When DEBTOR_SHARDS is configured, one process should be run for
+    each shard.
+
+    """
+
+    if shard not in get_shard_keys():
+        raise click.BadParameter(f'"{shard}" is not a configured shard.', param_hint='--shard')
+    with use_shard(shard):
+        _flush_signals(wait, sweep_interval, db.get_engine(bind=shard))
+
+
+def _flush_signals(wait, sweep_interval, engine):
+    logger = logging.getLogger(__name__)
+    signalbus = current_app.extensions['signalbus']
+    models_by_tablename = {m.__tablename__: m for m in signalbus.get_signal_models()}
+    connection = engine.raw_connection()
+    connection.detach()
+    connection.connection.autocommit = True
+    connection.cursor().execute(f'LISTEN {SIGNALBUS_NOTIFY_CHANNEL}')
+    next_sweep_at = 0.0
+
+    while True:
+        now = time.time()
+        if now >= next_sweep_at:
+            models = list(models_by_tablename.values())
+            next_sweep_at = now + sweep_interval
+        else:
+            select.select([connection.connection], [], [], next_sweep_at - now)
+            connection.connection.poll()
+            notifies = connection.connection.notifies
+            models = [models_by_tablename[t] for t in {n.payload for n in notifies} if t in models_by_tablename]
+            notifies.clear()
+        if not models:
+            continue
+        try:
+            if signalbus.autoflush:
+                signal_count = signalbus.flush(models, wait=wait)
+            else:
+                signal_count = signalbus.flushmany(models)
+        except Exception:
+            logger.exception('Caught error while sending pending signals.')
+            sys.exit(1)
+        report_signal_count(signal_count)
+
+
+@debtor.command('rebalance_shards')
+@with_appcontext
+@click.argument('new_shards')
+def rebalance_shards(new_shards):
+    """Move debtors between shards, according to a new shards specification.
+
+    NEW_SHARDS has the same format as DEBTOR_SHARDS. The debtors that
+    belong to a different database according to NEW_SHARDS are moved
+    there, each debtor in a separate transaction. The new databases
+    must be already migrated. After that, the application must be
+    restarted with DEBTOR_SHARDS set to NEW_SHARDS. Requests for the
+    moved debtors will fail until then, so it is best to stop the
+    application during the rebalancing.
+
+    """
+
+    logger = logging.getLogger(__name__)
+    try:
+        new_router = ShardRouter(parse_shards(new_shards) or [(0, current_app.config['SQLALCHEMY_DATABASE_URI'])])
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='NEW_SHARDS')
+    current_shards = parse_shards(current_app.config['DEBTOR_SHARDS'])
+    current_uris = [uri for _, uri in current_shards] or [current_app.config['SQLALCHEMY_DATABASE_URI']]
+    tables = [table for table in db.metadata.sorted_tables if 'debtor_id' in table.c]
+    engines = {}
+
+    def get_engine(database_uri):
+        if database_uri not in engines:
+            engines[database_uri] = sqlalchemy.create_engine(database_uri)
+        return engines[database_uri]
+
+    for bind_key, source_uri in zip(get_shard_keys(), current_uris):
+        moved_count = 0
+        for debtor_id in _iter_debtor_ids(bind_key):
+            target_uri = new_router.get_shard(debtor_id)
+            if target_uri != source_uri:
+                move_debtor(debtor_id, tables, get_engine(source_uri), get_engine(target_uri))
+                moved_count += 1
+        logger.info('Moved %i debtors from %s.', moved_count, bind_key or 'the default database')
+
+
+@debtor.command('consume_commands')
+@with_appcontext
+@click.option('-b', '--batch-size', type=int, default=batching.DEFAULT_BATCH_SIZE,
+              help='The maximal number of messages in a batch.'
+              ' The default is %s.' % batching.DEFAULT_BATCH_SIZE)
+@click.option('-w', '--wait', type=int, default=batching.DEFAULT_MAX_WAIT_MILLISECONDS,
+              help='The number of milliseconds to wait for more messages, before processing a batch.'
+              ' The default is %s milliseconds.' % batching.DEFAULT_MAX_WAIT_MILLISECONDS)
+@click.option('-q', '--queue', default=batching.COMMANDS_QUEUE,
+              help='The name of the queue to consume. The default is "%s".' % batching.COMMANDS_QUEUE)
+@click.option('-p', '--partition', type=int, help='Consume the specified sub-queue of the queue.'
+              ' Required when DEBTOR_QUEUE_PARTITIONS is greater than one.')
+@click.option('--drain', is_flag=True, help='Exit when the queue is empty.')
+def consume_commands(batch_size, wait, queue, partition, drain):
+    """Execute transfer and withdrawal commands in batches.
+
+    Runs until terminated. The commands in each batch are grouped by
+    debtor, and each group is executed in a single transaction. The
+    messages are acknowledged after the transaction has been
+    committed.
+
+    When DEBTOR_QUEUE_PARTITIONS is greater than one, exactly one
+    process should be run for each partition (0, 1, 2, etc.), so that
+    the commands for a given debtor are executed one after another.
+
+    Changing DEBTOR_QUEUE_PARTITIONS moves debtors to other
+    sub-queues, so the queues must be drained first. Otherwise, the
+    messages in the old queues would be left unconsumed, or executed
+    concurrently with newer commands for the same debtors. To change
+    it: 1) stop the processes that send commands; 2) wait until the
+    command queues are empty; 3) stop the consume_commands processes;
+    4) change DEBTOR_QUEUE_PARTITIONS, and restart everything. Any
+    messages left in the old queues can be drained, before the
+    senders are restarted, by running this command with --drain, and
+    with DEBTOR_QUEUE_PARTITIONS set to its old value.
+
+    """
+
+    queue_names = get_partition_queue_names(queue, current_app.config['DEBTOR_QUEUE_PARTITIONS'])
+    if partition is None and len(queue_names) > 1:
+        raise click.UsageError('The --partition option is required when DEBTOR_QUEUE_PARTITIONS is set.')
+    if partition is not None and not 0 <= partition < len(queue_names):
+        raise click.BadParameter(f'{partition} is not a valid partition.', param_hint='--partition')
+    batching.consume_commands(batch_size, wait, queue_names[partition or 0], drain=drain)
@@ -0,0 +1,257 @@
+import re
+import time
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from flask_signalbus.utils import DBSerializationError, get_db_error_code
+from .stats import Histogram, ThreadLocalAggregator, LATENCY_BUCKETS
+
+ATTEMPTS_BUCKETS = (1, 2, 3, 4, 5, 6, 7, 8)
+RETRY_CAUSES = {
+    '40001': 'serialization_failure',
+    '40P01': 'deadlock_detected',
+}
+LOCKING_STATEMENT = re.compile(r'^\s*(UPDATE|DELETE)\b|\bFOR (NO KEY )?UPDATE\b|\bDO UPDATE\b', re.IGNORECASE)
+
+_local = threading.local()
+
+
+class ProcedureStats:
+    """Statistics for the calls of an atomic procedure.
+
+    `attempts` is a histogram of the number of transaction attempts
+    per call, `lock_seconds` is a histogram of the time per call spent
+    in row-locking statements (which includes the time waiting for
+    the locks), and `retry_causes` counts the failed attempts by cause.
+
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.attempts = Histogram(ATTEMPTS_BUCKETS)
+        self.lock_seconds = Histogram(LATENCY_BUCKETS)
+        self.retry_causes = Counter()
+
+    @property
+    def retries(self):
+        return int(self.attempts.sum) - self.attempts.count
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.failures += other.failures
+        self.attempts.merge(other.attempts)
+        self.lock_seconds.merge(other.lock_seconds)
+        self.retry_causes.update(dict(other.retry_causes))
+
+
+class KeyCounter:
+    """Count keys, remembering only the most frequent ones.
+
+    When more than `2 * size` keys are counted, only the `size` most
+    frequent of them are kept, so the counts are approximate.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = Counter()
+
+    def update(self, keys):
+        if self.size > 0:
+            self.counts.update(keys)
+            if len(self.counts) > 2 * self.size:
+                self.counts = Counter(dict(self.counts.most_common(self.size)))
+
+    def merge(self, other):
+        self.update(dict(other.counts))
+
+
+class _ThreadStats:
+    def __init__(self, hot_keys_size):
+        self.procedures = {}
+        self.transactions = KeyCounter(hot_keys_size)
+        self.conflicts = KeyCounter(hot_keys_size)
+
+    def get_procedure(self, name):
+        procedure = self.procedures.get(name)
+        if procedure is None:
+            procedure = self.procedures[name] = ProcedureStats()
+        return procedure
+
+    def merge(self, other):
+        # Note that `other` may be updated by another thread at the
+        # same time, so its dictionaries are copied before iterating.
+        for name, procedure in list(other.procedures.items()):
+            self.get_procedure(name).merge(procedure)
+        self.transactions.merge(other.transactions)
+        self.conflicts.merge(other.conflicts)
+
+
+class _Call:
+    def __init__(self, name):
+        self.name = name
+        self.attempts = 0
+        self.lock_seconds = 0.0
+        self.retry_causes = []
+        self.keys = set()
+        self.conflict_keys = set()
+
+
+class ContentionStats:
+    """Collect statistics about the transactions of the atomic procedures.
+
+    The statistics are collected separately by each thread, without
+    locking, and are merged when read. Besides the per-procedure
+    statistics (see `ProcedureStats`), the accounts touched by the
+    transactions (see `note_accounts`) are counted, so that the
+    hottest accounts can be reported (see `get_hot_accounts`).
+
+    """
+
+    def __init__(self, hot_keys_size):
+        self.hot_keys_size = hot_keys_size
+        self._aggregator = ThreadLocalAggregator(lambda: _ThreadStats(hot_keys_size))
+
+    @contextmanager
+    def track(self, name):
+        """Track the transaction attempts of a call to the atomic procedure `name`."""
+
+        call = _local.call = _Call(name)
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            _local.call = None
+            self.record(
+                name,
+                call.attempts,
+                call.retry_causes,
+                failed=failed,
+                lock_seconds=call.lock_seconds,
+                keys=call.keys,
+                conflict_keys=call.conflict_keys,
+            )
+
+    def record(self, name, attempts, retry_causes, failed=False, lock_seconds=0.0, keys=(), conflict_keys=()):
+        """Record a call to the atomic procedure `name`.
+
+        `keys` are the accounts touched by the last attempt, and
+        `conflict_keys` are the accounts touched by the failed attempts.
+
+        """
+
+        stats = self._aggregator.get()
+        procedure = stats.get_procedure(name)
+        procedure.calls += 1
+        procedure.failures += failed
+        procedure.attempts.observe(attempts)
+        procedure.lock_seconds.observe(lock_seconds)
+        procedure.retry_causes.update(retry_causes)
+        if not failed:
+            stats.transactions.update(keys)
+        stats.conflicts.update(conflict_keys)
+
+    def get_procedures(self):
+        """Return a dictionary that maps procedure names to `ProcedureStats`."""
+
+        return self._aggregator.merge().procedures
+
+    def get_hot_accounts(self, n=20):
+        """Return a list of `(account_pk, conflicts, transactions)` tuples for the most contended accounts.
+
+        The accounts are ordered by the number of failed transaction
+        attempts that touched them, then by the number of committed
+        transactions that touched them.
+
+        """
+
+        merged = self._aggregator.merge()
+        conflicts, transactions = merged.conflicts.counts, merged.transactions.counts
+        keys = conflicts.keys() | transactions.keys()
+        keys = sorted(keys, key=lambda k: (conflicts[k], transactions[k]), reverse=True)
+        return [(key, conflicts[key], transactions[key]) for key in keys[:n]]
+
+    def format_report(self, n=20):
+        """Return a human-readable report of the procedure statistics and the hottest accounts."""
+
+        lines = ['procedure calls failures retries lock_seconds retry_causes']
+        for name, p in sorted(self.get_procedures().items(), key=lambda item: item[1].retries, reverse=True):
+            causes = ','.join(f'{cause}={count}' for cause, count in p.retry_causes.most_common())
+            lines.append(f'{name} {p.calls} {p.failures} {p.retries} {p.lock_seconds.sum:.3f} {causes or "-"}')
+        lines.append('')
+        lines.append('debtor_id creditor_id conflicts transactions')
+        for (debtor_id, creditor_id), conflicts, transactions in self.get_hot_accounts(n):
+            lines.append(f'{debtor_id} {creditor_id} {conflicts} {transactions}')
+        return '\n'.join(lines)
+
+
+def get_retry_cause(error):
+    """Return the name of the cause of a retryable transaction error, or `None`."""
+
+    if isinstance(error, DBSerializationError):
+        return 'integrity_error' if isinstance(error.__context__, IntegrityError) else 'serialization_error'
+    if isinstance(error, DBAPIError):
+        return RETRY_CAUSES.get(get_db_error_code(error.orig))
+
+    # asyncpg errors have a `sqlstate` attribute.
+    return RETRY_CAUSES.get(getattr(error, 'sqlstate', None))
+
+
+def is_tracking():
+    """Return whether a call to an atomic procedure is being tracked in the current thread."""
+
+    return getattr(_local, 'call', None) is not None
+
+
+@contextmanager
+def attempt():
+    """Track a transaction attempt of the current call (see `ContentionStats.track`)."""
+
+    call = getattr(_local, 'call', None)
+    if call is None:
+        yield
+        return
+    call.attempts += 1
+    call.keys = set()
+    try:
+        yield
+    except Exception as e:
+        cause = get_retry_cause(e)
+        if cause is not None:
+            call.retry_causes.append(cause)
+            call.conflict_keys.update(call.keys)
+        raise
+
+
+def note_accounts(pks):
+    """Record that the current transaction attempt locks or modifies the accounts."""
+
+    call = getattr(_local, 'call', None)
+    if call is not None:
+        call.keys.update(pks)
+
+
+@functools.lru_cache(maxsize=1024)
+def _is_locking_statement(statement):
+    return LOCKING_STATEMENT.search(statement) is not None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    call = getattr(_local, 'call', None)
+    _local.lock_started_at = time.perf_counter() if call is not None and _is_locking_statement(statement) else None
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(_local, 'lock_started_at', None)
+    call = getattr(_local, 'call', None)
+    if started_at is not None and call is not None:
+        call.lock_seconds += time.perf_counter() - started_at
+        _local.lock_started_at = None
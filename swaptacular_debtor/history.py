@@ -0,0 +1,66 @@
+from sqlalchemy.sql.expression import tuple_
+from .models import db, Branch, Withdrawal, WithdrawalRequest
+from .sharding import debtor_shard
+
+HISTORY_PAGE_SIZE = 5000
+HISTORY_YIELD_PER = 100
+
+
+def iter_withdrawals(branch, start_ts=None, end_ts=None, page_size=HISTORY_PAGE_SIZE, session=None):
+    """Yield branch's withdrawals, ordered by `closing_ts`.
+
+    Only withdrawals closed in the interval `[start_ts, end_ts)` are
+    yielded. By default, the queries are sent to a replica (see
+    `db.replica_session`). Each page of `page_size` withdrawals is
+    read in a separate transaction.
+
+    """
+
+    yield from _iter_branch_history(Withdrawal, Withdrawal.closing_ts, branch, start_ts, end_ts, page_size, session)
+
+
+def iter_withdrawal_requests(branch, start_ts=None, end_ts=None, page_size=HISTORY_PAGE_SIZE, session=None):
+    """Yield branch's withdrawal requests, ordered by `opening_ts`.
+
+    The arguments are the same as for `iter_withdrawals`.
+
+    """
+
+    yield from _iter_branch_history(
+        WithdrawalRequest, WithdrawalRequest.opening_ts, branch, start_ts, end_ts, page_size, session)
+
+
+def _iter_branch_history(model, ts_column, branch, start_ts, end_ts, page_size, session):
+    # The rows are walked with keyset pagination over the
+    # `(debtor_id, operator_branch_id, <ts_column>, creditor_id,
+    # withdrawal_request_seqnum)` index. The primary key columns make
+    # the ordering unique, and because the index covers the whole
+    # keyset, each page is read in index order, without sorting.
+    session = session or db.replica_session
+    debtor_id, branch_id = Branch.get_pk_values(branch)
+    keyset = (ts_column, model.creditor_id, model.withdrawal_request_seqnum)
+    query = session.query(model).filter(model.debtor_id == debtor_id, model.operator_branch_id == branch_id)
+    if start_ts is not None:
+        query = query.filter(ts_column >= start_ts)
+    if end_ts is not None:
+        query = query.filter(ts_column < end_ts)
+    last_key = None
+    while True:
+        page = query
+        if last_key is not None:
+            page = page.filter(ts_column >= last_key[0], tuple_(*keyset) > tuple_(*last_key))
+        page = page.order_by(*keyset).limit(page_size).yield_per(HISTORY_YIELD_PER)
+        count = 0
+        with debtor_shard(debtor_id):
+            # The query gets executed, and a connection to the right
+            # shard gets assigned right away.
+            rows = iter(page)
+        try:
+            for row in rows:
+                count += 1
+                last_key = (getattr(row, ts_column.key), row.creditor_id, row.withdrawal_request_seqnum)
+                yield row
+        finally:
+            session.rollback()
+        if count < page_size:
+            break
@@ -0,0 +1,85 @@
+import os
+import struct
+import threading
+from werkzeug.utils import import_string
+
+ID_BITS = 63
+ID_MASK = (1 << ID_BITS) - 1
+BLOCK_BITS = 16
+BLOCK_SIZE = 1 << BLOCK_BITS
+MAX_BLOCK = (1 << (ID_BITS - BLOCK_BITS)) - 1
+
+
+def scramble_id(n):
+    """Map a 63-bit integer to another 63-bit integer.
+
+    The mapping is a bijection (a variant of the "splitmix64"
+    finalizer), so that different numbers always give different
+    results, and zero is mapped to zero. Consecutive numbers are
+    mapped to well spread results, which is important for sharding.
+
+    """
+
+    assert 0 <= n <= ID_MASK
+    n ^= n >> 30
+    n = (n * 0x3f58476d1ce4e5b9) & ID_MASK
+    n ^= n >> 27
+    n = (n * 0x14d049bb133111eb) & ID_MASK
+    n ^= n >> 31
+    return n
+
+
+class RandomIdAllocator:
+    """Generate random IDs. Collisions are possible, although very unlikely."""
+
+    def __init__(self, reserve_block):
+        pass
+
+    def allocate(self):
+        return struct.unpack('>q', os.urandom(8))[0] % (1 << ID_BITS) or 1
+
+
+class BlockIdAllocator:
+    """Generate unique IDs from reserved blocks of IDs.
+
+    `reserve_block` should return a new block number, between 1 and
+    `MAX_BLOCK`, each time it is called (a database sequence, for
+    example). The block number and a counter within the block are
+    scrambled together, so that the generated IDs are unique and well
+    spread. The allocator is thread-safe, and reserves a new block
+    after a fork.
+
+    """
+
+    def __init__(self, reserve_block):
+        self._reserve_block = reserve_block
+        self._lock = threading.Lock()
+        self._pid = None
+        self._block = None
+        self._counter = BLOCK_SIZE
+
+    def allocate(self):
+        with self._lock:
+            pid = os.getpid()
+            if self._counter >= BLOCK_SIZE or self._pid != pid:
+                block = self._reserve_block()
+                assert 0 < block <= MAX_BLOCK
+                self._pid = pid
+                self._block = block
+                self._counter = 0
+            n = (self._block << BLOCK_BITS) | self._counter
+            self._counter += 1
+        return scramble_id(n)
+
+
+ID_ALLOCATORS = {
+    'random': RandomIdAllocator,
+    'block': BlockIdAllocator,
+}
+
+
+def create_id_allocator(name, reserve_block):
+    """Create an ID allocator by name, or by an import path ("module:Class")."""
+
+    allocator_class = ID_ALLOCATORS.get(name) or import_string(name)
+    return allocator_class(reserve_block)
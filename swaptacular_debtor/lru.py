@@ -0,0 +1,63 @@
+import time
+import threading
+from collections import OrderedDict
+
+VERSION_SLOTS = 4096
+
+
+class LruCache:
+    """A thread-safe LRU cache, whose entries expire after `ttl` seconds.
+
+    At most `size` entries are kept. `None` can not be cached.
+
+    To avoid caching a value that has been read before a concurrent
+    invalidation, callers should obtain the key's version (see
+    `get_version`) before reading the value, and pass it to `set`.
+
+    """
+
+    def __init__(self, size, ttl):
+        assert size > 0
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        # Each key maps to a version slot, which gets incremented when
+        # the key is invalidated. Keys that map to the same slot share
+        # the version, which is harmless.
+        self._versions = [0] * VERSION_SLOTS
+
+    def get(self, key):
+        """Return the cached value, or `None` if it is not cached."""
+
+        now = time.monotonic()
+        with self._lock:
+            expires_at, value = self._entries.get(key, (now, None))
+            if expires_at <= now:
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def get_version(self, key):
+        """Return a value that changes when the key gets invalidated."""
+
+        return self._versions[hash(key) % VERSION_SLOTS]
+
+    def set(self, key, value, version=None):
+        """Cache a value, unless the key has been invalidated since `version` was obtained."""
+
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            if version is not None and self._versions[hash(key) % VERSION_SLOTS] != version:
+                return
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._versions[hash(key) % VERSION_SLOTS] += 1
@@ -0,0 +1,194 @@
+import math
+import time
+import logging
+import functools
+from flask import Blueprint, Response, current_app
+from sqlalchemy.pool import QueuePool
+from .models import db, TransactionSignal, WithdrawalSignal, get_now_utc
+from .sharding import get_shard_keys, use_shard
+from .stats import Histogram, HistogramSet, ThreadLocalAggregator
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SIGNAL_MODELS = [TransactionSignal, WithdrawalSignal]
+SIGNAL_COUNT_LIMIT = 10000
+SIGNAL_METRICS_TTL_SECONDS = 5.0
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+def timed(func):
+    """Decorate a function so that its latency gets recorded in the application's `Metrics`."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics = current_app.extensions.get('metrics')
+            if metrics is not None:
+                metrics.latencies.get().observe(func.__name__, time.perf_counter() - started_at)
+
+    return wrapper
+
+
+class TimedQueuePool(QueuePool):
+    """A `QueuePool` that records how long the connection checkouts take.
+
+    The time includes the waiting for a connection to be returned to
+    the pool, when all connections are in use.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_seconds = ThreadLocalAggregator(Histogram)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.checkout_seconds = self.checkout_seconds
+        return pool
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.checkout_seconds.get().observe(time.perf_counter() - started_at)
+
+
+# SQLAlchemy names the pool loggers after the pool classes, and
+# silences the loggers in the "sqlalchemy" namespace by default. The
+# same is done here.
+logging.getLogger(f'{TimedQueuePool.__module__}.{TimedQueuePool.__name__}').setLevel(logging.WARNING)
+
+
+class Metrics:
+    """Collect the application's metrics, and render them in the Prometheus text format.
+
+    The procedure latencies are collected separately by each thread
+    (see `stats.ThreadLocalAggregator`), and are merged only when the
+    metrics are rendered. Note that each process reports its own
+    metrics.
+
+    The signal tables are queried at most once every
+    `signal_metrics_ttl` seconds, and the signals are counted only up
+    to SIGNAL_COUNT_LIMIT per shard.
+
+    """
+
+    def __init__(self, signal_metrics_ttl=SIGNAL_METRICS_TTL_SECONDS):
+        self.latencies = ThreadLocalAggregator(HistogramSet)
+        self.signal_metrics_ttl = signal_metrics_ttl
+        self._signal_rows = (-math.inf, None)
+
+    def render(self, app):
+        lines = []
+        _add_help(lines, 'debtor_procedure_seconds', 'histogram', 'Latency of the procedures.')
+        for name, histogram in sorted(self.latencies.merge().histograms.items()):
+            _add_histogram(lines, 'debtor_procedure_seconds', {'procedure': name}, histogram)
+        self._add_contention_metrics(lines, app.extensions.get('contention_stats'))
+        self._add_pool_metrics(lines, app)
+        self._add_signal_metrics(lines)
+        return ''.join(f'{line}\n' for line in lines)
+
+    def _add_contention_metrics(self, lines, stats):
+        if stats is None:
+            return
+        procedures = sorted(stats.get_procedures().items())
+        _add_help(lines, 'debtor_transaction_attempts', 'histogram', 'Transaction attempts per call.')
+        for name, p in procedures:
+            _add_histogram(lines, 'debtor_transaction_attempts', {'procedure': name}, p.attempts)
+        _add_help(lines, 'debtor_transaction_lock_seconds', 'histogram',
+                  'Time per atomic procedure call spent in row-locking statements.')
+        for name, p in procedures:
+            _add_histogram(lines, 'debtor_transaction_lock_seconds', {'procedure': name}, p.lock_seconds)
+        _add_help(lines, 'debtor_transaction_retries_total', 'counter', 'Failed transaction attempts, by cause.')
+        for name, p in procedures:
+            for cause, count in sorted(p.retry_causes.items()):
+                _add_sample(lines, 'debtor_transaction_retries_total', {'procedure': name, 'cause': cause}, count)
+
+    def _add_pool_metrics(self, lines, app):
+        bind_keys = [None, *(app.config['SQLALCHEMY_BINDS'] or {})]
+        pools = [(bind_key or 'default', db.get_engine(app, bind=bind_key).pool) for bind_key in bind_keys]
+        _add_help(lines, 'debtor_db_pool_connections_in_use', 'gauge', 'Connections checked out from the pool.')
+        for bind, pool in pools:
+            if isinstance(pool, QueuePool):
+                _add_sample(lines, 'debtor_db_pool_connections_in_use', {'bind': bind}, pool.checkedout())
+        _add_help(lines, 'debtor_db_pool_checkout_seconds', 'histogram', 'Time to check out a database connection.')
+        for bind, pool in pools:
+            if isinstance(pool, TimedQueuePool):
+                histogram = pool.checkout_seconds.merge()
+                _add_histogram(lines, 'debtor_db_pool_checkout_seconds', {'bind': bind}, histogram)
+
+    def _add_signal_metrics(self, lines):
+        now = get_now_utc()
+        rows = self._get_signal_rows()
+        _add_help(lines, 'debtor_signal_rows', 'gauge', 'Signals waiting to be sent.')
+        for table, count, _ in rows:
+            _add_sample(lines, 'debtor_signal_rows', {'table': table}, count)
+        _add_help(lines, 'debtor_signal_oldest_age_seconds', 'gauge', 'Age of the oldest signal.')
+        for table, _, oldest_ts in rows:
+            oldest_age = 0.0 if oldest_ts is None else max(0.0, (now - oldest_ts).total_seconds())
+            _add_sample(lines, 'debtor_signal_oldest_age_seconds', {'table': table}, oldest_age)
+
+    def _get_signal_rows(self):
+        # Concurrent scrapes may query the tables more than once, which
+        # is harmless.
+        expires_at, rows = self._signal_rows
+        if expires_at <= time.monotonic():
+            rows = [(model.__tablename__, *_get_signal_stats(model)) for model in SIGNAL_MODELS]
+            self._signal_rows = (time.monotonic() + self.signal_metrics_ttl, rows)
+        return rows
+
+
+def _get_signal_stats(model):
+    # The signal tables are not scanned when they are large: at most
+    # SIGNAL_COUNT_LIMIT rows are counted, and the oldest signal is
+    # found with the `inserted_at_ts` index.
+    count, oldest_ts = 0, None
+    for bind_key in get_shard_keys():
+        with use_shard(bind_key):
+            signals = db.session.query(model.inserted_at_ts)
+            bounded_signals = signals.limit(SIGNAL_COUNT_LIMIT).subquery()
+            count += db.session.query(db.func.count()).select_from(bounded_signals).scalar()
+            shard_oldest_ts = signals.order_by(model.inserted_at_ts).limit(1).scalar()
+            db.session.rollback()
+        if shard_oldest_ts is not None and (oldest_ts is None or shard_oldest_ts < oldest_ts):
+            oldest_ts = shard_oldest_ts
+    return count, oldest_ts
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+
+def _add_help(lines, name, metric_type, help_text):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {metric_type}')
+
+
+def _add_sample(lines, name, labels, value):
+    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+
+def _add_histogram(lines, name, labels, histogram):
+    cumulative_count = 0
+    for bound, count in zip(histogram.bounds + (math.inf,), histogram.counts):
+        cumulative_count += count
+        _add_sample(lines, f'{name}_bucket', {**labels, 'le': _format_value(float(bound))}, cumulative_count)
+    _add_sample(lines, f'{name}_sum', labels, float(histogram.sum))
+    _add_sample(lines, f'{name}_count', labels, cumulative_count)
+
+
+@metrics_blueprint.route('/metrics')
+def metrics():
+    return Response(current_app.extensions['metrics'].render(current_app), content_type=CONTENT_TYPE)
@@ -1,19 +1,21 @@
-import os
-import struct
 import datetime
 import math
 import warnings
+import functools
 import dramatiq
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.dialects import postgresql as pg
 from sqlalchemy.sql.expression import and_, or_, null
 from sqlalchemy.exc import SAWarning
+from sqlalchemy import orm, event, DDL
 from flask import current_app
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 from flask_migrate import Migrate
 from flask_signalbus import SignalBusMixin
 from flask_signalbus.atomic import AtomicProceduresMixin
-from . import tasks
+from . import tasks, contention
+from .serializers import compile_dump_function
+from .sharding import get_current_shard, get_clause_debtor_ids, ShardNotSelectedError
 
 warnings.filterwarnings(
     'ignore',
@@ -22,14 +24,171 @@ warnings.filterwarnings(
 )
 
 
+class ShardedSession(SignallingSession):
+    """Send the database operations to the selected shard (see `sharding.use_shard`).
+
+    When sharding is configured, but no shard is selected, the shard
+    is determined from the debtor IDs in the statement's criteria (see
+    `sharding.get_clause_debtor_ids`). If that is not possible (when
+    flushing objects, for example), `ShardNotSelectedError` is raised,
+    instead of silently using the default database.
+
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        bind_key = get_current_shard()
+        if bind_key is None:
+            router = self.app.extensions['shard_router']
+            if router is None:
+                return super().get_bind(mapper, clause)
+            debtor_ids = set() if clause is None else get_clause_debtor_ids(clause)
+            bind_keys = {router.get_shard(debtor_id) for debtor_id in debtor_ids}
+            if len(bind_keys) != 1:
+                raise ShardNotSelectedError()
+            bind_key = bind_keys.pop()
+        return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+
+
+class ReplicaSession(ShardedSession):
+    """Send the read-only database operations to a replica, if possible.
+
+    A replica is selected at the beginning of each transaction (see
+    `replicas.ReplicaSelector`). If there are no fresh enough
+    replicas, the primary database is used, but in a read-only
+    transaction. Replicas are not used when a shard is selected.
+
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        selector = current_app.extensions['replica_selector']
+        if selector is None or get_current_shard() is not None:
+            return super().get_bind(mapper, clause)
+        if REPLICA_BIND_KEY not in self.info:
+            self.info[REPLICA_BIND_KEY] = selector.select()
+        bind_key = self.info[REPLICA_BIND_KEY]
+        if bind_key is None:
+            return super().get_bind(mapper, clause)
+        return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+
+
+@event.listens_for(ReplicaSession, 'after_begin')
+def _set_read_only(session, transaction, connection):
+    if session.info.get(REPLICA_BIND_KEY) is None:
+        connection.execute('SET TRANSACTION READ ONLY')
+
+
+@event.listens_for(ReplicaSession, 'after_transaction_end')
+def _forget_replica(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(REPLICA_BIND_KEY, None)
+
+
+def invalidate_cached(session, cache_name, keys):
+    """Remove the keys from an application cache when the session's transaction ends.
+
+    The cache is looked up in the application's extensions by
+    `cache_name`. The keys are removed on rollback too, because
+    uncommitted data may have been cached during the transaction.
+
+    """
+
+    session.info.setdefault(CACHE_INVALIDATIONS, {}).setdefault(cache_name, set()).update(keys)
+
+
+def invalidate_cached_accounts(session, pks):
+    invalidate_cached(session, 'account_cache', pks)
+
+
+@event.listens_for(ShardedSession, 'after_flush')
+def _invalidate_flushed_instances(session, flush_context):
+    # The accounts changed via the ORM, and the accounts mentioned in
+    # newly emitted transaction signals, are invalidated. Note that
+    # `session.new`, `session.dirty`, and `session.deleted` are still
+    # in their pre-flush state here.
+    account_pks = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, Account):
+            account_pks.add((instance.debtor_id, instance.creditor_id))
+        elif isinstance(instance, TransactionSignal):
+            account_pks.add((instance.debtor_id, instance.sender_creditor_id))
+            account_pks.add((instance.debtor_id, instance.recipient_creditor_id))
+    if account_pks:
+        invalidate_cached_accounts(session, account_pks)
+
+
+@event.listens_for(ShardedSession, 'after_commit')
+@event.listens_for(ShardedSession, 'after_rollback')
+def _apply_cache_invalidations(session):
+    for cache_name, keys in session.info.pop(CACHE_INVALIDATIONS, {}).items():
+        cache = session.app.extensions.get(cache_name)
+        if cache is not None:
+            for key in keys:
+                cache.invalidate(key)
+
+
 class CustomAlchemy(AtomicProceduresMixin, SignalBusMixin, SQLAlchemy):
-    pass
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replica_session = self.create_scoped_session({'class_': ReplicaSession})
+
+    def init_app(self, app, *args, **kwargs):
+        super().init_app(app, *args, **kwargs)
+
+        @app.teardown_appcontext
+        def shutdown_replica_session(response_or_exc):
+            self.replica_session.remove()
+            return response_or_exc
+
+    def create_session(self, options):
+        options.setdefault('class_', ShardedSession)
+        return orm.sessionmaker(db=self, **options)
+
+    def atomic(self, func):
+        """Like `AtomicProceduresMixin.atomic`, but also collect statistics about the transactions.
+
+        The statistics are collected by the application's
+        `contention.ContentionStats` instance, if there is one.
+
+        """
+
+        name = f'{func.__module__}.{func.__qualname__}'
+        session = self.session
+
+        @functools.wraps(func)
+        def attempt(*args, **kwargs):
+            # The session is flushed here, so that the errors
+            # occurring on flush are attributed to the attempt.
+            with contention.attempt():
+                result = func(*args, **kwargs)
+                session.flush()
+                return result
+
+        atomic_func = super().atomic(attempt)
+        untracked_atomic_func = super().atomic(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if contention.is_tracking():
+                # This is a nested atomic block.
+                return func(*args, **kwargs)
+            stats = current_app.extensions.get('contention_stats')
+            if stats is None:
+                return untracked_atomic_func(*args, **kwargs)
+            with stats.track(name):
+                return atomic_func(*args, **kwargs)
+
+        return wrapper
 
 
 db = CustomAlchemy()
 migrate = Migrate()
 
 
+SIGNALBUS_NOTIFY_CHANNEL = 'signalbus'
+DEBTOR_ID_BLOCK_SEQUENCE = 'debtor_id_block_seq'
+DEBTOR_ID_PARTITION_COUNT = 8
+REPLICA_BIND_KEY = 'replica_bind_key'
+CACHE_INVALIDATIONS = 'cache_invalidations'
 BEGINNING_OF_TIME = datetime.datetime(datetime.MINYEAR, 1, 1, tzinfo=datetime.timezone.utc)
 
 
@@ -37,6 +196,14 @@ def get_now_utc():
     return datetime.datetime.now(tz=datetime.timezone.utc)
 
 
+def reserve_debtor_id_block():
+    # The sequence is always in the default database, because the
+    # debtor IDs must be unique across all shards. Note that
+    # sequences are not transactional.
+    with db.engine.connect() as connection:
+        return connection.execute(db.select([db.func.nextval(DEBTOR_ID_BLOCK_SEQUENCE)])).scalar()
+
+
 class Debtor(db.Model):
     debtor_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
     demurrage_rate = db.Column(db.REAL, nullable=False, default=0.0)
@@ -49,9 +216,8 @@ class Debtor(db.Model):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if 'debtor_id' not in kwargs:
-            modulo = 1 << 63
-            self.debtor_id = struct.unpack('>q', os.urandom(8))[0] % modulo or 1
-            assert 0 < self.debtor_id < modulo
+            self.debtor_id = current_app.extensions['debtor_id_allocator'].allocate()
+            assert 0 < self.debtor_id < (1 << 63)
 
 
 class DebtorModel(db.Model):
@@ -66,32 +232,65 @@ class DebtorModel(db.Model):
         )
 
 
+@functools.lru_cache(maxsize=None)
+def _get_signalbus_routing(model, event_exchange_name):
+    if model.queue_name is None:
+        assert not hasattr(model, 'actor_name'), \
+            'SignalModel.queue_name is not set, but SignalModel.actor_model is set'
+        exchange_name = event_exchange_name
+        actor_prefix = f'on_{exchange_name}_' if exchange_name else 'on_'
+        actor_name = actor_prefix + model.__tablename__
+    else:
+        exchange_name = ''
+        actor_name = model.actor_name
+    return exchange_name, actor_name
+
+
 class SignalModel(db.Model):
     __abstract__ = True
 
     queue_name = None
-
-    def send_signalbus_message(self):
+    signalbus_burst_count = 1000
+
+    @classmethod
+    def _get_signalbus_routing(cls):
+        return _get_signalbus_routing(cls, current_app.config['RABBITMQ_EVENT_EXCHANGE'])
+
+    @classmethod
+    def _get_signalbus_dump(cls):
+        # The dump function is compiled once per model class, and
+        # produces exactly the same output as the marshmallow schema.
+        dump = cls.__dict__.get('_signalbus_dump')
+        if dump is None:
+            dump = cls._signalbus_dump = compile_dump_function(cls.__marshmallow_schema__)
+        return dump
+
+    def _create_signalbus_message(self, actor_name):
         model = type(self)
-        if model.queue_name is None:
-            assert not hasattr(model, 'actor_name'), \
-                'SignalModel.queue_name is not set, but SignalModel.actor_model is set'
-            exchange_name = current_app.config['RABBITMQ_EVENT_EXCHANGE']
-            actor_prefix = f'on_{exchange_name}_' if exchange_name else 'on_'
-            actor_name = actor_prefix + model.__tablename__
-        else:
-            exchange_name = ''
-            actor_name = model.actor_name
-        data = model.__marshmallow_schema__.dump(self)
-        message = dramatiq.Message(
-            queue_name=model.queue_name,
+        queue_name = model.queue_name
+        if queue_name is not None:
+            # All messages for a given debtor go to the same
+            # sub-queue (see `tasks.get_debtor_queue_name`).
+            queue_name = tasks.get_debtor_queue_name(queue_name, self.debtor_id)
+        return dramatiq.Message(
+            queue_name=queue_name,
             actor_name=actor_name,
             args=(),
-            kwargs=data,
+            kwargs=model._get_signalbus_dump()(self),
             options={},
         )
+
+    def send_signalbus_message(self):
+        exchange_name, actor_name = self._get_signalbus_routing()
+        message = self._create_signalbus_message(actor_name)
         tasks.broker.publish_message(message, exchange=exchange_name)
 
+    @classmethod
+    def send_signalbus_messages(cls, instances):
+        exchange_name, actor_name = cls._get_signalbus_routing()
+        messages = [instance._create_signalbus_message(actor_name) for instance in instances]
+        tasks.publish_messages(messages, exchange=exchange_name)
+
 
 class Account(DebtorModel):
     debtor_id = db.Column(db.BigInteger, db.ForeignKey('debtor.debtor_id'), primary_key=True)
@@ -119,12 +318,47 @@ class Account(DebtorModel):
         comment='The total owed amount, minus demurrage, minus pending transfer locks',
     )
     last_transfer_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=BEGINNING_OF_TIME)
+    demurrage_ts = db.Column(
+        db.TIMESTAMP(timezone=True),
+        nullable=False,
+        default=get_now_utc,
+        comment='The moment up to which the demurrage has been accrued',
+    )
     __table_args__ = (
         db.CheckConstraint(demurrage >= 0),
         db.CheckConstraint(discount_demurrage_rate >= 0),
     )
 
 
+class AccountSlot(db.Model):
+    debtor_id = db.Column(db.BigInteger, primary_key=True)
+    creditor_id = db.Column(db.BigInteger, primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    balance = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+        comment='An amount that should be added to `account.balance`',
+    )
+    avl_balance = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+        comment='An amount that should be added to `account.avl_balance`',
+    )
+    last_transfer_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=BEGINNING_OF_TIME)
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ['debtor_id', 'creditor_id'],
+            ['account.debtor_id', 'account.creditor_id'],
+        ),
+        {
+            'comment': 'Splits the writes to a heavily used account across several rows. '
+                       'Periodically, the slots are folded back into the account.',
+        },
+    )
+
+
 class PreparedTransfer(DebtorModel):
     TYPE_CIRCULAR = 1
     TYPE_DIRECT = 2
@@ -167,6 +401,12 @@ class PreparedTransfer(DebtorModel):
             debtor_id,
             sender_creditor_id,
         ),
+        db.Index(
+            'idx_prepared_transfer_coordinator_id',
+            debtor_id,
+            coordinator_id,
+        ),
+        db.Index('idx_prepared_transfer_prepared_at_ts', prepared_at_ts),
         db.CheckConstraint(amount >= 0),
         db.CheckConstraint(sender_locked_amount >= 0),
         db.CheckConstraint(third_party_amount >= 0),
@@ -196,6 +436,10 @@ class TransactionSignal(SignalModel):
     sender_creditor_id = db.Column(db.BigInteger, nullable=False)
     recipient_creditor_id = db.Column(db.BigInteger, nullable=False)
     amount = db.Column(db.BigInteger, nullable=False)
+    inserted_at_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc)
+    __table_args__ = (
+        db.Index('idx_transaction_signal_inserted_at_ts', inserted_at_ts),
+    )
 
 
 class Coordinator(DebtorModel):
@@ -275,7 +519,11 @@ class WithdrawalRequest(WithdrawalDataMixin, DebtorModel):
     @declared_attr
     def __table_args__(cls):
         return super().__table_args__ + (
-            db.Index('idx_withdrawal_request_opening_ts', 'debtor_id', 'operator_branch_id', 'opening_ts'),
+            db.Index(
+                'idx_withdrawal_request_opening_ts',
+                'debtor_id', 'operator_branch_id', 'opening_ts', 'creditor_id', 'withdrawal_request_seqnum',
+            ),
+            db.Index('idx_withdrawal_request_deadline_ts', 'deadline_ts'),
         )
 
 
@@ -287,7 +535,10 @@ class Withdrawal(WithdrawalDataMixin, DebtorModel):
     @declared_attr
     def __table_args__(cls):
         return super().__table_args__ + (
-            db.Index('idx_withdrawal_closing_ts', 'debtor_id', 'operator_branch_id', 'closing_ts'),
+            db.Index(
+                'idx_withdrawal_closing_ts',
+                'debtor_id', 'operator_branch_id', 'closing_ts', 'creditor_id', 'withdrawal_request_seqnum',
+            ),
         )
 
 
@@ -295,7 +546,9 @@ class WithdrawalSignal(SignalModel):
     debtor_id = db.Column(db.BigInteger, primary_key=True)
     creditor_id = db.Column(db.BigInteger, primary_key=True)
     withdrawal_request_seqnum = db.Column(db.BigInteger, primary_key=True)
+    inserted_at_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc)
     __table_args__ = (
+        db.Index('idx_withdrawal_signal_inserted_at_ts', inserted_at_ts),
         db.ForeignKeyConstraint(
             [
                 'debtor_id',
@@ -312,3 +565,21 @@ class WithdrawalSignal(SignalModel):
     )
 
     withdrawal = db.relationship('Withdrawal')
+
+
+def _partition_by_debtor_id(model):
+    # The partitions are not present in the metadata, and are created
+    # only by `create_all()`. In production, they are created by the
+    # migrations (see migration `9b3e5f0a7c21`).
+    table = model.__table__
+    table.dialect_kwargs['postgresql_partition_by'] = 'HASH (debtor_id)'
+    for remainder in range(DEBTOR_ID_PARTITION_COUNT):
+        event.listen(table, 'after_create', DDL(
+            f'CREATE TABLE {table.name}_p{remainder} PARTITION OF {table.name} '
+            f'FOR VALUES WITH (MODULUS {DEBTOR_ID_PARTITION_COUNT}, REMAINDER {remainder})'
+        ))
+
+
+for model in [Account, AccountSlot, PreparedTransfer, WithdrawalRequest, Withdrawal,
+              WithdrawalSignal, TransactionSignal]:
+    _partition_by_debtor_id(model)
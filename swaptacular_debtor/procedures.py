@@ -1,11 +1,37 @@
-from .models import db, Debtor, Account, Coordinator, Branch, Operator, PreparedTransfer, \
-    WithdrawalRequest, Withdrawal, WithdrawalSignal, get_now_utc
+import random
+import functools
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy.sql.expression import tuple_, and_, extract, bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.dialects import postgresql as pg
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+from flask_signalbus.utils import DBSerializationError
+from .sharding import sharded, debtor_shard, get_debtor_id
+from .models import db, Debtor, Account, AccountSlot, Coordinator, Branch, Operator, PreparedTransfer, \
+    WithdrawalRequest, get_now_utc, invalidate_cached_accounts
+from .account_cache import AccountState
+from .contention import note_accounts
+from .metrics import timed
 
 ROOT_CREDITOR_ID = -1
 DEFAULT_COORINATOR_ID = 1
 DEFAULT_BRANCH_ID = 1
+DEMURRAGE_CHUNK_SIZE = 5000
+REAPER_BATCH_SIZE = 1000
+STATEMENT_CACHE_SIZE = 128
+SECONDS_IN_YEAR = 365.25 * 24 * 60 * 60
+
+BranchInfo = namedtuple('BranchInfo', 'info')
+OperatorInfo = namedtuple('OperatorInfo', 'alias profile can_withdraw can_audit')
+
+# `branches` maps branch IDs to `BranchInfo` tuples, `operators`
+# maps `(branch_id, user_id)` tuples to `OperatorInfo` tuples.
+DebtorOperators = namedtuple('DebtorOperators', 'branches operators')
 
 execute_atomic = db.execute_atomic
+bakery = baked.bakery()
 
 
 class InsufficientFunds(Exception):
@@ -20,8 +46,26 @@ class InvalidPreparedTransfer(Exception):
     """The specified prepared transfer does not exist."""
 
 
-@db.atomic
+class InvalidOperator(Exception):
+    """The specified operator does not exist."""
+
+
+class PermissionDenied(Exception):
+    """The operator does not have the required permission."""
+
+
+@timed
 def create_debtor(**kw):
+    # The debtor ID is allocated in advance, because it determines
+    # the shard in which the debtor will be created.
+    if 'debtor_id' not in kw:
+        kw['debtor_id'] = current_app.extensions['debtor_id_allocator'].allocate()
+    with debtor_shard(kw['debtor_id']):
+        return _create_debtor(**kw)
+
+
+@db.atomic
+def _create_debtor(**kw):
     admin_user_id = kw.pop('user_id')
     debtor = Debtor(**kw)
     account = Account(
@@ -50,18 +94,63 @@ def create_debtor(**kw):
     return debtor
 
 
+def _get_accounts(pks):
+    """Return a dictionary of `Account` instances, creating the missing accounts.
+
+    The accounts that are not present in the session are inserted
+    and/or loaded with a single "INSERT ... ON CONFLICT DO NOTHING"
+    statement, combined with a SELECT of the already existing rows.
+
+    """
+
+    note_accounts(pks)
+    accounts = {}
+    for pk in set(pks):
+        instance = db.session.identity_map.get(identity_key(Account, pk))
+        if instance is not None:
+            accounts[pk] = instance
+    missing_pks = sorted(set(pks) - accounts.keys())
+    if missing_pks:
+        # We must make sure that pending accounts are written to the
+        # database before we try to insert them.
+        db.session.flush()
+        params = {}
+        for i, (debtor_id, creditor_id) in enumerate(missing_pks):
+            params[f'debtor_id_{i}'] = debtor_id
+            params[f'creditor_id_{i}'] = creditor_id
+        stmt = _get_accounts_upsert(len(missing_pks))
+        for instance in Account.query.instances(db.session.execute(stmt, params)):
+            accounts[(instance.debtor_id, instance.creditor_id)] = instance
+        if not accounts.keys() >= set(missing_pks):
+            # The account has been inserted by a concurrent
+            # transaction, which is not visible in our snapshot.
+            # Normally, PostgreSQL reports a serialization failure
+            # in this case, but we want to be sure.
+            raise DBSerializationError
+    return accounts
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _get_accounts_upsert(n):
+    table = Account.__table__
+    pks = [(bindparam(f'debtor_id_{i}'), bindparam(f'creditor_id_{i}')) for i in range(n)]
+    insert = pg.insert(table).values([dict(debtor_id=d, creditor_id=c) for d, c in pks])
+    inserted = insert.on_conflict_do_nothing().returning(*table.c).cte('inserted')
+    existing = table.select().where(tuple_(table.c.debtor_id, table.c.creditor_id).in_([tuple_(*pk) for pk in pks]))
+    return db.select([inserted]).union_all(existing)
+
+
 def _get_account(account):
-    instance = Account.get_instance(account)
-    if instance is None:
-        debtor_id, creditor_id = Account.get_pk_values(account)
-        instance = Account(debtor_id=debtor_id, creditor_id=creditor_id)
-        with db.retry_on_integrity_error():
-            db.session.add(instance)
-    return instance
+    if isinstance(account, Account) and account in db.session:
+        return account
+    pk = Account.get_pk_values(account)
+    return _get_accounts([pk])[pk]
 
 
 def _lock_account_amount(account, amount, ignore_demurrage=False):
     assert amount > 0
+    if current_app.config['LOCK_ACCOUNT_AMOUNTS_WITH_UPDATE']:
+        return _update_account_amount(account, amount, ignore_demurrage)
     account = _get_account(account)
     avl_balance = account.avl_balance + (account.demurrage if ignore_demurrage else 0)
     if avl_balance < amount:
@@ -70,59 +159,377 @@ def _lock_account_amount(account, amount, ignore_demurrage=False):
     return account
 
 
-def _commit_prepared_transfer(prepared_transfer, comment={}):
-    prepared_transfer = PreparedTransfer.get_instance(prepared_transfer)
-    if prepared_transfer is None:
+def _update_account_amount(account, amount, ignore_demurrage):
+    # The available amount is checked and locked with a single
+    # conditional "UPDATE ... RETURNING" statement, so that the
+    # account row is locked for a shorter time.
+    debtor_id, creditor_id = Account.get_pk_values(account)
+    note_accounts([(debtor_id, creditor_id)])
+    db.session.flush()
+    stmt, params = _get_account_amount_update((debtor_id, creditor_id), amount, ignore_demurrage)
+    accounts = list(Account.query.populate_existing().instances(db.session.execute(stmt, params)))
+    if not accounts:
+        account = _get_account((debtor_id, creditor_id))
+        raise InsufficientFunds(account.avl_balance + (account.demurrage if ignore_demurrage else 0))
+    invalidate_cached_accounts(db.session, [(debtor_id, creditor_id)])
+    return accounts[0]
+
+
+def _get_account_amount_update(pk, amount, ignore_demurrage):
+    debtor_id, creditor_id = pk
+    return _get_account_amount_update_stmt(ignore_demurrage), dict(
+        b_debtor_id=debtor_id,
+        b_creditor_id=creditor_id,
+        amount=amount,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_account_amount_update_stmt(ignore_demurrage):
+    # Note that the names of the columns can not be used as
+    # parameter names in UPDATE statements.
+    table = Account.__table__
+    amount = bindparam('amount', type_=table.c.avl_balance.type)
+    avl_balance = table.c.avl_balance + table.c.demurrage if ignore_demurrage else table.c.avl_balance
+    stmt = table.update().where(and_(
+        table.c.debtor_id == bindparam('b_debtor_id'),
+        table.c.creditor_id == bindparam('b_creditor_id'),
+        avl_balance >= amount,
+    ))
+    return stmt.values(avl_balance=table.c.avl_balance - amount).returning(*table.c)
+
+
+def _lock_accounts(pks):
+    if not pks:
+        return {}
+
+    # Note that `populate_existing()` disables autoflush.
+    note_accounts(pks)
+    db.session.flush()
+    query = bakery(lambda session: session.query(Account))
+    query += lambda q: q.filter(tuple_(Account.debtor_id, Account.creditor_id).in_(bindparam('pks', expanding=True)))
+    query += lambda q: q.order_by(Account.debtor_id, Account.creditor_id).with_for_update().populate_existing()
+    accounts = query(db.session()).params(pks=list(pks)).all()
+    return {(a.debtor_id, a.creditor_id): a for a in accounts}
+
+
+def _use_account_slots(creditor_id):
+    return creditor_id == ROOT_CREDITOR_ID and current_app.config['ROOT_ACCOUNT_SLOTS'] > 0
+
+
+def _add_to_account_slot(account, amount, last_transfer_ts):
+    # Writes to the account row are avoided here, so that concurrent
+    # transactions do not serialize on it. Note that the amounts in
+    # the slots will not be available for spending until they are
+    # folded back into the account (see `fold_account_slots`).
+    slot = random.randrange(current_app.config['ROOT_ACCOUNT_SLOTS'])
+    db.session.execute(*_get_account_slot_upsert(Account.get_pk_values(account), slot, amount, last_transfer_ts))
+
+
+def _get_account_slot_upsert(pk, slot, amount, last_transfer_ts):
+    debtor_id, creditor_id = pk
+    return _get_account_slot_upsert_stmt(), dict(
+        debtor_id=debtor_id,
+        creditor_id=creditor_id,
+        slot=slot,
+        balance=amount,
+        avl_balance=amount,
+        last_transfer_ts=last_transfer_ts,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_account_slot_upsert_stmt():
+    table = AccountSlot.__table__
+    columns = ['debtor_id', 'creditor_id', 'slot', 'balance', 'avl_balance', 'last_transfer_ts']
+    insert = pg.insert(table).values({c: bindparam(c, type_=table.c[c].type) for c in columns})
+    return insert.on_conflict_do_update(
+        index_elements=[AccountSlot.debtor_id, AccountSlot.creditor_id, AccountSlot.slot],
+        set_=dict(
+            balance=AccountSlot.balance + insert.excluded.balance,
+            avl_balance=AccountSlot.avl_balance + insert.excluded.avl_balance,
+            last_transfer_ts=db.func.greatest(AccountSlot.last_transfer_ts, insert.excluded.last_transfer_ts),
+        ),
+    )
+
+
+def _get_prepared_transfers_delete(clause):
+    table = PreparedTransfer.__table__
+    return table.delete().where(clause).returning(*table.c)
+
+
+def _get_prepared_transfer_delete(prepared_transfer):
+    debtor_id, prepared_transfer_seqnum = PreparedTransfer.get_pk_values(prepared_transfer)
+    return _get_prepared_transfer_delete_stmt(), dict(
+        debtor_id=debtor_id,
+        prepared_transfer_seqnum=prepared_transfer_seqnum,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_prepared_transfer_delete_stmt():
+    return _get_prepared_transfers_delete(and_(
+        PreparedTransfer.debtor_id == bindparam('debtor_id'),
+        PreparedTransfer.prepared_transfer_seqnum == bindparam('prepared_transfer_seqnum'),
+    ))
+
+
+def _delete_prepared_transfers(stmt, params={}):
+    # The transfers are deleted and fetched with a single "DELETE
+    # ... RETURNING" statement. This also locks the deleted rows.
+    db.session.flush()
+    table = PreparedTransfer.__table__
+    rows = db.session.execute(stmt, params).fetchall()
+    for row in rows:
+        pk = (row[table.c.debtor_id], row[table.c.prepared_transfer_seqnum])
+        instance = db.session.identity_map.get(identity_key(PreparedTransfer, pk))
+        if instance is not None:
+            db.session.expunge(instance)
+    return rows
+
+
+def _change_account_balances(changes, last_transfer_ts=None):
+    """Apply balance changes to many accounts with a single statement.
+
+    `changes` is a dictionary that maps account primary keys to
+    `(balance_delta, avl_balance_delta)` tuples. The missing accounts
+    are created, and the instances present in the session are updated
+    with the new values.
+
+    """
+
+    if not changes:
+        return
+    note_accounts(changes)
+    db.session.flush()
+    invalidate_cached_accounts(db.session, changes)
+    for row in db.session.execute(*_get_account_balances_upsert(changes, last_transfer_ts)).fetchall():
+        instance = db.session.identity_map.get(identity_key(Account, (row.debtor_id, row.creditor_id)))
+        if instance is not None:
+            for attr in row.keys():
+                set_committed_value(instance, attr, row[attr])
+
+
+class _DefaultContext:
+    # Imitates the execution context that SQLAlchemy passes to
+    # Python-side column defaults.
+    def __init__(self, parameters):
+        self.current_parameters = parameters
+
+    def get_current_parameters(self):
+        return self.current_parameters
+
+
+def _with_column_defaults(table, values):
+    """Return `values`, adding the Python-side defaults of the missing columns.
+
+    Normally, the defaults are calculated when the statement gets
+    executed. Here they are calculated in advance, so that the
+    statement can be executed by a different driver (see `aio`).
+
+    """
+
+    values = dict(values)
+    context = _DefaultContext(values)
+    for column in table.columns:
+        default = column.default
+        if column.key not in values and default is not None and not default.is_sequence:
+            values[column.key] = default.arg(context) if default.is_callable else default.arg
+    return values
+
+
+def _get_account_balances_upsert(changes, last_transfer_ts):
+    table = Account.__table__
+    params = {}
+    for i, ((debtor_id, creditor_id), (balance_delta, avl_balance_delta)) in enumerate(sorted(changes.items())):
+        row = dict(debtor_id=debtor_id, creditor_id=creditor_id, balance=balance_delta, avl_balance=avl_balance_delta)
+        if last_transfer_ts is not None:
+            row['last_transfer_ts'] = last_transfer_ts
+        for key, value in _with_column_defaults(table, row).items():
+            params[f'{key}_{i}'] = value
+    return _get_account_balances_upsert_stmt(len(changes), last_transfer_ts is not None), params
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _get_account_balances_upsert_stmt(n, change_last_transfer_ts):
+    # The account rows returned by the statement contain the primary
+    # key, and the changed columns.
+    table = Account.__table__
+    insert = pg.insert(table).values([
+        {c.key: bindparam(f'{c.key}_{i}', type_=c.type) for c in table.columns} for i in range(n)
+    ])
+    set_ = dict(
+        balance=table.c.balance + insert.excluded.balance,
+        avl_balance=table.c.avl_balance + insert.excluded.avl_balance,
+    )
+    if change_last_transfer_ts:
+        set_['last_transfer_ts'] = insert.excluded.last_transfer_ts
+    stmt = insert.on_conflict_do_update(index_elements=[table.c.debtor_id, table.c.creditor_id], set_=set_)
+    return stmt.returning(table.c.debtor_id, table.c.creditor_id, *[table.c[attr] for attr in set_])
+
+
+def _get_commit_changes(rows, use_account_slots):
+    # The changes are aggregated per account, so that each account
+    # row (or slot) is updated only once. Returns the balance changes
+    # (see `_change_account_balances`), and the amounts that should
+    # be added to account slots.
+    changes = {}
+    slot_amounts = {}
+    for row in rows:
+        amount = row.amount
+        sender = (row.debtor_id, row.sender_creditor_id)
+        recipient = (row.debtor_id, row.recipient_creditor_id)
+        balance_delta, avl_balance_delta = changes.get(sender, (0, 0))
+        changes[sender] = (balance_delta - amount, avl_balance_delta - amount + row.sender_locked_amount)
+        if use_account_slots(row.recipient_creditor_id):
+            slot_amounts[recipient] = slot_amounts.get(recipient, 0) + amount
+        else:
+            balance_delta, avl_balance_delta = changes.get(recipient, (0, 0))
+            changes[recipient] = (balance_delta + amount, avl_balance_delta + amount)
+    return changes, slot_amounts
+
+
+def _get_cancel_changes(rows):
+    changes = {}
+    for row in rows:
+        sender = (row.debtor_id, row.sender_creditor_id)
+        balance_delta, avl_balance_delta = changes.get(sender, (0, 0))
+        changes[sender] = (balance_delta, avl_balance_delta + row.sender_locked_amount)
+    return changes
+
+
+def _commit_prepared_transfers(rows, now):
+    changes, slot_amounts = _get_commit_changes(rows, _use_account_slots)
+    _change_account_balances(changes, now)
+    for recipient, amount in sorted(slot_amounts.items()):
+        _add_to_account_slot(recipient, amount, now)
+
+
+def _cancel_prepared_transfers(rows):
+    _change_account_balances(_get_cancel_changes(rows))
+
+
+def _get_coordinator_clause(coordinator, prepared_transfer_seqnums):
+    debtor_id, coordinator_id = Coordinator.get_pk_values(coordinator)
+    clause = and_(PreparedTransfer.debtor_id == debtor_id, PreparedTransfer.coordinator_id == coordinator_id)
+    if prepared_transfer_seqnums is not None:
+        clause = and_(clause, PreparedTransfer.prepared_transfer_seqnum.in_(prepared_transfer_seqnums))
+    return clause
+
+
+def _delete_coordinator_prepared_transfers(coordinator, prepared_transfer_seqnums):
+    if prepared_transfer_seqnums is not None:
+        prepared_transfer_seqnums = set(prepared_transfer_seqnums)
+        if not prepared_transfer_seqnums:
+            return []
+    clause = _get_coordinator_clause(coordinator, prepared_transfer_seqnums)
+    rows = _delete_prepared_transfers(_get_prepared_transfers_delete(clause))
+    if prepared_transfer_seqnums is not None and len(rows) < len(prepared_transfer_seqnums):
+        raise InvalidPreparedTransfer()
+    return rows
+
+
+def _commit_prepared_transfer(prepared_transfer):
+    rows = _delete_prepared_transfers(*_get_prepared_transfer_delete(prepared_transfer))
+    if not rows:
         raise InvalidPreparedTransfer()
-    now = get_now_utc()
-    amount = prepared_transfer.amount
-    sender_account = prepared_transfer.sender_account
-    recipient_account = _get_account((prepared_transfer.debtor_id, prepared_transfer.recipient_creditor_id))
-    withdrawal_request = prepared_transfer.withdrawal_request
-    if withdrawal_request:
-        assert prepared_transfer.transfer_type == PreparedTransfer.TYPE_DIRECT
-        assert withdrawal_request.amount == amount
-        if now > withdrawal_request.deadline_ts:
-            raise InvalidPreparedTransfer()
-        withdrawal = Withdrawal(
-            debtor_id=withdrawal_request.debtor_id,
-            creditor_id=withdrawal_request.creditor_id,
-            withdrawal_request_seqnum=withdrawal_request.withdrawal_request_seqnum,
-            amount=withdrawal_request.amount,
-            operator_branch_id=withdrawal_request.operator_branch_id,
-            operator_user_id=withdrawal_request.operator_user_id,
-            details=withdrawal_request.details,
-            opening_ts=withdrawal_request.opening_ts,
-            closing_ts=now,
-            closing_comment=comment,
-        )
-        db.session.add(withdrawal)
-        db.session.add(WithdrawalSignal(withdrawal=withdrawal))
-        db.session.delete(withdrawal_request)
-    sender_account.balance -= amount
-    sender_account.avl_balance -= amount - prepared_transfer.sender_locked_amount
-    sender_account.last_transfer_ts = now
-    recipient_account.balance += amount
-    recipient_account.avl_balance += amount
-    recipient_account.last_transfer_ts = now
-    db.session.delete(prepared_transfer)
+    _commit_prepared_transfers(rows, get_now_utc())
 
 
 def _cancel_prepared_transfer(prepared_transfer):
-    prepared_transfer = PreparedTransfer.get_instance(prepared_transfer)
-    if prepared_transfer is None:
+    rows = _delete_prepared_transfers(*_get_prepared_transfer_delete(prepared_transfer))
+    if not rows:
         raise InvalidPreparedTransfer()
-    sender_account = prepared_transfer.sender_account
-    sender_account.avl_balance += prepared_transfer.sender_locked_amount
-    db.session.delete(prepared_transfer)
+    _cancel_prepared_transfers(rows)
 
 
+@timed
+@sharded
+@db.atomic
+def get_debtor_operators(debtor_id):
+    """Return debtor's branches and operators (a `DebtorOperators` tuple)."""
+
+    branches_query, operators_query = _get_debtor_operators_queries()
+    params = dict(debtor_id=debtor_id)
+    return _make_debtor_operators(
+        db.session.execute(branches_query, params),
+        db.session.execute(operators_query, params),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_debtor_operators_queries():
+    branches_query = db.select([Branch.branch_id, Branch.info]).where(Branch.debtor_id == bindparam('debtor_id'))
+    operators_query = db.select([Operator.branch_id, Operator.user_id, *_get_operator_info_columns()])
+    operators_query = operators_query.where(Operator.debtor_id == bindparam('debtor_id'))
+    return branches_query, operators_query
+
+
+def _get_operator_info_columns():
+    return [Operator.alias, Operator.profile, Operator.can_withdraw, Operator.can_audit]
+
+
+def _make_debtor_operators(branch_rows, operator_rows):
+    return DebtorOperators(
+        branches={row['branch_id']: BranchInfo(row['info']) for row in branch_rows},
+        operators={(row['branch_id'], row['user_id']): OperatorInfo(*tuple(row)[2:]) for row in operator_rows},
+    )
+
+
+@timed
+@sharded
+@db.atomic
+def get_operator(operator):
+    """Return operator's `OperatorInfo`, or `None` if the operator does not exist."""
+
+    row = db.session.execute(*_get_operator_query(operator)).first()
+    return None if row is None else OperatorInfo(*row)
+
+
+def _get_operator_query(operator):
+    debtor_id, branch_id, user_id = Operator.get_pk_values(operator)
+    return _get_operator_query_stmt(), dict(debtor_id=debtor_id, branch_id=branch_id, user_id=user_id)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_operator_query_stmt():
+    return db.select(_get_operator_info_columns()).where(and_(
+        Operator.debtor_id == bindparam('debtor_id'),
+        Operator.branch_id == bindparam('branch_id'),
+        Operator.user_id == bindparam('user_id'),
+    ))
+
+
+def _get_operator_permission_query(operator):
+    # The operator's permissions are checked in the same transaction
+    # in which they are used. The operator row is locked, so that it
+    # can not be deleted before the transaction is committed.
+    debtor_id, branch_id, user_id = Operator.get_pk_values(operator)
+    return _get_operator_permission_query_stmt(), dict(debtor_id=debtor_id, branch_id=branch_id, user_id=user_id)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_operator_permission_query_stmt():
+    return db.select([Operator.can_withdraw]).where(and_(
+        Operator.debtor_id == bindparam('debtor_id'),
+        Operator.branch_id == bindparam('branch_id'),
+        Operator.user_id == bindparam('user_id'),
+    )).with_for_update(read=True, key_share=True)
+
+
+def _check_can_withdraw(row):
+    if row is None:
+        raise InvalidOperator()
+    if not row['can_withdraw']:
+        raise PermissionDenied()
+
+
+@timed
+@sharded
 @db.atomic
 def create_withdrawal_request(operator, creditor_id, amount, deadline_ts, details={}):
     debtor_id, operator_branch_id, operator_user_id = Operator.get_pk_values(operator)
-
-    # We presume that the operator exists in the database. If not, an
-    # unhandled integrity error will be raised.
+    _check_can_withdraw(db.session.execute(*_get_operator_permission_query(operator)).first())
     request = WithdrawalRequest(
         debtor_id=debtor_id,
         creditor_id=creditor_id,
@@ -136,6 +543,8 @@ def create_withdrawal_request(operator, creditor_id, amount, deadline_ts, detail
     return request
 
 
+@timed
+@sharded
 @db.atomic
 def prepare_direct_transfer(sender_account, recipient_creditor_id, amount):
     assert amount > 0
@@ -154,11 +563,282 @@ def prepare_direct_transfer(sender_account, recipient_creditor_id, amount):
     return transfer
 
 
+@timed
+@sharded
 @db.atomic
 def commit_creditor_prepared_transfer(prepared_transfer, comment={}):
-    _commit_prepared_transfer(prepared_transfer, comment)
+    _commit_prepared_transfer(prepared_transfer)
 
 
+@timed
+@sharded
 @db.atomic
 def cancel_creditor_prepared_transfer(prepared_transfer):
     _cancel_prepared_transfer(prepared_transfer)
+
+
+@timed
+@sharded
+@db.atomic
+def commit_coordinator_prepared_transfers(coordinator, prepared_transfer_seqnums=None):
+    """Commit coordinator's prepared transfers in a single transaction.
+
+    If `prepared_transfer_seqnums` is `None`, all prepared transfers
+    of the coordinator are committed. Raises `InvalidPreparedTransfer`
+    if some of the specified transfers do not exist. Returns the
+    number of committed transfers.
+
+    """
+
+    rows = _delete_coordinator_prepared_transfers(coordinator, prepared_transfer_seqnums)
+    _commit_prepared_transfers(rows, get_now_utc())
+    return len(rows)
+
+
+@timed
+@sharded
+@db.atomic
+def cancel_coordinator_prepared_transfers(coordinator, prepared_transfer_seqnums=None):
+    """Cancel coordinator's prepared transfers in a single transaction.
+
+    The arguments and the return value are the same as for
+    `commit_coordinator_prepared_transfers`.
+
+    """
+
+    rows = _delete_coordinator_prepared_transfers(coordinator, prepared_transfer_seqnums)
+    _cancel_prepared_transfers(rows)
+    return len(rows)
+
+
+@timed
+def prepare_direct_transfers(batch):
+    """Prepare many direct transfers in a single transaction.
+
+    `batch` is a sequence of `(sender_account, recipient_creditor_id,
+    amount)` tuples. Returns a list with one element for each item in
+    `batch` -- either the created `PreparedTransfer`, or an
+    `InsufficientFunds` instance. Raises `CrossShardError` if the
+    senders are not in the same shard.
+
+    """
+
+    batch = list(batch)
+    with debtor_shard(*[get_debtor_id(account) for account, _, _ in batch]):
+        return _prepare_direct_transfers(batch)
+
+
+@db.atomic
+def _prepare_direct_transfers(batch):
+    items = [(Account.get_pk_values(account), recipient_id, amount) for account, recipient_id, amount in batch]
+    assert all(amount > 0 for _, _, amount in items)
+    accounts = _lock_accounts(sorted({pk for pk, _, _ in items}))
+    results = [None] * len(items)
+    values = []
+    for i, (pk, recipient_creditor_id, amount) in enumerate(items):
+        account = accounts.get(pk)
+        if account is None:
+            results[i] = InsufficientFunds(0)
+            continue
+        ignore_demurrage = recipient_creditor_id == ROOT_CREDITOR_ID
+        avl_balance = account.avl_balance + (account.demurrage if ignore_demurrage else 0)
+        if avl_balance < amount:
+            results[i] = InsufficientFunds(avl_balance)
+            continue
+        account.avl_balance -= amount
+        values.append((i, dict(
+            debtor_id=pk[0],
+            sender_creditor_id=pk[1],
+            recipient_creditor_id=recipient_creditor_id,
+            amount=amount,
+            sender_locked_amount=amount,
+            transfer_type=PreparedTransfer.TYPE_DIRECT,
+        )))
+    if values:
+        table = PreparedTransfer.__table__
+        stmt = table.insert().values([v for _, v in values]).returning(*table.c)
+        transfers = PreparedTransfer.query.instances(db.session.execute(stmt))
+
+        # The order of the returned rows is not guaranteed, so they
+        # are matched with the batch items by their column values.
+        # Items with equal values are interchangeable.
+        transfers_by_key = {}
+        for transfer in sorted(transfers, key=lambda t: t.prepared_transfer_seqnum, reverse=True):
+            key = (transfer.debtor_id, transfer.sender_creditor_id, transfer.recipient_creditor_id, transfer.amount)
+            transfers_by_key.setdefault(key, []).append(transfer)
+        for i, v in values:
+            key = (v['debtor_id'], v['sender_creditor_id'], v['recipient_creditor_id'], v['amount'])
+            results[i] = transfers_by_key[key].pop()
+    return results
+
+
+@sharded
+@db.atomic
+def _accrue_demurrage_chunk(debtor_id, accrual_ts, start_after, chunk_size):
+    query = db.session.query(Account.creditor_id).filter(
+        Account.debtor_id == debtor_id,
+        Account.demurrage_ts < accrual_ts,
+    )
+    if start_after is not None:
+        query = query.filter(Account.creditor_id > start_after)
+
+    # NOTE: The chunk must be a CTE. A "creditor_id IN (SELECT ...
+    # LIMIT n FOR UPDATE)" sub-query may get re-scanned, skipping the
+    # rows that have been already updated, and so all rows would
+    # eventually be updated.
+    chunk = query.order_by(Account.creditor_id).limit(chunk_size).with_for_update().cte('chunk')
+    rate = db.func.least(Account.discount_demurrage_rate, Debtor.demurrage_rate, Debtor.demurrage_rate_ceiling)
+    years = extract('epoch', db.literal(accrual_ts, db.TIMESTAMP(timezone=True)) - Account.demurrage_ts) / SECONDS_IN_YEAR
+    subject_to_demurrage = db.func.greatest(Account.balance - Account.demurrage, 0)
+    accrued = db.cast(db.func.floor(subject_to_demurrage * (1 - db.func.power(1 + rate / 100, -years))), db.BigInteger)
+    stmt = Account.__table__.update().where(and_(
+        Account.debtor_id == debtor_id,
+        Account.creditor_id == chunk.c.creditor_id,
+        Debtor.debtor_id == Account.debtor_id,
+    ))
+    stmt = stmt.values(
+        demurrage=Account.demurrage + accrued,
+        avl_balance=Account.avl_balance - accrued,
+        demurrage_ts=accrual_ts,
+    )
+    stmt = stmt.returning(Account.creditor_id)
+    creditor_ids = [row[0] for row in db.session.execute(stmt)]
+    invalidate_cached_accounts(db.session, [(debtor_id, creditor_id) for creditor_id in creditor_ids])
+    return creditor_ids
+
+
+def accrue_demurrage(debtor_id, accrual_ts=None, start_after=None, chunk_size=DEMURRAGE_CHUNK_SIZE):
+    """Accrue the demurrage on debtor's accounts, up to `accrual_ts`.
+
+    Accounts are processed in chunks, ordered by `creditor_id`, each
+    chunk in its own transaction. After each chunk is committed, the
+    biggest processed `creditor_id` is yielded. This value can be
+    passed as `start_after` to resume an interrupted accrual.
+
+    """
+
+    accrual_ts = accrual_ts or get_now_utc()
+    while True:
+        creditor_ids = _accrue_demurrage_chunk(debtor_id, accrual_ts, start_after, chunk_size)
+        if not creditor_ids:
+            break
+        start_after = max(creditor_ids)
+        yield start_after
+        if len(creditor_ids) < chunk_size:
+            break
+
+
+@timed
+@sharded
+@db.atomic
+def get_account_balances(account):
+    """Return account's `(balance, avl_balance)`, including the amounts in account's slots."""
+
+    debtor_id, creditor_id = Account.get_pk_values(account)
+    slots = AccountSlot.query.filter_by(debtor_id=debtor_id, creditor_id=creditor_id)
+    slots_balance = slots.with_entities(db.func.coalesce(db.func.sum(AccountSlot.balance), 0)).as_scalar()
+    slots_avl_balance = slots.with_entities(db.func.coalesce(db.func.sum(AccountSlot.avl_balance), 0)).as_scalar()
+    query = Account.query.filter_by(debtor_id=debtor_id, creditor_id=creditor_id)
+    row = query.with_entities(Account.balance + slots_balance, Account.avl_balance + slots_avl_balance).one_or_none()
+    return (0, 0) if row is None else tuple(row)
+
+
+@timed
+def get_account_state(account):
+    """Return account's `AccountState`, or `None` if the account does not exist.
+
+    The state may be served from the account cache. The amounts in
+    account's slots are not included.
+
+    """
+
+    pk = Account.get_pk_values(account)
+    cache = current_app.extensions['account_cache']
+    state = None if cache is None else cache.get(pk)
+    if state is None:
+        # The version is obtained before the state is read, so that a
+        # state that gets invalidated meanwhile is not cached.
+        version = None if cache is None else cache.get_version(pk)
+        state = _get_account_state(pk)
+        if cache is not None and state is not None:
+            cache.set(pk, state, version)
+    return state
+
+
+@sharded
+@db.atomic
+def _get_account_state(pk):
+    debtor_id, creditor_id = pk
+    row = db.session.execute(_get_account_state_query(), dict(debtor_id=debtor_id, creditor_id=creditor_id)).first()
+    return None if row is None else AccountState(*row)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_account_state_query():
+    query = db.select([Account.balance, Account.avl_balance, Account.demurrage, Account.last_transfer_ts])
+    return query.where(and_(
+        Account.debtor_id == bindparam('debtor_id'),
+        Account.creditor_id == bindparam('creditor_id'),
+    ))
+
+
+@timed
+@sharded
+@db.atomic
+def fold_account_slots(account):
+    debtor_id, creditor_id = Account.get_pk_values(account)
+    table = AccountSlot.__table__
+    stmt = table.delete().where(and_(table.c.debtor_id == debtor_id, table.c.creditor_id == creditor_id))
+    stmt = stmt.returning(table.c.balance, table.c.avl_balance, table.c.last_transfer_ts)
+    slots = db.session.execute(stmt).fetchall()
+    if slots:
+        account = Account.lock_instance((debtor_id, creditor_id))
+        account.balance += sum(s.balance for s in slots)
+        account.avl_balance += sum(s.avl_balance for s in slots)
+        account.last_transfer_ts = max([account.last_transfer_ts] + [s.last_transfer_ts for s in slots])
+    return len(slots)
+
+
+@timed
+@db.atomic
+def cancel_stale_prepared_transfers(cutoff_ts, batch_size=REAPER_BATCH_SIZE):
+    """Cancel a batch of transfers that have been prepared before `cutoff_ts`.
+
+    The transfers locked by concurrent transactions are skipped, so
+    that live transfers are not blocked, and several reapers can run
+    in parallel. Returns the number of cancelled transfers.
+
+    """
+
+    query = db.session.query(PreparedTransfer.debtor_id, PreparedTransfer.prepared_transfer_seqnum)
+    query = query.filter(PreparedTransfer.prepared_at_ts < cutoff_ts).order_by(PreparedTransfer.prepared_at_ts)
+    chunk = query.limit(batch_size).with_for_update(skip_locked=True).cte('chunk')
+    rows = _delete_prepared_transfers(_get_prepared_transfers_delete(and_(
+        PreparedTransfer.debtor_id == chunk.c.debtor_id,
+        PreparedTransfer.prepared_transfer_seqnum == chunk.c.prepared_transfer_seqnum,
+    )))
+    _cancel_prepared_transfers(rows)
+    return len(rows)
+
+
+@timed
+@db.atomic
+def delete_expired_withdrawal_requests(cutoff_ts=None, batch_size=REAPER_BATCH_SIZE):
+    """Delete a batch of withdrawal requests with deadlines before `cutoff_ts`.
+
+    The rows locked by concurrent transactions are skipped. Returns
+    the number of deleted withdrawal requests.
+
+    """
+
+    cutoff_ts = cutoff_ts or get_now_utc()
+    query = db.session.query(WithdrawalRequest.debtor_id, WithdrawalRequest.withdrawal_request_seqnum)
+    query = query.filter(WithdrawalRequest.deadline_ts < cutoff_ts).order_by(WithdrawalRequest.deadline_ts)
+    chunk = query.limit(batch_size).with_for_update(skip_locked=True).cte('chunk')
+    db.session.flush()
+    table = WithdrawalRequest.__table__
+    stmt = table.delete().where(and_(
+        table.c.debtor_id == chunk.c.debtor_id,
+        table.c.withdrawal_request_seqnum == chunk.c.withdrawal_request_seqnum,
+    ))
+    return db.session.execute(stmt).rowcount
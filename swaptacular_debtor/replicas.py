@@ -0,0 +1,66 @@
+import math
+import time
+import random
+import logging
+import threading
+from sqlalchemy import text
+
+DEFAULT_CHECK_INTERVAL_SECONDS = 1.0
+
+STALENESS_QUERY = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+def get_replica_staleness(engine):
+    """Return the replication lag of a database, in seconds.
+
+    The lag of a database that is not a replica is zero.
+
+    """
+
+    with engine.connect() as connection:
+        return float(connection.execute(STALENESS_QUERY).scalar() or 0.0)
+
+
+class ReplicaSelector:
+    """Select a replica whose staleness is within the tolerance.
+
+    `get_staleness` is called with a bind key, and should return the
+    staleness of the corresponding replica in seconds. The staleness
+    of each replica is checked at most once every `check_interval`
+    seconds. Replicas that can not be checked are considered stale.
+
+    """
+
+    def __init__(self, bind_keys, max_staleness, get_staleness, check_interval=DEFAULT_CHECK_INTERVAL_SECONDS):
+        self.bind_keys = list(bind_keys)
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self._get_staleness = get_staleness
+        self._lock = threading.Lock()
+        self._checks = {}
+
+    def get_staleness(self, bind_key):
+        now = time.monotonic()
+        with self._lock:
+            checked_at, staleness = self._checks.get(bind_key, (-math.inf, math.inf))
+        if now - checked_at >= self.check_interval:
+            try:
+                staleness = self._get_staleness(bind_key)
+            except Exception:
+                logger = logging.getLogger(__name__)
+                logger.exception('Caught error while checking the staleness of "%s".', bind_key)
+                staleness = math.inf
+            with self._lock:
+                self._checks[bind_key] = (now, staleness)
+        return staleness
+
+    def select(self):
+        """Return the bind key of a fresh enough replica, or `None` if there is none."""
+
+        fresh_bind_keys = [k for k in self.bind_keys if self.get_staleness(k) <= self.max_staleness]
+        return random.choice(fresh_bind_keys) if fresh_bind_keys else None
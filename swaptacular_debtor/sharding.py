@@ -0,0 +1,211 @@
+import bisect
+import threading
+import functools
+from contextlib import contextmanager
+from sqlalchemy import text
+from sqlalchemy.sql import visitors, operators
+from sqlalchemy.sql.expression import BindParameter, ColumnClause
+from flask import current_app
+
+MAX_DEBTOR_ID = (1 << 63) - 1
+
+_local = threading.local()
+
+
+class CrossShardError(Exception):
+    """The operation involves debtors from more than one shard."""
+
+
+class ShardNotSelectedError(Exception):
+    """The shard for a database operation can not be determined."""
+
+
+def parse_shards(spec):
+    """Parse a shards specification, and return a list of `(lower_bound, database_uri)` tuples.
+
+    The specification is a whitespace-separated list of
+    "LOWER_BOUND=DATABASE_URI" entries. Each shard contains the
+    debtors whose IDs are greater or equal to its lower bound, and
+    smaller than the lower bound of the next shard. The first lower
+    bound must be zero.
+
+    """
+
+    shards = []
+    for entry in spec.split():
+        lower_bound, sep, database_uri = entry.partition('=')
+        if not sep or not database_uri:
+            raise ValueError(f'invalid shard specification: "{entry}"')
+        shards.append((int(lower_bound), database_uri))
+    shards.sort()
+    lower_bounds = [lower_bound for lower_bound, _ in shards]
+    if lower_bounds and lower_bounds[0] != 0:
+        raise ValueError('the first lower bound must be zero')
+    if len(set(lower_bounds)) != len(lower_bounds) or any(b > MAX_DEBTOR_ID for b in lower_bounds):
+        raise ValueError('invalid lower bounds')
+    return shards
+
+
+class ShardRouter:
+    """Map debtor IDs to shards.
+
+    `shards` is a sorted list of `(lower_bound, shard)` tuples, where
+    `shard` can be any value (a bind key or a database URI, for
+    example).
+
+    """
+
+    def __init__(self, shards):
+        assert shards and shards[0][0] == 0
+        self.lower_bounds = [lower_bound for lower_bound, _ in shards]
+        self.shards = [shard for _, shard in shards]
+
+    def get_shard(self, debtor_id):
+        assert 0 <= debtor_id <= MAX_DEBTOR_ID
+        return self.shards[bisect.bisect_right(self.lower_bounds, debtor_id) - 1]
+
+
+def get_current_shard():
+    """Return the bind key of the selected shard, or `None` if no shard is selected."""
+
+    return getattr(_local, 'shard', None)
+
+
+def get_shard_keys():
+    """Return the bind keys of all shards (`[None]` if sharding is not configured)."""
+
+    router = current_app.extensions['shard_router']
+    return [None] if router is None else list(router.shards)
+
+
+@contextmanager
+def use_shard(bind_key):
+    """Send the database operations in the current thread to the specified shard."""
+
+    current_shard = get_current_shard()
+    if current_shard is not None and current_shard != bind_key:
+        raise CrossShardError()
+    _local.shard = bind_key
+    try:
+        yield
+    finally:
+        _local.shard = current_shard
+
+
+def get_debtor_id(obj):
+    """Return the debtor ID for a model instance, a primary key tuple, or a debtor ID."""
+
+    if isinstance(obj, int):
+        return obj
+    if isinstance(obj, (tuple, list)):
+        return obj[0]
+    return obj.debtor_id
+
+
+def get_clause_debtor_ids(clause):
+    """Return the set of debtor IDs to which `debtor_id` columns are compared for equality in a clause.
+
+    Only comparisons with bound values are taken into account. For
+    example, for `Account.query.filter_by(debtor_id=1).statement`,
+    `{1}` is returned.
+
+    """
+
+    debtor_ids = set()
+
+    def visit_binary(binary):
+        if binary.operator is operators.eq:
+            for column, value in [(binary.left, binary.right), (binary.right, binary.left)]:
+                is_debtor_id = isinstance(column, ColumnClause) and column.name == 'debtor_id'
+                if is_debtor_id and isinstance(value, BindParameter) and isinstance(value.value, int):
+                    debtor_ids.add(value.value)
+
+    visitors.traverse(clause, {}, {'binary': visit_binary})
+    return debtor_ids
+
+
+@contextmanager
+def debtor_shard(*debtor_ids):
+    """Send the database operations in the current thread to the debtors' shard.
+
+    Raises `CrossShardError` if the debtors are in different shards.
+
+    """
+
+    router = current_app.extensions['shard_router']
+    bind_keys = set() if router is None else {router.get_shard(debtor_id) for debtor_id in debtor_ids}
+    if len(bind_keys) > 1:
+        raise CrossShardError()
+    with use_shard(bind_keys.pop() if bind_keys else get_current_shard()):
+        yield
+
+
+def sharded(func):
+    """Decorate a function so that it is executed in the shard of its first argument's debtor."""
+
+    @functools.wraps(func)
+    def wrapper(obj, *args, **kwargs):
+        with debtor_shard(get_debtor_id(obj)):
+            return func(obj, *args, **kwargs)
+
+    return wrapper
+
+
+def move_debtor(debtor_id, tables, source_engine, target_engine):
+    """Move all debtor's rows from one database to another.
+
+    `tables` should be sorted in dependency order. The moved rows are
+    locked in the source database until they have been committed to
+    the target database, so that concurrent transactions can not
+    modify them. Still, requests for the moved debtor will fail until
+    the application is reconfigured with the new shards.
+
+    The target transaction is committed before the source
+    transaction, so if the move gets interrupted, the debtor may
+    remain in both databases. Therefore, the move is idempotent: the
+    debtor's rows that already exist in the target database are
+    replaced with the rows from the source database (which is still
+    the authoritative one), unless they are identical. Nothing is
+    done if the debtor does not exist in the source database.
+
+    """
+
+    with source_engine.connect() as source, target_engine.connect() as target:
+        with source.begin():
+            rows_by_table = [(table, _get_debtor_rows(source, table, debtor_id)) for table in tables]
+            if not any(rows for _, rows in rows_by_table):
+                # The debtor has been moved already.
+                return
+            with target.begin():
+                target_rows_by_table = [(table, _get_debtor_rows(target, table, debtor_id)) for table in tables]
+                if target_rows_by_table != rows_by_table:
+                    for table in reversed(tables):
+                        target.execute(table.delete().where(table.c.debtor_id == debtor_id))
+                    for table, rows in rows_by_table:
+                        if rows:
+                            target.execute(table.insert(), rows)
+                for table, rows in rows_by_table:
+                    if rows:
+                        _advance_sequences(target, table, rows)
+            for table in reversed(tables):
+                source.execute(table.delete().where(table.c.debtor_id == debtor_id))
+
+
+def _get_debtor_rows(connection, table, debtor_id):
+    query = table.select().where(table.c.debtor_id == debtor_id).order_by(*table.primary_key.columns)
+    return [dict(row) for row in connection.execute(query.with_for_update())]
+
+
+def _advance_sequences(connection, table, rows):
+    # The moved rows may contain sequence numbers that the target
+    # database has not generated yet.
+    for column in table.primary_key.columns:
+        if column.autoincrement is True:
+            get_sequence = text('SELECT pg_get_serial_sequence(:table, :column)')
+            sequence = connection.execute(get_sequence, table=table.name, column=column.name).scalar()
+            if sequence is not None:
+                connection.execute(
+                    text(f'SELECT setval(:sequence, greatest(last_value, :value)) FROM {sequence}'),
+                    sequence=sequence,
+                    value=max(row[column.name] for row in rows),
+                )
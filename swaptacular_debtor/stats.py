@@ -0,0 +1,97 @@
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """A histogram with fixed bucket upper bounds, like the Prometheus histograms.
+
+    The last element of `counts` is the number of values that are
+    greater than the last bound.
+
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        assert self.bounds == other.bounds
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+
+class HistogramSet:
+    """A dictionary of histograms with the same buckets, created on first use."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.histograms = {}
+
+    def get(self, key):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.bounds)
+        return histogram
+
+    def observe(self, key, value):
+        self.get(key).observe(value)
+
+    def merge(self, other):
+        # Note that `other` may be updated by another thread at the
+        # same time, so its dictionary is copied before iterating.
+        for key, histogram in list(other.histograms.items()):
+            self.get(key).merge(histogram)
+
+
+class ThreadLocalAggregator:
+    """Keep a separate accumulator for each thread, and merge the accumulators when read.
+
+    The accumulators are created by calling `factory()`, and must
+    have a `merge(other)` method. Each thread updates its own
+    accumulator (see `get`), so no locking is needed on the hot path.
+
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._retired = factory()
+
+    def get(self):
+        """Return the current thread's accumulator."""
+
+        accumulator = getattr(self._local, 'accumulator', None)
+        if accumulator is None:
+            accumulator = self._local.accumulator = self.factory()
+            with self._lock:
+                # The accumulators of finished threads are merged, so
+                # that short-lived threads do not accumulate.
+                for thread, thread_accumulator in self._threads:
+                    if not thread.is_alive():
+                        self._retired.merge(thread_accumulator)
+                self._threads = [(t, a) for t, a in self._threads if t.is_alive()]
+                self._threads.append((threading.current_thread(), accumulator))
+        return accumulator
+
+    def merge(self):
+        """Return a new accumulator, in which the accumulators of all threads are merged."""
+
+        merged = self.factory()
+        with self._lock:
+            merged.merge(self._retired)
+            for _, accumulator in self._threads:
+                merged.merge(accumulator)
+        return merged
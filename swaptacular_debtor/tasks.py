@@ -1,6 +1,131 @@
+import datetime
+import functools
+import threading
+import dramatiq
+from flask import current_app
 from flask_melodramatiq import RabbitmqBroker
 
+PUBLISH_ATTEMPTS = 6
+COMMANDS_QUEUE = 'debtor_commands'
+
 broker = RabbitmqBroker(confirm_delivery=True)
+_local = threading.local()
+
+# Maps actor names to the functions that execute debtors'
+# commands. See `command_actor`.
+commands = {}
+
+
+def get_debtor_partition(debtor_id, partitions):
+    """Return the number of the partition to which a debtor belongs.
+
+    This is Lamping and Veach's "jump" consistent hash: when the
+    number of partitions grows from N to N + 1, only 1/(N + 1) of the
+    debtors move to another partition (the new one).
+
+    """
+
+    key = debtor_id & 0xffffffffffffffff
+    b, j = -1, 0
+    while j < partitions:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def get_partition_queue_names(queue_name, partitions):
+    """Return the names of queue's sub-queues."""
+
+    if partitions <= 1:
+        return [queue_name]
+    return [f'{queue_name}_{i}' for i in range(partitions)]
+
+
+def get_debtor_queue_name(queue_name, debtor_id):
+    """Return the name of the sub-queue for debtor's messages.
+
+    When DEBTOR_QUEUE_PARTITIONS is greater than one, the queue is
+    split into that many sub-queues, and all messages for a given
+    debtor go to the same sub-queue. When each sub-queue has a single
+    consumer (which must not process messages concurrently), debtor's
+    messages are processed one after another, without competing for
+    the same database rows. Note that the queues must be drained
+    before DEBTOR_QUEUE_PARTITIONS is changed (see the
+    `consume_commands` CLI command).
+
+    """
+
+    partitions = current_app.config['DEBTOR_QUEUE_PARTITIONS']
+    if partitions <= 1:
+        return queue_name
+    return get_partition_queue_names(queue_name, partitions)[get_debtor_partition(debtor_id, partitions)]
+
+
+def get_message_debtor_id(args, kwargs):
+    return args[0] if args else kwargs['debtor_id']
+
+
+def _get_transactional_channel():
+    # The broker's own channel is in "confirm delivery" mode, which
+    # waits for a confirmation after each published message. Instead,
+    # we publish batches of messages in a single AMQP transaction.
+    connection = broker.connection
+    channel = getattr(_local, 'channel', None)
+    if channel is None or channel.is_closed or getattr(_local, 'connection', None) is not connection:
+        channel = connection.channel()
+        channel.tx_select()
+        _local.connection = connection
+        _local.channel = channel
+    return channel
+
+
+def _get_routing_key(message):
+    if message.queue_name is None:
+        return 'dramatiq.events.' + message.actor_name
+    return message.queue_name
+
+
+def publish_messages(messages, *, exchange=''):
+    """Publish a batch of messages on an exchange.
+
+    All messages are published in a single AMQP transaction, so that
+    the broker is waited for only once per batch. If the function
+    returns normally, all messages have been accepted by the broker.
+
+    :param messages: A list of `dramatiq.Message` instances
+
+    :param exchange: The name of the RabbitMQ exchange on which to
+      publish the messages
+
+    """
+
+    import pika
+
+    bodies = [(_get_routing_key(m), m.encode(), m.options.get('broker_priority')) for m in messages]
+    attempts = 1
+    while True:
+        try:
+            channel = _get_transactional_channel()
+            for routing_key, body, priority in bodies:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=body,
+                    properties=pika.BasicProperties(delivery_mode=2, priority=priority),
+                )
+            channel.tx_commit()
+            return
+
+        except (pika.exceptions.AMQPConnectionError,
+                pika.exceptions.AMQPChannelError) as e:
+            _local.channel = None
+            del broker.channel
+            del broker.connection
+
+            attempts += 1
+            if attempts > PUBLISH_ATTEMPTS:
+                raise dramatiq.ConnectionClosed(e) from None
 
 
 @broker.actor
@@ -15,3 +140,58 @@ def test_job():
     print('****************************')
     print('* Performing the test job. *')
     print('****************************')
+
+
+def command_actor(fn):
+    """Declare an actor that executes a debtor's command.
+
+    The first argument of `fn` must be the debtor ID. The messages
+    should be sent with `send_command`, which routes them to one of
+    the sub-queues of `COMMANDS_QUEUE`. They can be processed one by
+    one by a Dramatiq worker (with a single thread per sub-queue), or
+    in batches by the `flask debtor consume_commands` command (see
+    `batching.consume_commands`).
+    Commands that fail with an expected error (insufficient funds, for
+    example) are logged and dropped.
+
+    """
+
+    @functools.wraps(fn)
+    def execute(*args, **kwargs):
+        from .batching import execute_commands
+        execute_commands(get_message_debtor_id(args, kwargs), [(fn, args, kwargs)])
+
+    commands[fn.__name__] = fn
+    return broker.actor(execute, queue_name=COMMANDS_QUEUE)
+
+
+def send_command(actor, debtor_id, **kwargs):
+    """Send a message to a command actor, on debtor's sub-queue (see `get_debtor_queue_name`)."""
+
+    message = actor.message_with_options(kwargs={'debtor_id': debtor_id, **kwargs})
+    return broker.enqueue(message.copy(queue_name=get_debtor_queue_name(actor.queue_name, debtor_id)))
+
+
+@command_actor
+def prepare_transfer(debtor_id, sender_creditor_id, recipient_creditor_id, amount):
+    from .procedures import prepare_direct_transfer
+    prepare_direct_transfer((debtor_id, sender_creditor_id), recipient_creditor_id, amount)
+
+
+@command_actor
+def commit_transfer(debtor_id, prepared_transfer_seqnum):
+    from .procedures import commit_creditor_prepared_transfer
+    commit_creditor_prepared_transfer((debtor_id, prepared_transfer_seqnum))
+
+
+@command_actor
+def cancel_transfer(debtor_id, prepared_transfer_seqnum):
+    from .procedures import cancel_creditor_prepared_transfer
+    cancel_creditor_prepared_transfer((debtor_id, prepared_transfer_seqnum))
+
+
+@command_actor
+def create_withdrawal_request(debtor_id, branch_id, user_id, creditor_id, amount, deadline_ts, details={}):
+    from .procedures import create_withdrawal_request
+    deadline_ts = datetime.datetime.fromisoformat(deadline_ts)
+    create_withdrawal_request((debtor_id, branch_id, user_id), creditor_id, amount, deadline_ts, details)
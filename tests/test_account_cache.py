@@ -0,0 +1,121 @@
+from swaptacular_debtor.models import Account, TransactionSignal, BEGINNING_OF_TIME, get_now_utc
+from swaptacular_debtor.account_cache import AccountCache, SharedAccountCache, AccountState, create_account_cache
+from swaptacular_debtor import procedures
+
+
+def test_account_cache():
+    cache = AccountCache(2, ttl=60.0)
+    state = AccountState(1, 2, 3, BEGINNING_OF_TIME)
+    assert cache.get((1, 1)) is None
+    cache.set((1, 1), state)
+    cache.set((1, 2), state)
+    assert cache.get((1, 1)) == state
+    cache.set((1, 3), state)
+    assert cache.get((1, 2)) is None
+    assert cache.get((1, 1)) == state
+    cache.invalidate((1, 1))
+    assert cache.get((1, 1)) is None
+    cache.ttl = 0.0
+    cache.set((1, 1), state)
+    assert cache.get((1, 1)) is None
+
+
+def test_account_cache_version(tmp_path):
+    for cache in [AccountCache(10, ttl=60.0), SharedAccountCache(str(tmp_path / 'cache'), 10, ttl=60.0)]:
+        state = AccountState(1, 2, 3, BEGINNING_OF_TIME)
+        version = cache.get_version((1, 1))
+        cache.invalidate((1, 1))
+        cache.set((1, 1), state, version)
+        assert cache.get((1, 1)) is None
+        cache.set((1, 1), state, cache.get_version((1, 1)))
+        assert cache.get((1, 1)) == state
+
+
+def test_shared_account_cache(tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = SharedAccountCache(path, 100, ttl=60.0)
+    other_cache = SharedAccountCache(path, 100, ttl=60.0)
+    state = AccountState(-1, 2, 3, get_now_utc())
+    assert cache.get((1, -1)) is None
+    cache.set((1, -1), state)
+    cache.set((1, BEGINNING_OF_TIME.year), AccountState(0, 0, 0, BEGINNING_OF_TIME))
+    assert other_cache.get((1, -1)) == state
+    assert other_cache.get((1, 1)) == AccountState(0, 0, 0, BEGINNING_OF_TIME)
+    assert other_cache.get((2, -1)) is None
+    other_cache.invalidate((1, -1))
+    assert cache.get((1, -1)) is None
+    cache.ttl = -1.0
+    cache.set((1, -1), state)
+    assert other_cache.get((1, -1)) is None
+    assert isinstance(create_account_cache(10, 1.0, path), SharedAccountCache)
+    assert isinstance(create_account_cache(10, 1.0), AccountCache)
+    assert create_account_cache(0, 1.0) is None
+
+
+def test_get_account_state(app, db_session):
+    cache = app.extensions['account_cache']
+    debtor = procedures.create_debtor(user_id=666)
+    db_session.add(Account(debtor_id=debtor.debtor_id, creditor_id=777, balance=2000, avl_balance=2000))
+
+    # The cache is invalidated only when the outermost transaction
+    # commits. In the test session, this happens on explicit commits
+    # only, and after that, on each atomic block.
+    db_session.commit()
+    pk = (debtor.debtor_id, 777)
+    state = procedures.get_account_state(pk)
+    assert state.balance == 2000
+    assert cache.get(pk) == state
+    assert procedures.get_account_state((debtor.debtor_id, 888)) is None
+
+    # Locking an amount invalidates the cached state on commit.
+    transfer = procedures.prepare_direct_transfer(pk, 888, 500)
+    assert cache.get(pk) is None
+    assert procedures.get_account_state(pk).avl_balance == 1500
+
+    # Committing a transfer invalidates both accounts.
+    assert procedures.get_account_state((debtor.debtor_id, 888)) is None
+    procedures.commit_creditor_prepared_transfer(transfer)
+    assert cache.get(pk) is None
+    assert procedures.get_account_state(pk).balance == 1500
+    assert procedures.get_account_state((debtor.debtor_id, 888)).balance == 500
+
+    # Emitting a transaction signal invalidates both accounts. Note
+    # that the cache is invalidated on rollback too.
+    db_session.add(TransactionSignal(
+        debtor_id=debtor.debtor_id,
+        sender_creditor_id=777,
+        recipient_creditor_id=888,
+        amount=1,
+    ))
+    db_session.flush()
+    assert cache.get(pk) is not None
+    db_session.rollback()
+    assert cache.get(pk) is None
+    procedures.get_account_state(pk)
+    procedures.get_account_state((debtor.debtor_id, 888))
+    db_session.add(TransactionSignal(
+        debtor_id=debtor.debtor_id,
+        sender_creditor_id=777,
+        recipient_creditor_id=888,
+        amount=1,
+    ))
+    db_session.commit()
+    assert cache.get(pk) is None
+    assert cache.get((debtor.debtor_id, 888)) is None
+
+
+def test_get_account_state_invalidated_while_reading(app, db_session, monkeypatch):
+    cache = app.extensions['account_cache']
+    debtor = procedures.create_debtor(user_id=666)
+    db_session.commit()
+    pk = (debtor.debtor_id, procedures.ROOT_CREDITOR_ID)
+    get_account_state = procedures._get_account_state
+
+    def get_account_state_and_invalidate(pk):
+        state = get_account_state(pk)
+        cache.invalidate(pk)
+        return state
+
+    monkeypatch.setattr(procedures, '_get_account_state', get_account_state_and_invalidate)
+    assert procedures.get_account_state(pk) is not None
+    assert cache.get(pk) is None
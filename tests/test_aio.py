@@ -0,0 +1,122 @@
+import asyncio
+import datetime
+import pytest
+import sqlalchemy
+from swaptacular_debtor.models import db, Account, Operator, Branch, Coordinator, PreparedTransfer, \
+    WithdrawalRequest, Debtor, get_now_utc
+from swaptacular_debtor import procedures
+from swaptacular_debtor.contention import ContentionStats
+
+aio = pytest.importorskip('swaptacular_debtor.aio')
+
+
+def test_compile_statement():
+    stmt = Account.__table__.select().where(Account.creditor_id.in_([1, 2])).where(Account.debtor_id.like('%a'))
+    sql, params = aio.compile_statement(stmt)
+    assert '$1' in sql and '$3' in sql and '%s' not in sql
+    assert params == [1, 2, '%a']
+    stmt = Account.__table__.select().where(Account.creditor_id == sqlalchemy.bindparam('creditor_id'))
+    assert aio.compile_statement(stmt, dict(creditor_id=5))[1] == [5]
+    assert aio.compile_statement(stmt, dict(creditor_id=6))[1] == [6]
+
+
+def _delete_debtor(debtor_id):
+    with db.engine.begin() as connection:
+        for model in [WithdrawalRequest, PreparedTransfer, Operator, Branch, Coordinator, Account, Debtor]:
+            connection.execute(model.__table__.delete().where(model.__table__.c.debtor_id == debtor_id))
+
+
+def test_async_procedures(app):
+    async def run():
+        procs = aio.AsyncProcedures(app)
+        try:
+            debtor = await procs.create_debtor(user_id=666, demurrage_rate=1.0)
+            debtor_id = debtor['debtor_id']
+            try:
+                assert debtor['demurrage_rate'] == 1.0
+                admin = (debtor_id, procedures.DEFAULT_BRANCH_ID, 666)
+                assert (await procs.get_operator(admin)).can_withdraw
+                assert await procs.get_operator((debtor_id, 1, 1)) is None
+                deadline_ts = get_now_utc() + datetime.timedelta(days=1)
+                request = await procs.create_withdrawal_request(admin, 777, 10, deadline_ts, {'a': 1})
+                assert request['details'] == {'a': 1}
+                with pytest.raises(procedures.InvalidOperator):
+                    await procs.create_withdrawal_request((debtor_id, 1, 1), 777, 10, deadline_ts)
+
+                root = (debtor_id, procedures.ROOT_CREDITOR_ID)
+                with pytest.raises(procedures.InsufficientFunds):
+                    await procs.prepare_direct_transfer(root, 777, 1000)
+                with db.engine.begin() as connection:
+                    connection.execute(Account.__table__.update().where(
+                        (Account.debtor_id == debtor_id) & (Account.creditor_id == procedures.ROOT_CREDITOR_ID)
+                    ).values(balance=5000, avl_balance=5000))
+
+                # Many transfers are prepared concurrently, and the
+                # conflicting transactions are retried.
+                transfers = await asyncio.gather(*[procs.prepare_direct_transfer(root, 777, 100) for _ in range(8)])
+                assert transfers[0]['sender_locked_amount'] == 100
+                pks = [(t['debtor_id'], t['prepared_transfer_seqnum']) for t in transfers]
+                await asyncio.gather(*[procs.commit_creditor_prepared_transfer(pk) for pk in pks[:6]])
+                await asyncio.gather(*[procs.cancel_creditor_prepared_transfer(pk) for pk in pks[6:]])
+                with pytest.raises(procedures.InvalidPreparedTransfer):
+                    await procs.commit_creditor_prepared_transfer(pks[0])
+                with db.engine.connect() as connection:
+                    accounts = connection.execute(Account.__table__.select().where(Account.debtor_id == debtor_id))
+                    balances = {row['creditor_id']: (row['balance'], row['avl_balance']) for row in accounts}
+                assert balances == {procedures.ROOT_CREDITOR_ID: (4400, 4400), 777: (600, 600)}
+            finally:
+                _delete_debtor(debtor_id)
+        finally:
+            await procs.close()
+
+    asyncio.run(run())
+
+
+def test_execute_atomic_stats(app, monkeypatch):
+    stats = ContentionStats(10)
+    monkeypatch.setitem(app.extensions, 'contention_stats', stats)
+
+    async def fail(connection):
+        raise procedures.InsufficientFunds()
+
+    async def run():
+        procs = aio.AsyncProcedures(app)
+        try:
+            with pytest.raises(procedures.InsufficientFunds):
+                await procs.execute_atomic(1, fail)
+        finally:
+            await procs.close()
+
+    asyncio.run(run())
+    [p] = stats.get_procedures().values()
+    assert p.calls == 1
+    assert p.failures == 1
+    assert p.attempts.count == 1
+    assert p.attempts.sum == 1
+    assert p.retries == 0
+
+
+def test_get_pool_after_failure(app, monkeypatch):
+    create_pool = aio.asyncpg.create_pool
+    calls = []
+
+    async def create_pool_failing_once(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == 1:
+            raise OSError('connection refused')
+        return await create_pool(*args, **kwargs)
+
+    monkeypatch.setattr(aio.asyncpg, 'create_pool', create_pool_failing_once)
+
+    async def run():
+        procs = aio.AsyncProcedures(app)
+        try:
+            with pytest.raises(OSError):
+                await procs._get_pool()
+            pool = await procs._get_pool()
+            assert await procs._get_pool() is pool
+        finally:
+            await procs.close()
+
+    asyncio.run(run())
+    assert len(calls) == 2
@@ -0,0 +1,94 @@
+import pytest
+import dramatiq
+from unittest import mock
+from sqlalchemy.exc import OperationalError, IntegrityError
+from flask_signalbus.utils import DBSerializationError
+from swaptacular_debtor.models import Account, PreparedTransfer
+from swaptacular_debtor import procedures, batching
+
+
+def _message(actor_name, **kwargs):
+    return dramatiq.Message(queue_name='q', actor_name=actor_name, args=(), kwargs=kwargs, options={})
+
+
+def _prepare(debtor_id, amount):
+    return _message('prepare_transfer', debtor_id=debtor_id, sender_creditor_id=777, recipient_creditor_id=888,
+                    amount=amount)
+
+
+def _get_avl_balance(debtor_id, creditor_id):
+    return Account.query.filter_by(debtor_id=debtor_id, creditor_id=creditor_id).one().avl_balance
+
+
+def test_collect_batch():
+    consumer = mock.Mock()
+    consumer.__next__ = mock.Mock(side_effect=[None, 1, 2, None, 3])
+    assert batching._collect_batch(consumer, 10) == [1, 2]
+    consumer.__next__ = mock.Mock(side_effect=[1, 2, 3])
+    assert batching._collect_batch(consumer, 2) == [1, 2]
+    consumer.__next__ = mock.Mock(side_effect=[None, 1])
+    assert batching._collect_batch(consumer, 10, block=False) == []
+
+
+def test_process_batch(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    debtor_id = debtor.debtor_id
+    db_session.add(Account(debtor=debtor, creditor_id=777, balance=1000, avl_balance=1000))
+    consumer = mock.Mock()
+    messages = [
+        _prepare(debtor_id, 300),
+        _prepare(debtor_id, 900),
+        _prepare(debtor_id, 400),
+        _message('unknown', debtor_id=debtor_id),
+        _message('prepare_transfer', amount=100),
+    ]
+    batching.process_batch(consumer, messages)
+    assert [c[0][0] for c in consumer.ack.call_args_list] == messages[:3]
+    assert [c[0][0] for c in consumer.nack.call_args_list] == messages[3:]
+    assert _get_avl_balance(debtor_id, 777) == 300
+    assert PreparedTransfer.query.filter_by(debtor_id=debtor_id).count() == 2
+
+
+def test_process_batch_isolates_failures(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    debtor_id = debtor.debtor_id
+    db_session.add(Account(debtor=debtor, creditor_id=777, balance=1000, avl_balance=1000))
+    db_session.commit()
+    consumer = mock.Mock()
+    messages = [
+        _prepare(debtor_id, 300),
+        _message('commit_transfer', debtor_id=debtor_id),
+    ]
+    batching.process_batch(consumer, messages)
+    assert [c[0][0] for c in consumer.ack.call_args_list] == messages[:1]
+    assert [c[0][0] for c in consumer.nack.call_args_list] == messages[1:]
+    assert _get_avl_balance(debtor_id, 777) == 700
+
+
+def test_process_batch_leaves_transient_errors_unacknowledged():
+    consumer = mock.Mock()
+    messages = [_prepare(1, 300), _prepare(2, 300)]
+    error = OperationalError('SELECT 1', {}, Exception('connection lost'))
+    with mock.patch.object(batching, 'execute_commands', side_effect=error):
+        with pytest.raises(OperationalError):
+            batching.process_batch(consumer, messages)
+    consumer.ack.assert_not_called()
+    consumer.nack.assert_not_called()
+
+
+def test_is_transient_error():
+    assert batching.is_transient_error(OperationalError('SELECT 1', {}, Exception()))
+    assert batching.is_transient_error(DBSerializationError())
+    assert not batching.is_transient_error(IntegrityError('INSERT', {}, Exception()))
+    assert not batching.is_transient_error(TypeError())
+
+
+def test_consume_commands_drain():
+    consumer = mock.Mock()
+    consumer.__next__ = mock.Mock(side_effect=[None])
+    with mock.patch.object(batching, 'broker') as broker:
+        broker.consume.return_value = consumer
+        batching.consume_commands(queue_name='q', drain=True)
+    broker.consume.assert_called_once_with('q', prefetch=batching.DEFAULT_BATCH_SIZE,
+                                           timeout=batching.DEFAULT_MAX_WAIT_MILLISECONDS)
+    consumer.close.assert_called_once_with()
@@ -0,0 +1,91 @@
+import threading
+import pytest
+from flask_signalbus.utils import DBSerializationError
+from swaptacular_debtor.models import db, Account
+from swaptacular_debtor.contention import ContentionStats, KeyCounter, note_accounts
+from swaptacular_debtor.stats import Histogram
+from swaptacular_debtor import procedures
+
+
+@pytest.fixture
+def stats(app, monkeypatch):
+    stats = ContentionStats(hot_keys_size=10)
+    monkeypatch.setitem(app.extensions, 'contention_stats', stats)
+    return stats
+
+
+def test_histogram():
+    h = Histogram((1, 2, 4))
+    for value in [0.5, 1, 3, 10]:
+        h.observe(value)
+    assert h.counts == [2, 0, 1, 1]
+    assert h.count == 4
+    assert h.sum == 14.5
+    h.merge(h)
+    assert h.counts == [4, 0, 2, 2]
+
+
+def test_key_counter():
+    c = KeyCounter(2)
+    c.update([1, 1, 1, 2, 2, 3])
+    c.update([4, 5])
+    assert c.counts == {1: 3, 2: 2}
+    KeyCounter(0).update([1])
+
+
+def test_track_retries(db_session, stats):
+    failures = []
+
+    @db.atomic
+    def conflict():
+        note_accounts([(1, 2)])
+        if not failures:
+            failures.append(1)
+            raise DBSerializationError
+        note_accounts([(1, 3)])
+
+    @db.atomic
+    def nested():
+        conflict()
+
+    nested()
+    conflict()
+    by_name = stats.get_procedures()
+    assert by_name['tests.test_contention.test_track_retries.<locals>.conflict'].calls == 1
+    p = by_name['tests.test_contention.test_track_retries.<locals>.nested']
+    assert p.calls == 1
+    assert p.failures == 0
+    assert p.attempts.counts[:3] == [0, 1, 0]
+    assert p.retries == 1
+    assert p.retry_causes == {'serialization_error': 1}
+    assert stats.get_hot_accounts() == [((1, 2), 1, 2), ((1, 3), 0, 2)]
+    assert 'nested' in stats.format_report()
+
+
+def test_track_lock_seconds(db_session, stats):
+    debtor = procedures.create_debtor(user_id=666)
+    db_session.add(Account(debtor=debtor, creditor_id=777, balance=1000, avl_balance=1000))
+    procedures.prepare_direct_transfer((debtor.debtor_id, 777), 888, 100)
+    with pytest.raises(procedures.InsufficientFunds):
+        procedures.prepare_direct_transfer((debtor.debtor_id, 777), 888, 1000)
+    p = stats.get_procedures()['swaptacular_debtor.procedures.prepare_direct_transfer']
+    assert p.calls == 2
+    assert p.failures == 1
+    assert p.lock_seconds.sum > 0.0
+    assert ((debtor.debtor_id, 777), 0, 1) in stats.get_hot_accounts()
+
+
+def test_merge_threads(stats):
+    def record():
+        stats.record('p', 2, ['deadlock_detected'], keys=[(1, 2)])
+
+    threads = [threading.Thread(target=record) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    record()
+    p = stats.get_procedures()['p']
+    assert p.calls == 4
+    assert p.retry_causes == {'deadlock_detected': 4}
+    assert stats.get_hot_accounts() == [((1, 2), 0, 4)]
@@ -0,0 +1,87 @@
+import datetime
+from swaptacular_debtor.models import Withdrawal, get_now_utc
+from swaptacular_debtor import procedures, history
+from swaptacular_debtor.sharding import debtor_shard
+
+
+def test_iter_withdrawals(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    d = debtor.debtor_id
+    branch = (d, procedures.DEFAULT_BRANCH_ID)
+    now = get_now_utc()
+    for i in range(25):
+        db_session.add(Withdrawal(
+            debtor_id=d,
+            creditor_id=1000 - i,
+            withdrawal_request_seqnum=i,
+            amount=i + 1,
+            operator_branch_id=procedures.DEFAULT_BRANCH_ID,
+            operator_user_id=666,
+            opening_ts=now,
+            closing_ts=now + datetime.timedelta(seconds=i // 3),
+        ))
+    db_session.commit()
+    withdrawals = list(history.iter_withdrawals(branch, page_size=7, session=db_session))
+    assert len(withdrawals) == 25
+    keys = [(w.closing_ts, w.creditor_id, w.withdrawal_request_seqnum) for w in withdrawals]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == 25
+    withdrawals = list(history.iter_withdrawals(
+        branch,
+        start_ts=now + datetime.timedelta(seconds=2),
+        end_ts=now + datetime.timedelta(seconds=5),
+        page_size=3,
+        session=db_session,
+    ))
+    assert sorted(w.withdrawal_request_seqnum for w in withdrawals) == list(range(6, 15))
+    assert list(history.iter_withdrawals((d, 2), session=db_session)) == []
+
+
+def test_iter_withdrawal_requests(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    d = debtor.debtor_id
+    operator = (d, procedures.DEFAULT_BRANCH_ID, 666)
+    deadline_ts = get_now_utc() + datetime.timedelta(days=1)
+    for creditor_id in range(10):
+        procedures.create_withdrawal_request(operator, creditor_id, 10, deadline_ts)
+    requests = history.iter_withdrawal_requests((d, procedures.DEFAULT_BRANCH_ID), page_size=4, session=db_session)
+    assert sorted(r.creditor_id for r in requests) == list(range(10))
+
+
+def test_iter_withdrawals_same_ts(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    d = debtor.debtor_id
+    branch = (d, procedures.DEFAULT_BRANCH_ID)
+    now = get_now_utc()
+    for i in range(300):
+        db_session.add(Withdrawal(
+            debtor_id=d,
+            creditor_id=i % 7,
+            withdrawal_request_seqnum=i,
+            amount=1,
+            operator_branch_id=procedures.DEFAULT_BRANCH_ID,
+            operator_user_id=666,
+            opening_ts=now,
+            closing_ts=now,
+        ))
+    db_session.commit()
+    withdrawals = list(history.iter_withdrawals(branch, page_size=11, session=db_session))
+    keys = [(w.creditor_id, w.withdrawal_request_seqnum) for w in withdrawals]
+    assert keys == sorted(keys)
+    assert sorted(seqnum for _, seqnum in keys) == list(range(300))
+
+
+def test_history_page_without_sort(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    with debtor_shard(debtor.debtor_id):
+        db_session.execute('SET LOCAL enable_seqscan = off')
+        plan = '\n'.join(row[0] for row in db_session.execute(
+            'EXPLAIN SELECT * FROM withdrawal '
+            'WHERE debtor_id = :debtor_id AND operator_branch_id = :branch_id AND closing_ts >= :ts '
+            'AND (closing_ts, creditor_id, withdrawal_request_seqnum) > (:ts, 0, 0) '
+            'ORDER BY closing_ts, creditor_id, withdrawal_request_seqnum LIMIT 100',
+            {'debtor_id': debtor.debtor_id, 'branch_id': procedures.DEFAULT_BRANCH_ID, 'ts': get_now_utc()},
+        ))
+        db_session.rollback()
+    assert 'Index Scan' in plan
+    assert 'Sort' not in plan
@@ -0,0 +1,32 @@
+import pytest
+from swaptacular_debtor import ids
+
+
+def test_scramble_id():
+    numbers = [ids.scramble_id(n) for n in range(1 << 12)]
+    assert numbers[0] == 0
+    assert len(set(numbers)) == len(numbers)
+    assert all(0 <= n <= ids.ID_MASK for n in numbers)
+    assert ids.scramble_id(ids.ID_MASK) <= ids.ID_MASK
+
+    # Consecutive numbers must be well spread.
+    assert len({n % 64 for n in numbers}) == 64
+    assert len({n >> (ids.ID_BITS - 6) for n in numbers}) == 64
+
+
+def test_block_id_allocator():
+    blocks = iter(range(1, 100))
+    allocator = ids.create_id_allocator('block', reserve_block=lambda: next(blocks))
+    numbers = [allocator.allocate() for _ in range(ids.BLOCK_SIZE + 1)]
+    assert len(set(numbers)) == len(numbers)
+    assert all(0 < n <= ids.ID_MASK for n in numbers)
+    assert next(blocks) == 3
+
+
+def test_create_id_allocator():
+    allocator = ids.create_id_allocator('random', reserve_block=None)
+    assert 0 < allocator.allocate() <= ids.ID_MASK
+    allocator = ids.create_id_allocator('swaptacular_debtor.ids:RandomIdAllocator', reserve_block=None)
+    assert isinstance(allocator, ids.RandomIdAllocator)
+    with pytest.raises(ImportError):
+        ids.create_id_allocator('swaptacular_debtor.ids:UnknownAllocator', reserve_block=None)
@@ -0,0 +1,55 @@
+from swaptacular_debtor.metrics import Metrics, TimedQueuePool
+from swaptacular_debtor.models import db, TransactionSignal
+from swaptacular_debtor import procedures, metrics
+
+
+def test_metrics(app, db_session, monkeypatch):
+    monkeypatch.setitem(app.extensions, 'metrics', Metrics())
+    debtor = procedures.create_debtor(user_id=666)
+    db_session.add(TransactionSignal(debtor_id=debtor.debtor_id, sender_creditor_id=1, recipient_creditor_id=2,
+                                     amount=100))
+    db_session.flush()
+    with app.test_client() as client:
+        response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    lines = response.get_data(as_text=True).splitlines()
+    assert 'debtor_procedure_seconds_bucket{procedure="create_debtor",le="+Inf"} 1' in lines
+    assert 'debtor_procedure_seconds_count{procedure="create_debtor"} 1' in lines
+    assert '# TYPE debtor_transaction_attempts histogram' in lines
+    assert any(line.startswith('debtor_db_pool_connections_in_use{bind="default"} ') for line in lines)
+    assert any(line.startswith('debtor_db_pool_checkout_seconds_count{bind="default"} ') for line in lines)
+    assert 'debtor_signal_rows{table="transaction_signal"} 1' in lines
+    assert 'debtor_signal_rows{table="withdrawal_signal"} 0' in lines
+    assert 'debtor_signal_oldest_age_seconds{table="withdrawal_signal"} 0.0' in lines
+
+
+def test_timed_queue_pool(app):
+    pool = db.get_engine(app).pool
+    assert isinstance(pool, TimedQueuePool)
+    count = pool.checkout_seconds.merge().count
+    connection = db.get_engine(app).connect()
+    connection.close()
+    assert pool.checkout_seconds.merge().count == count + 1
+    assert pool.recreate().checkout_seconds is pool.checkout_seconds
+
+
+def test_signal_metrics(app, db_session, monkeypatch):
+    monkeypatch.setattr(metrics, 'SIGNAL_COUNT_LIMIT', 2)
+    debtor = procedures.create_debtor(user_id=666)
+    db_session.commit()
+    m = Metrics()
+    assert 'debtor_signal_rows{table="transaction_signal"} 0' in m.render(app).splitlines()
+    for creditor_id in range(3):
+        db_session.add(TransactionSignal(debtor_id=debtor.debtor_id, sender_creditor_id=creditor_id,
+                                         recipient_creditor_id=2, amount=100))
+    db_session.flush()
+
+    # The values are cached.
+    assert 'debtor_signal_rows{table="transaction_signal"} 0' in m.render(app).splitlines()
+
+    # At most SIGNAL_COUNT_LIMIT signals are counted.
+    m = Metrics(signal_metrics_ttl=0.0)
+    lines = m.render(app).splitlines()
+    assert 'debtor_signal_rows{table="transaction_signal"} 2' in lines
+    assert any(line.startswith('debtor_signal_oldest_age_seconds{table="transaction_signal"} ') for line in lines)
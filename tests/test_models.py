@@ -2,7 +2,8 @@ import math
 import pytest
 from sqlalchemy import inspect
 from flask_signalbus.utils import DBSerializationError
-from swaptacular_debtor.models import db, Debtor, Account, Branch, Operator, Withdrawal, \
+from swaptacular_debtor import tasks
+from swaptacular_debtor.models import db, Debtor, Account, Branch, Operator, Withdrawal, WithdrawalSignal, \
     PreparedTransfer, TransactionSignal
 
 
@@ -39,6 +40,13 @@ def test_generate_sharding_key(db_session):
     assert num_calls > 1
 
 
+@pytest.mark.models
+def test_allocate_debtor_ids(db_session):
+    debtor_ids = [Debtor().debtor_id for _ in range(1000)]
+    assert len(set(debtor_ids)) == len(debtor_ids)
+    assert all(0 < debtor_id < (1 << 63) for debtor_id in debtor_ids)
+
+
 @pytest.mark.models
 def test_no_debtors(db_session):
     assert len(Debtor.query.all()) == 0
@@ -131,3 +139,67 @@ def test_send_signalbus_message(db_session):
     db_session.flush()
     db_session.commit()
     t.send_signalbus_message()
+
+
+@db.atomic
+def test_send_signalbus_messages(db_session, mocker):
+    publish_message = mocker.patch('swaptacular_debtor.tasks.broker').publish_message
+    publish_messages = mocker.patch('swaptacular_debtor.tasks.publish_messages')
+    signals = [
+        TransactionSignal(
+            debtor_id=1,
+            prepared_transfer_seqnum=seqnum,
+            sender_creditor_id=1,
+            recipient_creditor_id=2,
+            amount=100,
+        )
+        for seqnum in [1, 2, 3]
+    ]
+    for signal in signals:
+        db_session.add(signal)
+        signal.send_signalbus_message()
+    TransactionSignal.send_signalbus_messages(signals)
+    assert publish_message.call_count == 3
+    publish_messages.assert_called_once()
+    messages = publish_messages.call_args[0][0]
+    assert publish_messages.call_args[1] == {'exchange': ''}
+    assert len(messages) == 3
+    for message, call in zip(messages, publish_message.call_args_list):
+        assert message.actor_name == call[0][0].actor_name == 'on_transaction_signal'
+        assert message.kwargs == call[0][0].kwargs
+    assert messages[2].kwargs['prepared_transfer_seqnum'] == 3
+
+
+@pytest.mark.models
+def test_compiled_signal_dump(db_session):
+    t = TransactionSignal(
+        debtor_id=1,
+        prepared_transfer_seqnum=2,
+        sender_creditor_id=3,
+        recipient_creditor_id=4,
+        amount=None,
+    )
+    w = Withdrawal(debtor_id=1, creditor_id=666, withdrawal_request_seqnum=1, amount=5)
+    signals = [t, WithdrawalSignal(withdrawal=w), WithdrawalSignal()]
+    for signal in signals:
+        model = type(signal)
+        schema_dump = model.__marshmallow_schema__.dump(signal)
+        compiled_dump = model._get_signalbus_dump()(signal)
+        assert compiled_dump == schema_dump
+        assert list(compiled_dump) == list(schema_dump)
+        assert model._get_signalbus_dump() is model._get_signalbus_dump()
+        _, actor_name = model._get_signalbus_routing()
+        message = signal._create_signalbus_message(actor_name)
+        assert message.encode() == message.copy(kwargs=schema_dump).encode()
+    assert TransactionSignal._get_signalbus_dump() is not WithdrawalSignal._get_signalbus_dump()
+
+
+def test_signal_message_queue_name(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEBTOR_QUEUE_PARTITIONS', 4)
+    signal = TransactionSignal(debtor_id=123, prepared_transfer_seqnum=1, sender_creditor_id=1,
+                               recipient_creditor_id=2, amount=100)
+    assert signal._create_signalbus_message('on_transaction_signal').queue_name is None
+    monkeypatch.setattr(TransactionSignal, 'queue_name', 'q', raising=False)
+    message = signal._create_signalbus_message('on_transaction_signal')
+    assert message.queue_name == tasks.get_debtor_queue_name('q', 123)
+    assert message.queue_name.startswith('q_')
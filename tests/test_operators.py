@@ -0,0 +1,41 @@
+import pytest
+import datetime
+from swaptacular_debtor.models import Branch, Operator, get_now_utc
+from swaptacular_debtor import procedures
+
+
+def test_get_operator(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    debtor_id = debtor.debtor_id
+    db_session.commit()
+    admin = (debtor_id, procedures.DEFAULT_BRANCH_ID, 666)
+    info = procedures.get_operator(admin)
+    assert info.alias == 'admin'
+    assert info.can_withdraw
+    operators = procedures.get_debtor_operators(debtor_id)
+    assert operators.branches[procedures.DEFAULT_BRANCH_ID].info == {}
+    assert operators.operators[(procedures.DEFAULT_BRANCH_ID, 666)] == info
+
+    operator = Operator.query.get(admin)
+    operator.can_withdraw = False
+    db_session.commit()
+    assert not procedures.get_operator(admin).can_withdraw
+    db_session.add(Branch(debtor_id=debtor_id, branch_id=2, info={'name': 'branch 2'}))
+    db_session.commit()
+    assert procedures.get_debtor_operators(debtor_id).branches[2].info == {'name': 'branch 2'}
+    assert procedures.get_operator((debtor_id, 2, 1)) is None
+
+
+def test_create_withdrawal_request(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    db_session.add(Operator(debtor_id=debtor.debtor_id, branch_id=procedures.DEFAULT_BRANCH_ID, user_id=1,
+                            alias='auditor', can_audit=True))
+    deadline_ts = get_now_utc() + datetime.timedelta(days=1)
+    request = procedures.create_withdrawal_request(
+        (debtor.debtor_id, procedures.DEFAULT_BRANCH_ID, 666), 777, 10, deadline_ts)
+    assert request.amount == 10
+    with pytest.raises(procedures.PermissionDenied):
+        procedures.create_withdrawal_request((debtor.debtor_id, procedures.DEFAULT_BRANCH_ID, 1), 777, 10, deadline_ts)
+    with pytest.raises(procedures.InvalidOperator):
+        procedures.create_withdrawal_request((debtor.debtor_id, procedures.DEFAULT_BRANCH_ID, 2), 777, 10, deadline_ts)
+
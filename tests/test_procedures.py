@@ -1,6 +1,11 @@
+import math
 import pytest
 import datetime
-from swaptacular_debtor.models import db, Debtor, Account, Withdrawal, WithdrawalRequest
+from unittest import mock
+from sqlalchemy import event
+from sqlalchemy.orm import Query
+from swaptacular_debtor.models import db, Debtor, Account, PreparedTransfer, Withdrawal, WithdrawalRequest, \
+    get_now_utc
 from swaptacular_debtor import procedures
 
 
@@ -13,6 +18,14 @@ def test_create_debtor(db_session):
     assert len(debtor.account_list) == 1
 
 
+def test_create_debtor_with_debtor_id(app, db_session, monkeypatch):
+    allocator = mock.Mock()
+    monkeypatch.setitem(app.extensions, 'debtor_id_allocator', allocator)
+    debtor = procedures.create_debtor(debtor_id=123456789, user_id=666)
+    assert debtor.debtor_id == 123456789
+    allocator.allocate.assert_not_called()
+
+
 def test_prepare_direct_transfer(db_session):
     @db.execute_atomic
     def transfer():
@@ -27,6 +40,26 @@ def test_prepare_direct_transfer(db_session):
         procedures.prepare_direct_transfer((transfer.debtor_id, transfer.sender_creditor_id), 888, 1500)
 
 
+@pytest.mark.parametrize('with_update', [True, False])
+def test_lock_account_amount(app, db_session, monkeypatch, with_update):
+    monkeypatch.setitem(app.config, 'LOCK_ACCOUNT_AMOUNTS_WITH_UPDATE', with_update)
+    debtor = procedures.create_debtor(user_id=666)
+    db_session.add(Account(debtor=debtor, creditor_id=777, balance=2000, avl_balance=2000, demurrage=100))
+    account = procedures._lock_account_amount((debtor.debtor_id, 777), 1500)
+    assert account.avl_balance == 500
+    with pytest.raises(procedures.InsufficientFunds) as e:
+        procedures._lock_account_amount(account, 550)
+    assert e.value.args == (500,)
+    account = procedures._lock_account_amount(account, 550, ignore_demurrage=True)
+    assert account.avl_balance == -50
+    db_session.flush()
+    db_session.expire_all()
+    assert Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=777).one().avl_balance == -50
+    with pytest.raises(procedures.InsufficientFunds) as e:
+        procedures._lock_account_amount((debtor.debtor_id, 888), 1)
+    assert e.value.args == (0,)
+
+
 @db.atomic
 def test_get_account(db_session):
     debtor = procedures.create_debtor(user_id=666)
@@ -54,3 +87,206 @@ def test_cancel_prepared_transfer(db_session):
     assert a.avl_balance == 3000
     with pytest.raises(procedures.InvalidPreparedTransfer):
         procedures.cancel_creditor_prepared_transfer(transfer)
+
+
+def test_commit_prepared_transfer(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    debtor = Debtor.query.filter_by(debtor_id=debtor.debtor_id).one()
+    db_session.add(Account(debtor=debtor, creditor_id=777, balance=3000, avl_balance=3000))
+    transfer = procedures.prepare_direct_transfer((debtor.debtor_id, 777), recipient_creditor_id=888, amount=500)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    @db.execute_atomic
+    def commit():
+        sender = Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=777).one()
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            procedures._commit_prepared_transfer(transfer)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        assert sender.balance == 2500
+        assert sender.avl_balance == 2500
+
+    assert len(statements) == 2
+    a = Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=777).one()
+    assert a.balance == 2500
+    assert a.avl_balance == 2500
+    assert a.last_transfer_ts > datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    a = Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=888).one()
+    assert a.balance == 500
+    assert a.avl_balance == 500
+    with pytest.raises(procedures.InvalidPreparedTransfer):
+        procedures.commit_creditor_prepared_transfer(transfer)
+
+
+def test_coordinator_prepared_transfers(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    d = debtor.debtor_id
+    coordinator = (d, procedures.DEFAULT_COORINATOR_ID)
+    db_session.add(Account(debtor_id=d, creditor_id=777, balance=3000, avl_balance=2000))
+    transfers = [PreparedTransfer(
+        debtor_id=d,
+        sender_creditor_id=777,
+        recipient_creditor_id=888,
+        amount=amount,
+        transfer_type=PreparedTransfer.TYPE_CIRCULAR,
+        coordinator_id=procedures.DEFAULT_COORINATOR_ID,
+    ) for amount in [100, 200, 300, 400]]
+    db_session.add_all(transfers)
+    db_session.commit()
+    seqnums = [t.prepared_transfer_seqnum for t in transfers]
+    procedures.prepare_direct_transfer((d, 777), 888, 1000)
+    with pytest.raises(procedures.InvalidPreparedTransfer):
+        procedures.commit_coordinator_prepared_transfers(coordinator, seqnums + [-1])
+    assert procedures.commit_coordinator_prepared_transfers(coordinator, seqnums[:2]) == 2
+    assert procedures.commit_coordinator_prepared_transfers(coordinator, []) == 0
+    a = Account.query.filter_by(debtor_id=d, creditor_id=777).one()
+    assert a.balance == 2700
+    assert a.avl_balance == 1000
+    assert Account.query.filter_by(debtor_id=d, creditor_id=888).one().balance == 300
+    assert procedures.cancel_coordinator_prepared_transfers(coordinator) == 2
+    assert procedures.cancel_coordinator_prepared_transfers(coordinator) == 0
+    a = Account.query.filter_by(debtor_id=d, creditor_id=777).one()
+    assert a.balance == 2700
+    assert a.avl_balance == 1700
+
+
+def test_prepare_direct_transfers(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    debtor = Debtor.query.filter_by(debtor_id=debtor.debtor_id).one()
+    db_session.add(Account(debtor=debtor, creditor_id=777, balance=2000, avl_balance=2000))
+    db_session.add(Account(debtor=debtor, creditor_id=778, balance=100, avl_balance=50, demurrage=50))
+    results = procedures.prepare_direct_transfers([
+        ((debtor.debtor_id, 777), 888, 1500),
+        ((debtor.debtor_id, 777), 888, 1000),
+        ((debtor.debtor_id, 778), procedures.ROOT_CREDITOR_ID, 100),
+        ((debtor.debtor_id, 999), 888, 10),
+    ])
+    assert len(results) == 4
+    assert results[0].amount == 1500
+    assert results[0].sender_creditor_id == 777
+    assert results[0].sender_locked_amount == 1500
+    assert isinstance(results[1], procedures.InsufficientFunds)
+    assert results[2].recipient_creditor_id == procedures.ROOT_CREDITOR_ID
+    assert isinstance(results[3], procedures.InsufficientFunds)
+    assert Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=777).one().avl_balance == 500
+    assert Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=778).one().avl_balance == -50
+    procedures.cancel_creditor_prepared_transfer(results[0])
+    assert Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=777).one().avl_balance == 2000
+    assert procedures.prepare_direct_transfers([]) == []
+
+
+def test_prepare_direct_transfers_returning_order(db_session, monkeypatch):
+    debtor = procedures.create_debtor(user_id=666)
+    debtor = Debtor.query.filter_by(debtor_id=debtor.debtor_id).one()
+    db_session.add(Account(debtor=debtor, creditor_id=777, balance=2000, avl_balance=2000))
+    db_session.add(Account(debtor=debtor, creditor_id=778, balance=2000, avl_balance=2000))
+
+    # The inserted rows are returned in reverse order.
+    instances = Query.instances
+    monkeypatch.setattr(Query, 'instances', lambda self, cursor: list(reversed(list(instances(self, cursor)))))
+    batch = [
+        ((debtor.debtor_id, 777), 888, 10),
+        ((debtor.debtor_id, 778), 888, 10),
+        ((debtor.debtor_id, 777), 889, 10),
+        ((debtor.debtor_id, 777), 888, 20),
+        ((debtor.debtor_id, 777), 888, 10),
+    ]
+    results = procedures.prepare_direct_transfers(batch)
+    for (sender_account, recipient_creditor_id, amount), transfer in zip(batch, results):
+        assert (transfer.debtor_id, transfer.sender_creditor_id) == sender_account
+        assert transfer.recipient_creditor_id == recipient_creditor_id
+        assert transfer.amount == amount
+    assert len({t.prepared_transfer_seqnum for t in results}) == len(batch)
+
+
+def test_accrue_demurrage(db_session):
+    debtor = procedures.create_debtor(user_id=666, demurrage_rate=10.0, demurrage_rate_ceiling=20.0)
+    debtor = Debtor.query.filter_by(debtor_id=debtor.debtor_id).one()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    year_ago = now - datetime.timedelta(days=365.25)
+    for creditor_id in [777, 778, 779]:
+        db_session.add(Account(
+            debtor=debtor,
+            creditor_id=creditor_id,
+            balance=1000,
+            avl_balance=1000,
+            demurrage_ts=year_ago,
+        ))
+    db_session.add(Account(debtor=debtor, creditor_id=780, balance=1000, avl_balance=900, demurrage=900,
+                           discount_demurrage_rate=5.0, demurrage_ts=year_ago))
+    db_session.commit()
+    assert list(procedures.accrue_demurrage(debtor.debtor_id, now, chunk_size=2)) == [777, 779, 780]
+    assert list(procedures.accrue_demurrage(debtor.debtor_id, now)) == []
+    accounts = Account.query.filter_by(debtor_id=debtor.debtor_id).order_by(Account.creditor_id).all()
+    assert [a.demurrage for a in accounts] == [0, 90, 90, 90, 904]
+    assert [a.avl_balance for a in accounts] == [0, 910, 910, 910, 896]
+    assert all(a.demurrage_ts == now for a in accounts)
+
+
+def test_account_slots(app, db_session, monkeypatch):
+    monkeypatch.setitem(app.config, 'ROOT_ACCOUNT_SLOTS', 4)
+    debtor = procedures.create_debtor(user_id=666)
+    root = (debtor.debtor_id, procedures.ROOT_CREDITOR_ID)
+    assert procedures._use_account_slots(procedures.ROOT_CREDITOR_ID)
+    assert not procedures._use_account_slots(777)
+
+    @db.execute_atomic
+    def add_to_slots():
+        for amount in [10, 20, 30, 40, 50]:
+            procedures._add_to_account_slot(root, amount, get_now_utc())
+
+    assert procedures.get_account_balances(root) == (150, 150)
+    assert procedures.get_account_balances((debtor.debtor_id, 777)) == (0, 0)
+    assert Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=procedures.ROOT_CREDITOR_ID).one().balance == 0
+    assert 1 <= procedures.fold_account_slots(root) <= 4
+    assert procedures.fold_account_slots(root) == 0
+    assert procedures.get_account_balances(root) == (150, 150)
+    account = Account.query.filter_by(debtor_id=debtor.debtor_id, creditor_id=procedures.ROOT_CREDITOR_ID).one()
+    assert account.balance == 150
+    assert account.avl_balance == 150
+    assert account.last_transfer_ts > datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@db.atomic
+def test_get_accounts(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    d = debtor.debtor_id
+    db_session.add(Account(debtor_id=d, creditor_id=777, balance=10, avl_balance=10))
+    db_session.flush()
+    db_session.expunge_all()
+    accounts = procedures._get_accounts([(d, 777), (d, 888), (d, 888), (d, procedures.ROOT_CREDITOR_ID)])
+    assert set(accounts) == {(d, 777), (d, 888), (d, procedures.ROOT_CREDITOR_ID)}
+    assert accounts[(d, 777)].balance == 10
+    assert accounts[(d, 888)].balance == 0
+    assert accounts[(d, 888)].discount_demurrage_rate == math.inf
+    assert accounts[(d, 888)] in db_session
+    assert procedures._get_accounts([(d, 888)])[(d, 888)] is accounts[(d, 888)]
+    db_session.expunge_all()
+    assert Account.query.filter_by(debtor_id=d).count() == 3
+    assert procedures._get_account((d, 888)).creditor_id == 888
+    assert procedures._get_accounts([]) == {}
+
+
+def test_reap_expired(db_session):
+    debtor = procedures.create_debtor(user_id=666)
+    d = debtor.debtor_id
+    db_session.add(Account(debtor_id=d, creditor_id=777, balance=3000, avl_balance=3000))
+    for amount in [100, 200, 300]:
+        procedures.prepare_direct_transfer((d, 777), 888, amount)
+    now = get_now_utc()
+    operator = (d, procedures.DEFAULT_BRANCH_ID, 666)
+    procedures.create_withdrawal_request(operator, 777, 10, now - datetime.timedelta(days=1))
+    procedures.create_withdrawal_request(operator, 777, 10, now + datetime.timedelta(days=1))
+    assert procedures.cancel_stale_prepared_transfers(now - datetime.timedelta(days=1)) == 0
+    assert procedures.cancel_stale_prepared_transfers(get_now_utc(), batch_size=2) == 2
+    assert procedures.cancel_stale_prepared_transfers(get_now_utc(), batch_size=2) == 1
+    a = Account.query.filter_by(debtor_id=d, creditor_id=777).one()
+    assert a.balance == 3000
+    assert a.avl_balance == 3000
+    assert procedures.delete_expired_withdrawal_requests() == 1
+    assert procedures.delete_expired_withdrawal_requests() == 0
+    assert WithdrawalRequest.query.filter_by(debtor_id=d).count() == 1
@@ -0,0 +1,44 @@
+import math
+import pytest
+import sqlalchemy
+from swaptacular_debtor import create_app
+from swaptacular_debtor.models import db, Debtor
+from swaptacular_debtor.replicas import ReplicaSelector, get_replica_staleness
+
+
+def test_replica_selector():
+    stalenesses = {'a': 1.0, 'b': 10.0}
+    checks = []
+
+    def get_staleness(bind_key):
+        checks.append(bind_key)
+        if bind_key == 'c':
+            raise RuntimeError
+        return stalenesses[bind_key]
+
+    selector = ReplicaSelector(['a', 'b', 'c'], max_staleness=5.0, get_staleness=get_staleness, check_interval=60.0)
+    assert selector.select() == 'a'
+    assert selector.get_staleness('c') == math.inf
+    stalenesses['a'] = 10.0
+    assert selector.select() == 'a'
+    assert checks == ['a', 'b', 'c']
+    selector.check_interval = 0.0
+    assert selector.select() is None
+
+
+def test_replica_session(app):
+    assert get_replica_staleness(db.engine) == 0.0
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    replica_app = create_app({'TESTING': True, 'REPLICA_DATABASE_URIS': uri})
+    with replica_app.app_context():
+        assert db.replica_session.get_bind() is db.get_engine(replica_app, bind='replica0')
+        assert db.replica_session.query(Debtor).count() >= 0
+        db.replica_session.rollback()
+
+        # When there are no fresh replicas, the primary is used in a
+        # read-only transaction.
+        replica_app.extensions['replica_selector'].max_staleness = -1.0
+        assert db.replica_session.get_bind() is db.get_engine(replica_app)
+        with pytest.raises(sqlalchemy.exc.InternalError):
+            db.replica_session.execute('CREATE TEMPORARY TABLE t (id int)')
+        db.replica_session.rollback()
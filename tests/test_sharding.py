@@ -0,0 +1,160 @@
+import pytest
+import sqlalchemy
+from swaptacular_debtor import sharding
+from swaptacular_debtor.models import db, Account
+
+
+def test_parse_shards():
+    assert sharding.parse_shards('') == []
+    assert sharding.parse_shards('100=postgresql://b 0=postgresql://a') == [
+        (0, 'postgresql://a'),
+        (100, 'postgresql://b'),
+    ]
+    with pytest.raises(ValueError):
+        sharding.parse_shards('100=postgresql://b')
+    with pytest.raises(ValueError):
+        sharding.parse_shards('0=postgresql://a 0=postgresql://b')
+    with pytest.raises(ValueError):
+        sharding.parse_shards('0postgresql://a')
+
+
+def test_shard_router():
+    router = sharding.ShardRouter([(0, 'a'), (100, 'b'), (200, 'c')])
+    assert router.get_shard(0) == 'a'
+    assert router.get_shard(99) == 'a'
+    assert router.get_shard(100) == 'b'
+    assert router.get_shard(sharding.MAX_DEBTOR_ID) == 'c'
+
+
+def test_get_debtor_id():
+    class Instance:
+        debtor_id = 3
+
+    assert sharding.get_debtor_id(1) == 1
+    assert sharding.get_debtor_id((2, 777)) == 2
+    assert sharding.get_debtor_id(Instance()) == 3
+
+
+def test_use_shard():
+    assert sharding.get_current_shard() is None
+    with sharding.use_shard('a'):
+        assert sharding.get_current_shard() == 'a'
+        with sharding.use_shard('a'):
+            assert sharding.get_current_shard() == 'a'
+        with pytest.raises(sharding.CrossShardError):
+            with sharding.use_shard('b'):
+                pass
+    assert sharding.get_current_shard() is None
+
+
+def test_debtor_shard(app, monkeypatch):
+    with sharding.debtor_shard(1, 200):
+        assert sharding.get_current_shard() is None
+    assert sharding.get_shard_keys() == [None]
+
+    monkeypatch.setitem(app.extensions, 'shard_router', sharding.ShardRouter([(0, 'a'), (100, 'b')]))
+    assert sharding.get_shard_keys() == ['a', 'b']
+    with sharding.debtor_shard(1, 2):
+        assert sharding.get_current_shard() == 'a'
+    with pytest.raises(sharding.CrossShardError):
+        with sharding.debtor_shard(1, 200):
+            pass
+
+    @sharding.sharded
+    def f(account):
+        return sharding.get_current_shard()
+
+    assert f((200, 777)) == 'b'
+    assert sharding.get_current_shard() is None
+
+
+def test_get_clause_debtor_ids():
+    table = Account.__table__
+    assert sharding.get_clause_debtor_ids(table.select().where(Account.debtor_id == 1)) == {1}
+    query = table.select().where((Account.debtor_id == 1) & (Account.creditor_id == 2))
+    assert sharding.get_clause_debtor_ids(query) == {1}
+    assert sharding.get_clause_debtor_ids(table.select().where(Account.debtor_id.in_([1, 2]))) == set()
+
+
+def test_sharded_session_routing(app, db_session, monkeypatch):
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    monkeypatch.setitem(app.config['SQLALCHEMY_BINDS'], 'a', database_uri)
+    monkeypatch.setitem(app.config['SQLALCHEMY_BINDS'], 'b', database_uri)
+    monkeypatch.setitem(app.extensions, 'shard_router', sharding.ShardRouter([(0, 'a'), (100, 'b')]))
+    session = db.create_scoped_session()
+    try:
+        query = session.query(Account).filter_by(debtor_id=200)
+        assert session.get_bind(Account.__mapper__, query.statement) is db.get_engine(app, bind='b')
+        with pytest.raises(sharding.ShardNotSelectedError):
+            session.query(Account).all()
+        with pytest.raises(sharding.ShardNotSelectedError):
+            session.query(Account).filter(Account.debtor_id.in_([1, 200])).all()
+        with sharding.use_shard('a'):
+            assert session.get_bind(Account.__mapper__) is db.get_engine(app, bind='a')
+    finally:
+        session.remove()
+
+
+def _count(engine, table):
+    return engine.execute(sqlalchemy.select([sqlalchemy.func.count()]).select_from(table)).scalar()
+
+
+@pytest.fixture
+def shard_engines(app):
+    # Two schemas in the test database play the role of the source
+    # and the target databases.
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    engines = []
+    for schema in ['shard_test_source', 'shard_test_target']:
+        with sqlalchemy.create_engine(database_uri).connect() as connection:
+            connection.execute(f'CREATE SCHEMA IF NOT EXISTS {schema}')
+        engines.append(sqlalchemy.create_engine(database_uri, connect_args={'options': f'-c search_path={schema}'}))
+    yield engines
+    for engine, schema in zip(engines, ['shard_test_source', 'shard_test_target']):
+        engine.dispose()
+        with sqlalchemy.create_engine(database_uri).connect() as connection:
+            connection.execute(f'DROP SCHEMA {schema} CASCADE')
+
+
+def test_move_debtor_after_interruption(shard_engines):
+    source_engine, target_engine = shard_engines
+    metadata = sqlalchemy.MetaData()
+    parent = sqlalchemy.Table(
+        'parent', metadata,
+        sqlalchemy.Column('debtor_id', sqlalchemy.BigInteger, primary_key=True, autoincrement=False),
+    )
+    child = sqlalchemy.Table(
+        'child', metadata,
+        sqlalchemy.Column('debtor_id', sqlalchemy.BigInteger, sqlalchemy.ForeignKey('parent.debtor_id'),
+                          primary_key=True, autoincrement=False),
+        sqlalchemy.Column('seqnum', sqlalchemy.BigInteger, primary_key=True, autoincrement=True),
+        sqlalchemy.Column('amount', sqlalchemy.BigInteger, nullable=False),
+    )
+    tables = [parent, child]
+    for engine in shard_engines:
+        metadata.create_all(engine)
+    source_engine.execute(parent.insert(), [{'debtor_id': 1}])
+    source_engine.execute(child.insert(), [{'debtor_id': 1, 'amount': 10}, {'debtor_id': 1, 'amount': 20}])
+
+    def fail_on_delete(conn, cursor, statement, *args):
+        if statement.startswith('DELETE'):
+            raise RuntimeError('interrupted')
+
+    sqlalchemy.event.listen(source_engine, 'before_cursor_execute', fail_on_delete)
+    try:
+        with pytest.raises(RuntimeError):
+            sharding.move_debtor(1, tables, source_engine, target_engine)
+    finally:
+        sqlalchemy.event.remove(source_engine, 'before_cursor_execute', fail_on_delete)
+    assert _count(source_engine, child) == 2
+    assert _count(target_engine, child) == 2
+
+    # The source database is still the authoritative one.
+    source_engine.execute(child.update().where(child.c.amount == 20).values(amount=30))
+    sharding.move_debtor(1, tables, source_engine, target_engine)
+    assert _count(source_engine, child) == 0
+    assert _count(source_engine, parent) == 0
+    assert sorted(row['amount'] for row in target_engine.execute(child.select())) == [10, 30]
+    sharding.move_debtor(1, tables, source_engine, target_engine)
+    assert _count(target_engine, child) == 2
+    assert target_engine.execute(sqlalchemy.select([sqlalchemy.func.nextval('child_seqnum_seq')])).scalar() > 2
@@ -0,0 +1,55 @@
+import threading
+import dramatiq
+from swaptacular_debtor import tasks
+from swaptacular_debtor.ids import scramble_id
+
+
+def test_publish_messages(mocker):
+    broker = mocker.patch('swaptacular_debtor.tasks.broker')
+    mocker.patch('swaptacular_debtor.tasks._local', new=threading.local())
+    channel = broker.connection.channel.return_value
+    channel.is_closed = False
+    messages = [
+        dramatiq.Message(queue_name=None, actor_name='on_event', args=(), kwargs={'n': 1}, options={}),
+        dramatiq.Message(queue_name='q', actor_name='actor', args=(), kwargs={'n': 2}, options={}),
+    ]
+    tasks.publish_messages(messages, exchange='events')
+    tasks.publish_messages(messages[:1], exchange='events')
+    broker.connection.channel.assert_called_once()
+    channel.tx_select.assert_called_once()
+    assert channel.tx_commit.call_count == 2
+    assert channel.basic_publish.call_count == 3
+    calls = channel.basic_publish.call_args_list
+    assert calls[0][1]['routing_key'] == 'dramatiq.events.on_event'
+    assert calls[0][1]['exchange'] == 'events'
+    assert calls[1][1]['routing_key'] == 'q'
+    assert calls[1][1]['body'] == messages[1].encode()
+
+
+def test_get_debtor_partition():
+    debtor_ids = [scramble_id(i) for i in range(1, 2001)]
+    partitions = [tasks.get_debtor_partition(debtor_id, 10) for debtor_id in debtor_ids]
+    assert set(partitions) == set(range(10))
+    assert all(150 < partitions.count(i) < 250 for i in range(10))
+    assert all(tasks.get_debtor_partition(debtor_id, 1) == 0 for debtor_id in debtor_ids)
+
+    # Only the debtors that move to the new partition get reassigned.
+    for debtor_id, partition in zip(debtor_ids, partitions):
+        assert tasks.get_debtor_partition(debtor_id, 11) in (partition, 10)
+
+
+def test_get_debtor_queue_name(app, monkeypatch):
+    assert tasks.get_debtor_queue_name('q', 123) == 'q'
+    monkeypatch.setitem(app.config, 'DEBTOR_QUEUE_PARTITIONS', 4)
+    assert tasks.get_partition_queue_names('q', 4) == ['q_0', 'q_1', 'q_2', 'q_3']
+    assert tasks.get_debtor_queue_name('q', 123) == f'q_{tasks.get_debtor_partition(123, 4)}'
+
+
+def test_send_command(app, mocker, monkeypatch):
+    monkeypatch.setitem(app.config, 'DEBTOR_QUEUE_PARTITIONS', 4)
+    broker = mocker.patch('swaptacular_debtor.tasks.broker')
+    tasks.send_command(tasks.commit_transfer, 123, prepared_transfer_seqnum=1)
+    message = broker.enqueue.call_args[0][0]
+    assert message.actor_name == 'commit_transfer'
+    assert message.queue_name == tasks.get_debtor_queue_name(tasks.COMMANDS_QUEUE, 123)
+    assert message.kwargs == {'debtor_id': 123, 'prepared_transfer_seqnum': 1}